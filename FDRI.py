@@ -32,7 +32,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import inspect
+import csv
+import itertools
 import json
 from datetime import datetime
 import os  # file checking
@@ -40,18 +41,27 @@ import shutil  # file copy
 import subprocess  # .exe calling
 import time
 import signal
+import socket
 import hashlib
-import xml.dom.minidom as m_dom
+import struct
+import sys
+import xml.sax
+from array import array
+from xml.sax.saxutils import XMLGenerator
 import jarray
-from java.awt import BorderLayout, GridLayout, FlowLayout, Dimension
+from java.awt import (BasicStroke, BorderLayout, Color, GridLayout,
+                                    FlowLayout, Dimension, RenderingHints)
 from java.awt.event import KeyAdapter, KeyEvent, KeyListener
-from threading import Thread
-from distutils.dir_util import copy_tree
+from java.awt.image import BufferedImage
+from threading import Thread, Lock, Event, Condition
+from Queue import Queue
 
 # Java librarys
-from java.io import File
+from java.io import File, FileOutputStream, RandomAccessFile
 from java.lang import System
-from java.lang import Thread as JThread
+from java.nio import ByteOrder
+from java.nio.channels import FileChannel
+from java.nio.file import Files
 from java.util.logging import Level
 
 
@@ -60,6 +70,7 @@ from javax.swing import (BorderFactory, BoxLayout, JButton, JCheckBox,
                          JComponent, JFileChooser, JFrame, JLabel, JPanel,
                          JScrollPane, JTextField, JToolBar)
 from javax.swing.event import DocumentEvent, DocumentListener
+from javax.imageio import ImageIO
 from org.sleuthkit.autopsy.casemodule import Case
 from org.sleuthkit.autopsy.casemodule.services import (Blackboard, FileManager,
                                                        Services)
@@ -77,7 +88,8 @@ from org.sleuthkit.autopsy.ingest import (DataSourceIngestModule,
 from org.sleuthkit.autopsy.ingest.IngestModule import IngestModuleException
 from org.sleuthkit.datamodel import (AbstractFile, BlackboardArtifact,
                                      BlackboardAttribute, SleuthkitCase,
-                                     TskData, ReadContentInputStream)
+                                     TskData, ReadContentInputStream,
+                                     TskCoreException)
 
 #====================================================================
 # Configuration
@@ -90,12 +102,36 @@ GLOBAL_CONFIGURATION_PATH = os.path.join(os.path.dirname(
     os.path.abspath(__file__)), "configuration.json")
 
 CONFIGURATION_PATH = ""
+# MIME types (detected by Autopsy) of the supported extensions
+C_MIME_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+C_MIME_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png"}
+
 # Number of bytes to read on hashing function
-BLOCKSIZE = 5120
+BLOCKSIZE = 65536
+
+# Digests computed by the hashing engine (all in a single read of the file)
+C_HASH_ALGORITHMS = ("md5", "sha1", "sha256")
 
 # Minimum size for an image file to be processed (in bytes=
 C_FILE_MIN_SIZE = 1025
 
+# Check the header of each image before copying it: files that are not
+# valid JPEG/PNG images, or smaller than C_IMAGE_MIN_WIDTH x
+# C_IMAGE_MIN_HEIGHT pixels, are not copied nor given to FDRI.exe
+C_SNIFF_HEADERS = True
+
+# Minimum resolution (in pixels) of an image to be processed. Smaller
+# images (icons, tracking pixels) are too small to hold a face
+C_IMAGE_MIN_WIDTH = 40
+C_IMAGE_MIN_HEIGHT = 40
+
+# Bytes read at a time when checking the header of an image
+C_SNIFF_CHUNK_SIZE = 4096
+
+# How far into a JPEG file the SOF segment (dimensions) is looked for.
+# The segments before it (EXIF, thumbnails) are skipped, not read.
+C_SNIFF_MAX_OFFSET = 1024*1024
+
 # Name of file to hold the filenames where faces were detected
 C_FACES_FOUND_FNAME = "FDRI_faces_found.txt"
 
@@ -111,27 +147,293 @@ C_FILE_WITH_FNAMES_AND_SIZES = "FDRI_filenames+size.log.txt"
 # Name of file to get the list of repeated files
 C_REPEATED_FILES_LOG = "FDRI_repeated_files.log.txt"
 
+# Files hashed by the run (one JSON list per line: object id, name,
+# size), written while enumerating and read back for the repeated files
+C_HASHED_FILES_FNAME = "FDRI_hashed_files.json"
+
+# Name of file recording, per data source, the state of each file
+C_MANIFEST_FNAME = "FDRI_manifest.json"
+
+# Where the copies already processed by FDRI.exe are moved (from img/)
+C_IMG_DONE_DIR = "img_done"
+
+# FDRI.exe return codes meaning that all the images were processed
+# (8/9: no positive/target faces found)
+C_EXE_COMPLETED_CODES = (0, 8, 9)
+
+# FDRI.exe return code: CUDA out of memory
+C_EXE_OOM_CODE = 10
+
+# Return code given to a run killed by the watchdog (not an FDRI.exe
+# code: see C_STALL_KILL_SECS)
+C_EXE_STALLED_CODE = 99
+
+# Recover from CUDA out of memory: the images of the shard are split in
+# halves (each half with half the batch size) until the failing image is
+# found; it is then processed downscaled, by C_OOM_DOWNSCALE_FACTOR per
+# side at each attempt (at most C_OOM_DOWNSCALE_STEPS attempts)
+C_OOM_RECOVERY = True
+C_OOM_DOWNSCALE_FACTOR = 0.5
+C_OOM_DOWNSCALE_STEPS = 3
+
+# Sub-directory (of img/ and of the run's workspace) of the shards
+# created by the recovery: shard index, number of the recovery shard
+C_OOM_SHARD_DIR_FMT = "shard_%04d_oom_%02d"
+
+# Name of file recording the decisions of the recovery, image by image
+C_OOM_LOG_FNAME = "FDRI_oom_recovery.log.txt"
+
+# Downscaled detection: FDRI.exe gets the images whose longest side is
+# larger than this (pixels) decoded at a reduced scale, and the face
+# boxes it finds are projected back to the original image, for the
+# annotated copy and the recognition crop (0: images as they are)
+C_DETECT_MAX_SIDE = 0
+
+# Directory (next to the shard's img/, suffixed) of the originals of
+# the images given downscaled to FDRI.exe
+C_ORIGINALS_DIR_SUFFIX = "_originals"
+
+# Scale and original of each downscaled image (params.json's
+# "image_scales"), so that FDRI.exe crops the faces to recognize from
+# the originals (versions ignoring the key use the downscaled images)
+C_IMAGE_SCALES_FNAME = "FDRI_image_scales.json"
+
+# Face boxes (left, top, right, bottom) written by FDRI.exe
+# (params.json's "boxes_out"); projected to the originals once read
+C_BOXES_FNAME = "FDRI_boxes.json"
+
+# Colour and width (pixels of the original) of the face boxes drawn
+# on the annotated copies of the downscaled images
+C_ANNOTATION_COLOR = Color.RED
+C_ANNOTATION_STROKE = 3
+
 # Name of file holding JSON parameters
 C_PARAMS_JSON_FNAME="params.json"
 
+# Cache of the descriptors of the wanted faces (next to configuration.json)
+C_WANTED_CACHE_FNAME = "FDRI_wanted_cache.json"
+
+# Descriptors of the wanted faces given to FDRI.exe (params.json's
+# "wanted_descriptors") and descriptors computed by FDRI.exe for the
+# reference images that were not cached ("wanted_descriptors_out").
+# With "embed_only": true FDRI.exe only computes the latter: it loads
+# the recognition model, not the detector, and reads no imagesPath
+# (versions ignoring the key process imagesPath, given empty).
+C_WANTED_DESCRIPTORS_FNAME = "wanted_descriptors.json"
+C_WANTED_DESCRIPTORS_OUT_FNAME = "wanted_descriptors_out.json"
+
+# Face descriptors of the processed images, written by FDRI.exe
+# (params.json's "descriptors_out")
+C_DESCRIPTORS_FNAME = "FDRI_descriptors.json"
+
+# Index of the face descriptors of every processed image (all cases),
+# next to configuration.json. Wanted faces are searched in it for the
+# files that are not processed again by FDRI.exe
+C_FACE_INDEX = True
+C_FACE_INDEX_DIR = "FDRI_face_index"
+
+# Size of dlib's face descriptors
+C_FACE_DESCRIPTOR_DIM = 128
+
+# Maximum euclidean distance between descriptors of the same person
+C_FACE_MATCH_THRESHOLD = 0.6
+
+# Partitions of the index (0: a single one, exhaustive search) and
+# partitions searched per wanted face. Only used when the index is
+# created. The centroids of the partitions are built by k-means
+# (C_FACE_INDEX_KMEANS_PASSES passes) once C_FACE_INDEX_TRAIN_FACES
+# faces per partition are indexed; until then searches are exhaustive.
+C_FACE_INDEX_PARTITIONS = 32
+C_FACE_INDEX_PROBES = 3
+C_FACE_INDEX_TRAIN_FACES = 16
+C_FACE_INDEX_KMEANS_PASSES = 5
+
+# Artifacts per batch added to the case (indexed and announced with a
+# single ModuleDataEvent)
+C_BLACKBOARD_BATCH_SIZE = 500
+
+# Descriptors per memory-mapped window when searching the index
+C_FACE_INDEX_CHUNK = 4096
+
+# Matches of the wanted faces in the index (every case) and files of
+# the data source to tag
+C_INDEX_MATCHES_FNAME = "FDRI_index_matches.txt"
+C_INDEX_WANTED_FNAME = "FDRI_index_wanted.txt"
+
 # Label for an annotated file
 C_ANNOTATED_LABEL="Annotated_"
 
 # Represent annotated when pathname is being built
 C_ANNOTATED_DIR="annotated" 
 
+# Only the annotated images that become derived files go to the case's
+# Temp folder (as Autopsy requires): hard linked to the output of
+# FDRI.exe, or moved (False, or if the volumes differ)
+C_LINK_ANNOTATED = True
+
 # name of FDRI included in path
 C_FDRI_DIR="FDRI"
 
 # Label for GUI configuration
 C_LABEL_INFO_AUTOPSY_TEMP = "Save copied images outside of Autopsy's /Temp"
 
+# Default values of the case level flags (UISettings)
+#                  JPG   JPEG  PNG   Hash  Dedupe
+C_DEFAULT_FLAGS = [True, True, True, True, False]
+
+# Number of threads copying the images into img/ (and hashing them)
+C_EXTRACT_WORKERS = 4
+
+# Files that exist as local files (logical files, derived files) are
+# hard linked into img/ instead of copied (if on the same volume)
+C_LINK_LOCAL_FILES = True
+
+# Maximum number of files waiting to be copied by the workers
+C_EXTRACT_QUEUE_SIZE = 64
+
+# Keep only the ids of the enumerated files and fetch the AbstractFiles
+# from the case DB when reading FDRI.exe's results (saves memory)
+C_LAZY_FILE_LOOKUP = True
+
+# Files per case DB query when enumerating the data source
+C_ENUM_PAGE_SIZE = 1000
+
+# Number of ids per case DB query when resolving results in lazy mode
+C_RESOLVE_CHUNK_SIZE = 500
+
+# Images per call of FDRI.exe. With shards, copy, detection and posting
+# of results overlap; 0 processes all the images in a single call
+C_SHARD_SIZE = 0
+
+# Shard's sub-directory (of img/ and of the run's workspace)
+C_SHARD_DIR_FMT = "shard_%04d"
+
+# GPU memory (in MB) of the machine running FDRI.exe, unless set in the
+# global settings. With 0 (unknown) the images are not bucketed: a
+# single FDRI.exe call (per shard) takes images of every size.
+C_GPU_MEMORY_MB = 0
+
+# Largest image (in pixels) handled by each amount of GPU memory (MB)
+#   2GB of GPU memory handle around 2000*2000 images
+#   4GB of GPU memory handle around 3500*3500 images
+#   8GB of GPU memory handle around 6000*6000 images
+C_GPU_MAX_PIXELS = ((2048, 2000*2000), (4096, 3500*3500), (8192, 6000*6000))
+
+# Upper bounds (in pixels) of the resolution buckets. Each bucket is
+# processed by its own FDRI.exe calls (--min/--max), with a batch size
+# that fits the GPU memory. Images larger than the GPU can handle go to
+# a last bucket, one image per batch.
+C_RESOLUTION_BUCKETS = (640*480, 1200*1200, 2000*2000, 3500*3500, 6000*6000)
+
+# Maximum number of images per batch (params.json's "batch_size")
+C_GPU_MAX_BATCH_SIZE = 16
+
 # Create DFXML (internal use in this script)
 C_CREATE_DFXML = True
 
 # Compute hashes for DFXML
 C_COMPUTE_HASHES = True
 
+# Per-file log messages are summarized: at most every C_LOG_SUMMARY_SECS
+# seconds, with up to C_LOG_SUMMARY_EXAMPLES filenames
+C_LOG_SUMMARY_SECS = 30
+C_LOG_SUMMARY_EXAMPLES = 5
+
+# Metrics of the run (see RunMetrics), written to the run's workspace:
+# stages, throughput histograms, queues and FDRI.exe exit codes (JSON)
+# and one row per file (CSV, opt-in: the rows are kept in memory until
+# the end of the run)
+C_METRICS = True
+C_METRICS_FILES = False
+C_METRICS_FNAME = "FDRI_metrics.json"
+C_METRICS_FILES_FNAME = "FDRI_metrics_files.csv"
+
+# The time of each stage (and the slowest one) in the ingest message
+C_METRICS_IN_MESSAGE = False
+
+# Maximum delay (seconds) to notice that the user cancelled the job
+# (Autopsy can only be polled); the end of FDRI.exe is noticed at once
+C_CANCEL_CHECK_SECS = 0.5
+
+# Seconds given to FDRI.exe to exit after being asked to, before it
+# (and its children) are killed
+C_EXE_KILL_GRACE_SECS = 5
+
+# Progress of FDRI.exe: it appends a JSON object per line to the file
+# given as "progress_out" in params.json (see ProgressStream), and the
+# module reads it while FDRI.exe runs. The progress bar shows the images
+# done, the throughput (over the last C_PROGRESS_RATE_SECS) and the ETA,
+# updated at most every C_PROGRESS_UPDATE_SECS.
+C_PROGRESS_FNAME = "FDRI_progress.jsonl"
+C_PROGRESS_UPDATE_SECS = 2
+C_PROGRESS_RATE_SECS = 60
+
+# Watchdog: an image on which FDRI.exe makes no progress for
+# C_STALL_WARN_SECS is logged and listed in C_STALLED_FNAME. After
+# C_STALL_KILL_SECS FDRI.exe is killed, the image is put aside (in
+# C_STALLED_DIR, recorded as stalled in the manifest and tagged in the
+# case) and the shard is run again without it (0: never killed). A
+# stalled image is retried by the next runs until it has stalled
+# C_STALL_MAX_TRIES times. Until the first progress event (models being
+# loaded) FDRI.exe is only killed after C_STALL_START_SECS.
+C_STALL_WARN_SECS = 120
+C_STALL_KILL_SECS = 900
+C_STALL_START_SECS = 1800
+C_STALL_MAX_TRIES = 2
+C_STALLED_FNAME = "FDRI_stalled.txt"
+C_STALLED_DIR = "stalled"
+
+# Resident detector: FDRI.exe started once as a service (--serve), with
+# the models loaded and CUDA initialised, and reused by every job (and
+# every data source). If the service can't be started, FDRI.exe is run
+# once per shard, as usual.
+C_DETECTOR_SERVICE = False
+C_DETECTOR_SERVICE_HOST = "127.0.0.1"
+C_DETECTOR_SERVICE_PORT = 47810
+
+# Seconds to wait for a new service to answer (models are loaded first)
+C_DETECTOR_SERVICE_START_SECS = 60
+
+# The service exits after this many seconds without work
+C_DETECTOR_SERVICE_IDLE_SECS = 900
+
+# Detector backend:
+#   "fdri"     FDRI.exe (CNN) over every image
+#   "cascade"  a CPU pre-pass first; only the images scoring at least
+#              C_PREPASS_THRESHOLD go to FDRI.exe
+#   "prepass"  the CPU pre-pass only (no GPU): images scoring at least
+#              C_PREPASS_THRESHOLD are tagged as "Possible faces"
+# The pre-pass is the Haar frontal face detector of OpenCV (its Java
+# binding ships with Autopsy). Without OpenCV, or without the cascade
+# file, FDRI.exe is used alone.
+C_DETECTOR_BACKEND = "fdri"
+
+# Haar cascade of the pre-pass, in the folder of this module (from
+# https://github.com/opencv/opencv/tree/master/data/haarcascades)
+C_PREPASS_CASCADE_FNAME = "haarcascade_frontalface_default.xml"
+
+# Pre-pass score: neighbours of the best face found (overlapping raw
+# detections, as minNeighbors of OpenCV's detectMultiScale)
+C_PREPASS_THRESHOLD = 3
+
+# Size (pixels, longest side) of the image scanned by the pre-pass.
+# Faces smaller than the 24x24 window of the cascade at this size are
+# missed.
+C_PREPASS_DETECT_SIDE = 640
+
+# Calibration of the cascade: every image goes to FDRI.exe, and the
+# images that each threshold would have skipped are compared with its
+# results (see C_PREPASS_REPORT_FNAME). benchmark/calibrate_prepass.py
+# does the same over folders of images, without FDRI.exe.
+C_PREPASS_CALIBRATE = False
+C_PREPASS_REPORT_THRESHOLDS = (1, 2, 3, 4, 5, 6, 8, 10)
+
+# Name of file with the images tagged by the pre-pass ("prepass")
+C_PREPASS_FOUND_FNAME = "FDRI_prepass_found.txt"
+
+# Name of file with the accuracy/throughput report of the pre-pass
+C_PREPASS_REPORT_FNAME = "FDRI_prepass_report.txt"
+
 # Row separator
 C_SEP_S = "#---------------------------------------------------------\n"
 
@@ -192,9 +494,26 @@ class FDRIModule(DataSourceIngestModule):
 
     _logger = Logger.getLogger(FDRIModuleFactory.moduleName)
 
-    def log(self, level, msg):
+    #--------------------------------------------------------------------
+    # The level is checked first, so nothing is formatted (msg % args)
+    # for discarded messages. The caller's name comes from its frame
+    # (inspect.stack() builds the whole stack, with source lines).
+    #--------------------------------------------------------------------
+    def log(self, level, msg, *args):
+        if not self._logger.isLoggable(level):
+            return
+        if args:
+            msg = msg % args
         self._logger.logp(level, self.__class__.__name__,
-                          inspect.stack()[1][3], msg)
+                          sys._getframe(1).f_code.co_name, msg)
+
+    # Same, on behalf of the given method (see LogSummary)
+    def log_as(self, method_S, level, msg, *args):
+        if not self._logger.isLoggable(level):
+            return
+        if args:
+            msg = msg % args
+        self._logger.logp(level, self.__class__.__name__, method_S, msg)
 
     def __init__(self, settings):
         self.context = None
@@ -202,21 +521,28 @@ class FDRIModule(DataSourceIngestModule):
         self.extensions = []
         self.deleteAfter = False
         self.doRecognition = True
+        self.dedupe = False
+        # Return code of the last FDRI.exe run (None: didn't end)
+        self.exe_return_code = None
+        # Client of the resident FDRI.exe (None: one run per shard)
+        self.detector_service = None
+        # Progress bar of the job (see ProgressMonitor)
+        self.progress = None
+        # Metrics of the run (None: not recorded)
+        self.metrics = None
         self.userPaths = {
             "0": "", 
             "1": "", 
             "2": ""
         }
+        self.gpu_memory_mb = C_GPU_MEMORY_MB
 
         # True to create the DFXML file
         self.createDFXML    = C_CREATE_DFXML
 
-        # Time acumulators to determine the 
-        # cumulative time needed to compute
-        # MD5, SHA1 and SHA256
-        self.needed_time_MD5    = 0.0
-        self.needed_time_SHA1   = 0.0
-        self.needed_time_SHA256 = 0.0
+        # Hashing engine (MD5, SHA1 and SHA256 in a single read).
+        # A new one (with an empty cache) is created for each run
+        self.hasher = FileHasher()
 
         #CONFIGURATION_PATH = Case.getCurrentCase().getModuleDirectory() + "\\FDRI.json"
         
@@ -259,6 +585,10 @@ class FDRIModule(DataSourceIngestModule):
         else:
             self.generate_hash = False
 
+        # self.dedupe: only one copy of identical images (same MD5) is
+        # processed by FDRI.exe; its results are given to all the copies
+        self.dedupe = bool(self.localSettings.getFlag(4))
+
         #
         # Checking for default detectors and auxiliary files
         #
@@ -280,6 +610,8 @@ class FDRIModule(DataSourceIngestModule):
                 content = json.load(out)
                 save_file = content['save_files']
                 self.userPaths = content['paths']
+                self.gpu_memory_mb = content.get('gpu_memory_mb',
+                                                        C_GPU_MEMORY_MB)
 
         for code in self.userPaths:
             if not self.userPaths[code]:
@@ -290,7 +622,8 @@ class FDRIModule(DataSourceIngestModule):
         #self.log(Level.INFO, GLOBAL_CONFIGURATION_PATH)
         with open(GLOBAL_CONFIGURATION_PATH, "w") as out:
             json.dump({"save_files": save_file,
-                       "paths": self.userPaths}, out)
+                       "paths": self.userPaths,
+                       "gpu_memory_mb": self.gpu_memory_mb}, out)
 
             folder_positive_photos = self.localSettings.getPath("1")
 
@@ -348,27 +681,37 @@ class FDRIModule(DataSourceIngestModule):
 
         # we don't know how much work there is yet
         progressBar.switchToIndeterminate()
+        # Determinate (images detected) once all the images are copied
+        self.progress = ProgressMonitor(progressBar, C_PROGRESS_UPDATE_SECS,
+                                                    C_PROGRESS_RATE_SECS)
 
         # Start timer for file copy operation
         start_copy_time = time.time()
 
-        # case insensitive SQL LIKE clause is used to query the case database
-        # FileManager API: http://sleuthkit.org/autopsy/docs/api-docs/4.4.1/classorg_1_1sleuthkit_1_1autopsy_1_1casemodule_1_1services_1_1_file_manager.html
-        fileManager = Case.getCurrentCase().getServices().getFileManager()
+        # Timings and byte counts of the stages (None: not recorded)
+        if C_METRICS:
+            self.metrics = RunMetrics(C_METRICS_FILES)
+        else:
+            self.metrics = None
 
-        files = []
-        for extension in self.extensions:
-            try:
-                files.extend(fileManager.findFiles(
-                    dataSource, "%" + extension))
-            except TskCoreException:
-                self.log(Level.INFO, "Error getting files from: '" +
-                         extension + "'")
+        # Per-run hash cache, keyed by the file's object id
+        self.hasher = FileHasher(metrics=self.metrics)
 
-        numFiles = len(files)
-        if not numFiles:
+        # Image files of the data source (selected on the case DB), read
+        # a page at a time while they are copied
+        files = self.enumerate_files(dataSource)
+        first_file = next(files, None)
+        if first_file is None:
             self.log(Level.WARNING, "Didn't find any usable files!")
             return IngestModule.ProcessResult.OK
+        files = itertools.chain([first_file], files)
+
+        # Index id -> AbstractFile, used to map the results of FDRI.exe
+        # back to Autopsy's files. In lazy mode only the ids are kept and
+        # the files are fetched from the case DB when results are read.
+        # Files are added as they are enumerated.
+        file_index = FileIdIndex(Case.getCurrentCase().getSleuthkitCase(),
+                                                        C_LAZY_FILE_LOOKUP)
 
         # Check if the user pressed cancel while we were busy
         if self.context.isJobCancelled():
@@ -394,13 +737,106 @@ class FDRIModule(DataSourceIngestModule):
 
         # We always copy the files (except if a copy already exists)
         # as we will want to change them.
-        # We detect the existence of a previous copy if the creation of the dir
-        # 'module_dir' triggers an exception
+        # Previous runs over this data source are recorded in the manifest:
+        # only new or changed files (or files whose processing didn't end)
+        # are copied and processed again
         try:
             os.mkdir(module_dir)
         except:
             self.log(Level.INFO, "Directory already exists for this module")
 
+        # Descriptors of the wanted faces computed by previous jobs
+        self.wanted_cache = None
+        if self.doRecognition:
+            self.wanted_cache = WantedFacesCache(os.path.join(
+                    os.path.dirname(GLOBAL_CONFIGURATION_PATH),
+                    C_WANTED_CACHE_FNAME), [self.userPaths[code]
+                                    for code in sorted(self.userPaths)])
+            folder_positive_photos = self.localSettings.getPath("1")
+            cached_count = self.wanted_cache.scan(folder_positive_photos,
+                                                        self.extensions)
+            Log_S = "Wanted faces cache: %d of %d reference images cached" %\
+                    (cached_count, len(self.wanted_cache.gallery_D))
+            self.log(Level.INFO, Log_S)
+
+        # Face descriptors of all the processed images
+        self.face_index = None
+        if C_FACE_INDEX:
+            try:
+                self.face_index = FaceIndex(os.path.join(
+                    os.path.dirname(GLOBAL_CONFIGURATION_PATH),
+                    C_FACE_INDEX_DIR), C_FACE_DESCRIPTOR_DIM,
+                    C_FACE_INDEX_PARTITIONS, C_FACE_INDEX_TRAIN_FACES,
+                    C_FACE_INDEX_KMEANS_PASSES)
+            except (IOError, OSError), e:
+                self.log(Level.WARNING, "Face index disabled: " + str(e))
+
+        # Detector backend (FDRI.exe, or a CPU pre-pass first)
+        self.detector_backend = self.new_detector_backend(C_DETECTOR_BACKEND,
+                                os.path.join(module_dir,C_IMG_DONE_DIR))
+        self.log(Level.INFO, "Detector backend: %s" %\
+                                                (self.detector_backend.name))
+
+        manifest = IngestManifest(os.path.join(module_dir,C_MANIFEST_FNAME),
+                                self.settings_digest(), C_STALL_MAX_TRIES)
+        Log_S = "Manifest: %d files recorded by previous runs" %\
+                                                            (len(manifest))
+        self.log(Level.INFO, Log_S)
+
+        # Resident FDRI.exe: reused if already running, started otherwise
+        self.detector_service = None
+        if C_DETECTOR_SERVICE:
+            service = DetectorService(C_DETECTOR_SERVICE_HOST,
+                                        C_DETECTOR_SERVICE_PORT, self.log)
+            if service.ensure_started(self.pathToExe,
+                                                C_DETECTOR_SERVICE_START_SECS,
+                                                C_DETECTOR_SERVICE_IDLE_SECS):
+                self.detector_service = service
+
+        # Location where the output of executable will appear
+        # (with shards, each shard has its own sub-directory)
+        timestamp = datetime.now().strftime('%Y-%m-%d_%Hh%Mm%Ss')
+        workspace = os.path.join(module_dir,timestamp)
+        os.mkdir(workspace)
+
+        #----------------------------------------
+        # State shared with the detector and
+        # poster threads
+        #----------------------------------------
+        self.dataSource = dataSource
+        self.file_index = file_index
+        self.manifest = manifest
+        self.workspace = workspace
+        self.temp_dir = temp_dir
+        self.dir_img_done = os.path.join(module_dir,C_IMG_DONE_DIR)
+        self.dir_img = os.path.join(module_dir,"img")
+        self.dir_stalled = os.path.join(module_dir,C_STALLED_DIR)
+        # Shards created by the recovery from CUDA out of memory
+        self.oom_shards_count = 0
+        # Images put aside by the watchdog (see recover_stall)
+        self.stalled_count = 0
+        # Results of a representative file are also given to its duplicates
+        self.duplicates_D = {}
+        # Representatives already posted and the duplicates that got
+        # their results (duplicates found later get them at the end)
+        self.posted_reps_L = []
+        self.fanned_out_S = set()
+        self.posted_shards_L = []
+        # Artifacts and derived files are added to the case in batches
+        self.bb_writer = BlackboardWriter(
+                Case.getCurrentCase().getSleuthkitCase(),
+                Case.getCurrentCase().getServices().getBlackboard(),
+                BlackboardArtifact.ARTIFACT_TYPE.TSK_INTERESTING_FILE_HIT,
+                dataSource.getId(), C_BLACKBOARD_BATCH_SIZE, self.log)
+        self.images_with_faces_count = 0
+        # Images tagged by the pre-pass alone ("prepass" backend)
+        self.possible_faces_count = 0
+        # Annotated images put in the Temp folder (see place_annotated)
+        self.placed_annotated_S = set()
+        self.annotated_linked_count = 0
+        self.annotated_moved_count = 0
+        self.detect_time_secs = 0.0
+        self.post_time_secs = 0.0
 
         #----------------------------------------
         # Init file which holds filenames + size 
@@ -423,82 +859,276 @@ class FDRIModule(DataSourceIngestModule):
         total_files = 0 
         total_small_files = 0
 
+        # Files to check for repetitions, in enumeration order (their
+        # MD5s are in the manifest)
+        hashed_files_path = os.path.join(module_dir, C_HASHED_FILES_FNAME)
+        hashed_files_F = open(hashed_files_path, "w")
+
+        # Copy errors: (sequence number, name, error), in enumeration order
+        copy_errors_L = []
+
+        # Small files of this run (ids) and files skipped because they
+        # were already processed by a previous run
+        small_ids_L = []
+        total_done_files = 0
+        # Files left out by the header check of previous runs
+        total_skipped_before = 0
+        total_stalled_before = 0
+
+        #----------------------------------------
+        # Pipeline. This thread copies the images,
+        # one shard at a time. The detector thread
+        # runs FDRI.exe over each copied shard and
+        # the poster thread adds its results to the
+        # case: copy of shard N+1, detection of
+        # shard N and posting of shard N-1 overlap.
+        # Without shards (C_SHARD_SIZE = 0) there
+        # is a single shard (img/ and workspace).
+        #----------------------------------------
+        shards_L = []
+        # Images are bucketed by resolution (pixels, from their header)
+        # when the GPU memory is known: each bucket has its own shards
+        self.buckets = ResolutionBuckets(self.gpu_memory_mb,
+                        C_GPU_MAX_PIXELS, C_RESOLUTION_BUCKETS,
+                        C_GPU_MAX_BATCH_SIZE)
+        if self.buckets.enabled:
+            Log_S = "GPU memory: %d MB, images up to %d pixels; buckets: %s"\
+                    % (self.gpu_memory_mb, self.buckets.max_pixels,
+                    ", ".join([str(bucket) for bucket in self.buckets.buckets_L]))
+            self.log(Level.INFO, Log_S)
+        self.sharded = C_SHARD_SIZE > 0 or self.buckets.enabled
+        # bucket -> shard being filled
+        open_shards_D = {}
+        detect_queue = Queue(1)
+        post_queue = Queue(1)
+        detector_thread = Thread(
+            target=lambda: self.detect_stage(detect_queue, post_queue))
+        poster_thread = Thread(target=lambda: self.post_stage(post_queue))
+        detector_thread.start()
+        poster_thread.start()
+
         # A initial version mispelled 'Annotated"...
         avoid_prefix_1 = "Anotated_"
         avoid_prefix_2 = "Annotated_"
+
+        # Files skipped are logged in periodic summaries (one by one
+        # only at FINE level)
+        annotated_summary = LogSummary(self.log_as,
+                                    "Annotated_ files found: skipping")
+        small_files_summary = LogSummary(self.log_as,
+                "Skipping files (size < %d bytes)" % (C_FILE_MIN_SIZE))
+        sniffed_summary = LogSummary(self.log_as,
+                                "Skipping files (header check)")
+
+        # Reads the header of the images: dimensions and validity
+        sniffer = ImageHeaderSniffer(C_IMAGE_MIN_WIDTH, C_IMAGE_MIN_HEIGHT,
+                                    C_SNIFF_CHUNK_SIZE, C_SNIFF_MAX_OFFSET)
         try:
+            # img/ only holds the files still waiting for FDRI.exe
             dir_img = os.path.join(module_dir,"img") 
-            os.mkdir(dir_img)
+            if not os.path.exists(dir_img):
+                os.mkdir(dir_img)
             
             dir_small_files = os.path.join(module_dir,"small_files") + "\\"
-            os.mkdir(dir_small_files)
-
-            for file in files:
-                total_files = total_files + 1
-
-                filename_S = file.getName()
-                Log_S = ""
-                if filename_S.find(avoid_prefix_1) is 0:
-                    Log_S = "%s file found '%s': skipping" %\
-                                    (avoid_prefix_1,filename_S)
-                elif filename_S.find(avoid_prefix_2) is 0:
-                    Log_S = "%s file found '%s': skipping" %\
-                                    (avoid_prefix_2,filename_S)
-                if len(Log_S):
-                    # Annotated_ found
-                    # Log and skip this file
-                    self.log(Level.INFO, Log_S)
-                    continue
+            if not os.path.exists(dir_small_files):
+                os.mkdir(dir_small_files)
+
+            # Files are written (and hashed) by a pool of workers; the
+            # log records are written here, in enumeration order
+            extraction_pool = ExtractionPool(self.hasher,
+                            C_EXTRACT_WORKERS, C_EXTRACT_QUEUE_SIZE, manifest,
+                            C_LINK_LOCAL_FILES, self.metrics)
+            if self.dedupe:
+                self.duplicates_D = extraction_pool.duplicates_D
+            try:
+                for file in files:
+                    total_files = total_files + 1
+                    file_index.add(file)
+
+                    # Check if the user pressed cancel while we were busy
+                    if self.context.isJobCancelled():
+                        break
+
+                    filename_S = file.getName()
+                    if filename_S.startswith(avoid_prefix_1) or\
+                                    filename_S.startswith(avoid_prefix_2):
+                        # Annotated_ found
+                        # Log and skip this file
+                        annotated_summary.add(filename_S)
+                        continue
 
-                file_size = file.getSize()
-                filename, file_extension = os.path.splitext(file.getName())
-                # Record filename and file size in C_FILE_WITH_FNAMES_AND_SIZES
-                fnames_and_sizes_F.write("%s:%d\n" %(file.getName(),file_size))
-
-                # If file size is more than C_FILE_MIN_SIZE
-                # TODO:: User Choice as option
-                if file_size >= C_FILE_MIN_SIZE:
-                    new_fname = "%s__id__%s%s" %\
-                            (filename,str(file.getId()),file_extension)
-                    fullpath_dest = os.path.join(dir_img,new_fname)
-                    ContentUtils.writeToFile(file, File(fullpath_dest))
-
-
-                # We copy small files to a different DIR, so that we
-                # can look at them, if needed
-                if file_size < C_FILE_MIN_SIZE:
-                    total_small_files = total_small_files + 1
-
-                    dest_filename = "%s%s__id__%d%s" %\
-                      (dir_small_files,filename,file.getId(),file_extension)
-                    ContentUtils.writeToFile(file, File(dest_filename))
-
-                    Log_S = "Skipping file: %s (%d bytes)" %\
-                                        (file.getName(),file.getSize())
-                    # LOG
-                    self.log(Level.INFO, Log_S)
-
-                #--------------------------------
-                # Code to detect repeated files
-                # We simply use a dictionary 
-                # keyed by the MD5 of the file
-                # Patricio
-                #--------------------------------
-                if file_size > 0:
-                    md5_hash = self.create_hash(file, "md5")
-                    if md5_hash in files_hash_D:
-                        # hash already exists: repetition
-                        files_hash_D[md5_hash].append(file.getName())
+                    file_size = file.getSize()
+
+                    # Already processed by a previous run?
+                    state_S = manifest.check(file)
+                    if state_S == IngestManifest.DONE:
+                        total_done_files = total_done_files + 1
+                        fnames_and_sizes_F.write("%s:%d\n" %\
+                                                (file.getName(),file_size))
+                        continue
+                    # Left out by the header check of a previous run:
+                    # its header is not read again
+                    if state_S == IngestManifest.SKIPPED:
+                        total_skipped_before = total_skipped_before + 1
+                        fnames_and_sizes_F.write("%s:%d # skipped: %s\n"\
+                                % (file.getName(),file_size,
+                                manifest.skip_reason(file.getId())))
+                        continue
+                    # Stalled FDRI.exe C_STALL_MAX_TRIES times: left in
+                    # C_STALLED_DIR, for a manual review
+                    if state_S == IngestManifest.STALLED:
+                        total_stalled_before = total_stalled_before + 1
+                        fnames_and_sizes_F.write("%s:%d # stalled\n" %\
+                                                (file.getName(),file_size))
+                        continue
+
+                    # Junk (not an image, too small) is not copied. The
+                    # reason is recorded with the filename and size.
+                    pixels = None
+                    if C_SNIFF_HEADERS and file_size >= C_FILE_MIN_SIZE:
+                        sniff_start_time = time.time()
+                        skip_S, pixels = sniffer.check(file)
+                        if self.metrics is not None:
+                            self.metrics.record("header",
+                                        time.time() - sniff_start_time)
+                        if skip_S is not None:
+                            fnames_and_sizes_F.write("%s:%d # skipped: %s\n"\
+                                        % (file.getName(),file_size,skip_S))
+                            sniffed_summary.add("%s (%s)" % (file.getName(), skip_S))
+                            manifest.skip(file, skip_S)
+                            continue
+
+                    # Record filename and file size in C_FILE_WITH_FNAMES_AND_SIZES
+                    fnames_and_sizes_F.write("%s:%d\n" %(file.getName(),file_size))
+
+                    # If file size is more than C_FILE_MIN_SIZE
+                    # TODO:: User Choice as option
+                    if file_size >= C_FILE_MIN_SIZE:
+                        # Full shard: it goes to the detector thread as
+                        # soon as its files are copied
+                        bucket = self.buckets.find(pixels)
+                        shard = open_shards_D.get(bucket)
+                        if shard is None or (C_SHARD_SIZE > 0 and
+                                        shard.num_files >= C_SHARD_SIZE):
+                            if shard is not None:
+                                shard.seal()
+                                self.put_shard("detect", detect_queue, shard)
+                            shard = self.new_shard(len(shards_L), dir_img,
+                                                                    bucket)
+                            shards_L.append(shard)
+                            open_shards_D[bucket] = shard
+                        job_shard = shard
+
+                        new_fname = self.copy_fname(file)
+                        fullpath_dest = os.path.join(shard.dir_img,new_fname)
+
+                    # We copy small files to a different DIR, so that we
+                    # can look at them, if needed
+                    if file_size < C_FILE_MIN_SIZE:
+                        total_small_files = total_small_files + 1
+                        small_ids_L.append(file.getId())
+                        job_shard = None
+
+                        fullpath_dest = "%s%s" %\
+                                    (dir_small_files,self.copy_fname(file))
+
+                        # LOG
+                        small_files_summary.add(file.getName(), file_size)
+
+                    # A copy left by a previous run (that didn't end)
+                    # is reused
+                    if state_S == IngestManifest.EXTRACTED:
+                        reuse_path = manifest.copy_path(file.getId())
                     else:
-                        # hash doesn't yet exist in dictionary: 1st time
-                        files_hash_D[md5_hash] = [file_size,file.getName()]
-                        
+                        reuse_path = None
+
+                    # Digests are computed by the worker, right after
+                    # the copy (empty files are not hashed)
+                    # With dedupe, only one file per MD5 goes to FDRI.exe.
+                    extraction_pool.submit(total_files, file,
+                            fullpath_dest, file_size > 0,
+                            self.dedupe and file_size >= C_FILE_MIN_SIZE,
+                            reuse_path, job_shard)
+                    if file_size > 0:
+                        hashed_files_F.write(json.dumps([file.getId(),
+                                        file.getName(), file_size]) + "\n")
+            finally:
+                hashed_files_F.close()
+                annotated_summary.log_summary()
+                small_files_summary.log_summary()
+                sniffed_summary.log_summary()
+                # Last shards (smaller images first)
+                for shard in sorted(open_shards_D.values(),
+                                            key=lambda shard: shard.index):
+                    shard.seal()
+                    self.put_shard("detect", detect_queue, shard)
+                copy_errors_L = extraction_pool.close()
+
+            # Shard dirs of previous runs (their copies were moved)
+            run_dirs_L = [shard.dir_img for shard in shards_L]
+            for dir_S in os.listdir(dir_img):
+                shard_dir_img = os.path.join(dir_img, dir_S)
+                if shard_dir_img in run_dirs_L:
+                    continue
+                if os.path.isdir(shard_dir_img) and\
+                                            not os.listdir(shard_dir_img):
+                    os.rmdir(shard_dir_img)
+
+            #--------------------------------
+            # Code to detect repeated files
+            # We simply use a dictionary 
+            # keyed by the MD5 of the file
+            # Patricio
+            # The MD5s come from the manifest;
+            # a first pass counts the files of
+            # each MD5, so that only the
+            # repeated ones are kept
+            #--------------------------------
+            # md5 -> number of files
+            md5_counts_D = {}
+            for pass_num in (1, 2):
+                with open(hashed_files_path, "r") as hashed_files_F:
+                    for line in hashed_files_F:
+                        file_id, name_S, file_size = json.loads(line)
+                        md5_hash = manifest.md5(file_id)
+                        if md5_hash is None:
+                            # Hashing failed (see copy errors)
+                            continue
+                        if pass_num == 1:
+                            md5_counts_D[md5_hash] =\
+                                            md5_counts_D.get(md5_hash, 0) + 1
+                        elif md5_counts_D[md5_hash] < 2:
+                            continue
+                        elif md5_hash in files_hash_D:
+                            # hash already exists: repetition
+                            files_hash_D[md5_hash].append(name_S)
+                        else:
+                            # 1st file of a repeated hash
+                            files_hash_D[md5_hash] = [file_size,name_S]
+            md5_counts_D = None
+            os.remove(hashed_files_path)
+
         ##except:
         except Exception, e:            
             were_files_copied = False
-            self.log(Level.INFO,"Image folder already exists, skiping file copy")
-            self.log(Level.INFO,"Exception: " + str(e))
+            self.log(Level.SEVERE,"Error copying files")
+            self.log(Level.SEVERE,"Exception: " + str(e))
+
+        # No more shards
+        detect_queue.put(None)
 
+        # All the images to detect are known
+        self.progress.set_total(sum([len(shard.copied_ids_L)
+                                                for shard in shards_L]))
+
+        # Log the copy errors (the order is deterministic)
+        for seq_num, name_S, error_S in copy_errors_L:
+            Err_S = "Error copying '%s': %s" % (name_S, error_S)
+            self.log(Level.SEVERE, Err_S)
+            fnames_and_sizes_F.write("# ERROR: %s:%s\n" % (name_S, error_S))
+
+        if self.context.isJobCancelled():
+            fnames_and_sizes_F.write("# Cancelled by the user\n")
 
         #----------------------------------------
         # Close filename+size file
@@ -548,264 +1178,198 @@ class FDRIModule(DataSourceIngestModule):
         Log_S = "%d image files (%d of these were left out -- size <= "\
                 "%d bytes)" % (total_files, total_small_files,C_FILE_MIN_SIZE)
         self.log(Level.INFO, Log_S)
-        total_copied_files = total_files - total_small_files
-        Log_S = "Files copy operation (%d files) took %f secs" %\
-                (total_copied_files,elapsed_copy_time_secs)
+        if C_SNIFF_HEADERS:
+            reasons_S = ", ".join(["%s: %d" % (reason_S, count)
+                    for reason_S, count in sorted(sniffer.skipped_D.items())])
+            Log_S = "Header check: %d files skipped (%s), %d headers read "\
+                    "(%d bytes) in %f secs" % (sniffer.skipped_count,
+                    reasons_S or "none", sniffer.files_count,
+                    sniffer.bytes_read, sniffer.needed_time)
+            self.log(Level.INFO, Log_S)
+        total_copied_files = total_files - total_small_files -\
+                            sniffer.skipped_count - total_skipped_before -\
+                            total_stalled_before
+        Log_S = "Files copy operation (%d files, %d errors, %d workers, "\
+                "%d shards) took %f secs" % (total_copied_files,
+                len(copy_errors_L), C_EXTRACT_WORKERS, len(shards_L),
+                elapsed_copy_time_secs)
+        self.log(Level.INFO, Log_S)
+        if self.metrics is not None:
+            self.metrics.record("enumerate", self.enum_stats_D["secs"],
+                                        items=self.enum_stats_D["files"])
+            self.metrics.add_wall("copy", elapsed_copy_time_secs)
+        if were_files_copied:
+            Log_S = "Input: %d files hard linked, %d copied" %\
+                (extraction_pool.linked_count, extraction_pool.copied_count)
+            self.log(Level.INFO, Log_S)
+        if self.dedupe and were_files_copied:
+            Log_S = "Dedupe: %d duplicate image files not copied "\
+                    "(results are given to them)" %\
+                    (extraction_pool.duplicates_count)
+            self.log(Level.INFO, Log_S)
+        Log_S = "Manifest: %d files already processed by previous runs, "\
+                "%d left out by their header check, %d left out after "\
+                "stalling FDRI.exe" % (total_done_files,
+                total_skipped_before, total_stalled_before)
         self.log(Level.INFO, Log_S)
+        if manifest.other_settings_count:
+            Log_S = "Manifest: %d files processed by previous runs with "\
+                    "other settings (models or detector) "\
+                    "processed again" % (manifest.other_settings_count)
+            self.log(Level.INFO, Log_S)
 
         #----------------------------------------
-        # Start processing timer
+        # Wait for the detection and the posting
+        # of the last shards
         #----------------------------------------
-        start_FDRIexe_time = time.time()
-
-        # Location where the output of executable will appear
-        timestamp = datetime.now().strftime('%Y-%m-%d_%Hh%Mm%Ss')
-        workspace = os.path.join(module_dir,timestamp)
-        configFilePath = os.path.join(workspace,C_PARAMS_JSON_FNAME)
-
-        os.mkdir(workspace)
-
-        with open(configFilePath, "w") as out:
-            json.dump({
-                "paths": self.userPaths,#self.localSettings.getAllPaths(),
-                "wanted_faces" : self.localSettings.getPath("1"),
-                "imagesPath": os.path.join(module_dir,"img"),
-                "doRecognition": self.doRecognition,
-                "workspace": workspace,
-            }, out)
-
-        #
-        # Different calls can also be provided to specify the image size
-        #
-        # Note that 2GB of GPU memory handle around 2000*2000 images
-        # Note that 4GB of GPU memory handle around 3500*3500 images
-        # Note that 8GB of GPU memory handle around 6000*6000 images
-        #
-        # Example:
-        #                                                   Required    Minimum size Maximum size
-        # target=lambda: self.thread_work(self.pathToExe, configFilePath, 1200*1200, 2000*2000))
-        # target=lambda: self.thread_work(self.pathToExe, configFilePath, 1200*1200))
-        executable_thread = Thread(
-            target=lambda: self.thread_work(self.pathToExe, configFilePath))
-        executable_thread.start()
-
-        while(executable_thread.isAlive()):
+        while(poster_thread.isAlive()):
+            # Returns as soon as the thread ends
+            poster_thread.join(C_CANCEL_CHECK_SECS)
             if self.context.isJobCancelled():
-                self.log(Level.INFO, "User cancelled job! Terminating thread")
-                JThread.interrupt(executable_thread)
-                self.log(Level.INFO, "Thread terminated")
-                self.deleteFiles(module_dir)
+                self.log(Level.INFO, "User cancelled job! Terminating FDRI.exe")
+                # The supervisor of FDRI.exe kills it (and its children);
+                # the stages end without starting other shards
+                detector_thread.join()
+                poster_thread.join()
+                self.log(Level.INFO, "FDRI.exe terminated")
+                # Only the output of the shards not yet posted is deleted:
+                # the copied files and the manifest are kept, so that a
+                # rerun resumes from here
+                for shard in shards_L:
+                    if shard not in self.posted_shards_L:
+                        self.deleteFiles(shard.workspace)
+                manifest.close()
+                self.write_metrics(workspace, "cancelled")
                 return IngestModule.ProcessResult.OK
-            time.sleep(1)
 
         # Checking if cancel was pressed before starting another job
         if self.context.isJobCancelled():
+            manifest.close()
+            self.write_metrics(workspace, "cancelled")
+            return IngestModule.ProcessResult.OK
+
+        # Small files are never processed by FDRI.exe
+        manifest.mark_done(small_ids_L)
+
+        if self.wanted_cache is not None:
+            try:
+                self.wanted_cache.save()
+            except (IOError, OSError), e:
+                self.log(Level.WARNING,
+                        "Wanted faces cache not saved: " + str(e))
+
+        # Wanted faces in the files processed by previous runs
+        index_wanted_count = 0
+        if self.face_index is not None and self.doRecognition and\
+                                                        total_done_files:
+            search_start_time = time.time()
+            try:
+                index_wanted_count = self.search_face_index()
+            except Exception, e:
+                self.log(Level.SEVERE, "Error searching the face index: " +\
+                                                                    str(e))
+            if self.metrics is not None:
+                self.metrics.record("index_search",
+                                            time.time() - search_start_time)
+
+        # Nothing new since the last run: FDRI.exe was not needed
+        # (the workspace only keeps the metrics of the run)
+        if not shards_L:
+            manifest.close()
+            self.write_metrics(workspace, "done")
+            if not os.listdir(workspace):
+                os.rmdir(workspace)
+            ingest_msg_S = "No new images to process "\
+                    "(%d already processed by previous runs, %d with "\
+                    "wanted faces)" % (total_done_files, index_wanted_count)
+            if total_stalled_before:
+                ingest_msg_S = ingest_msg_S + ". %d images left in '%s' "\
+                        "after stalling FDRI.exe" % (total_stalled_before,
+                        self.dir_stalled)
+            self.log(Level.INFO, ingest_msg_S)
+            message = IngestMessage.createMessage(
+                    IngestMessage.MessageType.DATA,
+                    FDRIModuleFactory.moduleName, ingest_msg_S)
+            IngestServices.getInstance().postMessage(message)
             return IngestModule.ProcessResult.OK
 
         #----------------------------------------
-        # Compute time takne by FDRI.exe
+        # Time taken by FDRI.exe and by the last
+        # stage (summed over the shards)
         #----------------------------------------
-        elapsed_FDRIexe_time_secs = time.time() - start_FDRIexe_time
+        elapsed_FDRIexe_time_secs = self.detect_time_secs
         Log_S = "Process of image files by FDRI.exe took %f secs" %\
                 (elapsed_FDRIexe_time_secs)
         self.log(Level.INFO, Log_S)
+        if self.detector_service is not None:
+            Log_S = "Detector service: %d batches, %d images with faces "\
+                    "streamed" % (self.detector_service.batches_count,
+                                        self.detector_service.images_count)
+            self.log(Level.INFO, Log_S)
+        self.detector_backend.report(workspace)
+        self.log(Level.INFO, "Detection: " + self.progress.summary())
 
-        #----------------------------------------
-        # Start timer of last stage
-        #----------------------------------------
         self.log(Level.INFO, "START of last stage")
         start_last_stage_time = time.time()
 
- 
-        # Use blackboard class to index blackboard artifacts for keyword search
-        blackboard = Case.getCurrentCase().getServices().getBlackboard()
-
-        # Tag files with faces
-        artifact_type = BlackboardArtifact.ARTIFACT_TYPE.TSK_INTERESTING_FILE_HIT
-
-        # Copy files from workspace to temp_dir
-        tree_source      = os.path.join(workspace, C_ANNOTATED_DIR)
-        tree_destination = os.path.join(temp_dir, C_ANNOTATED_DIR)
-        copy_tree(tree_source,tree_destination)
-
-        # Add images with the wanted faces to blackboard
-        outPositiveFile = os.path.join(workspace,C_FDRI_WANTED_FNAME)
-        if os.path.exists(outPositiveFile):
-            with open(outPositiveFile, "r") as out:
-                for line in out:
-                    file_id = line.split('__id__')[1].split('.')
-                    interestingFile = self.findByID(files, file_id[0])
-
-                    if interestingFile == None:
-                        continue
-
-                    # Creating new artifacts with faces found
-                    artifactList = interestingFile.getArtifacts(artifact_type)
-                    if artifactList:
-                        self.log(
-                            Level.INFO, "Artifact already exists! ignoring")
-                    else:
-                        art = interestingFile.newArtifact(artifact_type)
-                        att = BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_SET_NAME.getTypeID(),
-                                                  FDRIModuleFactory.moduleName, dataSource.getName() + "/Wanted faces")
-                        art.addAttribute(att)
-                        try:
-                            # index the artifact for keyword search
-                            blackboard.indexArtifact(art)
-                        except Blackboard.BlackboardException as e:
-                            self.log(
-                                Level.SEVERE, "Error indexing artifact " + art.getDisplayName())
-
-                        # Adding derivated files to case
-                        # These are files with borders on the found faces
-                        # Code to deal with filenames with multiple "."
-                        # Patricio, 2018.08.09
-                        interestingFName = interestingFile.getName()
-                        try:
-                            name, extension = self.split_fname(interestingFName)
-                        except Exception, e:
-                            Err_S = "Error in splitting name/extension of '%s' (skipping file)" % (interestingFName)
-                            self.log(Level.SEVERE,Err_S)
-                            self.log(Level.SEVERE,"Exception: " + str(e))
-                            continue
-
-                        # Still here? Good.
-                        f_path = "%s__id__%s.%s" %\
-                                (name,str(interestingFile.getId()),extension)
-
-                        # We need path relative to temp folder for Autopsy API
-                        f_temp_path = os.path.join("Temp",dataSource.getName(),
-                                C_FDRI_DIR, C_ANNOTATED_DIR, f_path)
-                        f_abs_path = os.path.join(workspace,
-                                            C_ANNOTATED_DIR, f_path)
-
-                        # Temporary fix
-                        if os.path.exists(f_abs_path):
-                            f_size = os.path.getsize(f_abs_path)
-                            case = Case.getCurrentCase().getSleuthkitCase()
-
-                            try:
-                                abstract_f = case.getAbstractFileById(
-                                    interestingFile.getId())
-
-                                # https://sleuthkit.org/autopsy/docs/api-docs/4.4/classorg_1_1sleuthkit_1_1autopsy_1_1casemodule_1_1services_1_1_file_manager.html
-                                label_S = C_ANNOTATED_LABEL + interestingFName
-                                case.addDerivedFile(label_S, f_temp_path, 
-                                       f_size, 0, 0, 0, 0, True, abstract_f,
-                                       "", FDRIModuleFactory.moduleName, 
-                                       FDRIModuleFactory.moduleVersion, 
-                                       "Image with faces",
-                                       TskData.EncodingType.NONE)
-                            except:
-                                self.log(Level.SEVERE,"Error getting abs file")
-
-                    if self.generate_hash:
-                        dfxml_path = os.path.join(workspace,C_DFXML_FNAME)
-                        self.complete_dfxml( dfxml_path, interestingFile)
-
-        # Name of file that holds the data regarding detected faces
-        # Each row corresponds to a detected face
-        outPositiveFile = os.path.join(workspace,C_FACES_FOUND_FNAME)
-        self.log(Level.INFO,"File with found faces from FDRI.exe:'%s'" %\
-                (outPositiveFile))
-
-        # Count the number of images where at least one face was detected
-        images_with_faces_count = 0
+        # Duplicates found after the shard of their representative was
+        # posted get its results now
+        self.post_late_duplicates()
 
-        if os.path.exists(outPositiveFile):
-            with open(outPositiveFile, "r") as out:
-                for line in out:
-                    # Another file with at least one face
-                    images_with_faces_count += 1
-                    file_id = line.split('__id__')[1].split('.')
-                    interestingFile = self.findByID(files, file_id[0])
-
-                    if interestingFile == None:
-                        continue
+        self.bb_writer.commit()
+        Log_S = "Blackboard: %d artifacts and %d derived files added "\
+                "(%d batches)" % (self.bb_writer.artifacts_count,
+                self.bb_writer.derived_count, self.bb_writer.batches_count)
+        self.log(Level.INFO, Log_S)
+        Log_S = "Annotated images: %d hard linked, %d moved to '%s'" %\
+                (self.annotated_linked_count, self.annotated_moved_count,
+                os.path.join(self.temp_dir, C_ANNOTATED_DIR))
+        self.log(Level.INFO, Log_S)
 
-                    # Creating new artifacts with faces found
-                    artifactList = interestingFile.getArtifacts(artifact_type)
-                    if artifactList:
-                        self.log(Level.INFO,"Artifact already exists! ignoring")
-                    else:
-                        art = interestingFile.newArtifact(artifact_type)
-                        att = BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_SET_NAME.getTypeID(),
-                                                  FDRIModuleFactory.moduleName, dataSource.getName() + "/Images with faces")
-                        art.addAttribute(att)
-                        try:
-                            # index the artifact for keyword search
-                            blackboard.indexArtifact(art)
-                        except Blackboard.BlackboardException as e:
-                            self.log(Level.SEVERE, 
-                             "Error indexing artifact " + art.getDisplayName())
-
-                        # Adding derivated files to case
-                        # These are files with borders on the found faces
-
-                        # Code to deal with filenames with multiple "."
-                        # Patricio, 2018.08.09
-                        interestingFName = interestingFile.getName()
-                        try:
-                            name, extension = self.split_fname(interestingFName)
-                        except Exception, e:
-                            Err_S = "Error in splitting name/extension of '%s' (skipping file)" % (interestingFName)
-                            self.log(Level.SEVERE,Err_S)
-                            self.log(Level.SEVERE,"Exception: " + str(e))
-                            continue
+        # Merge the results of the shards (or of the shards of the
+        # recovery from out of GPU memory)
+        merge_shards_L = [shard for shard in self.posted_shards_L
+                                    if shard.workspace != self.workspace]
+        if merge_shards_L:
+            self.merge_shards_results(sorted(merge_shards_L,
+                                key=lambda shard: (shard.index, shard.dir_img)))
 
-                        # Still here? Good.
-                        f_path = "%s__id__%s.%s" %\
-                                (name,str(interestingFile.getId()),extension)
-
-                        # We need path relative to temp folder since the 
-                        # Autopsy's API requires files in the case's 
-                        # TEMP folder
-                        f_temp_path = os.path.join("Temp",dataSource.getName(),
-                                C_FDRI_DIR, C_ANNOTATED_DIR, f_path)
-                        f_abs_path = os.path.join(workspace, 
-                                        C_ANNOTATED_DIR, f_path)
-
-                        # Temporary fix
-                        if os.path.exists(f_abs_path):
-                            f_size = os.path.getsize(f_abs_path)
-                            case = Case.getCurrentCase().getSleuthkitCase()
-
-                            try:
-                                abstract_f = case.getAbstractFileById(
-                                                    interestingFile.getId())
-
-                                # https://sleuthkit.org/autopsy/docs/api-docs/4.4/classorg_1_1sleuthkit_1_1autopsy_1_1casemodule_1_1services_1_1_file_manager.html
-                                label_S = C_ANNOTATED_LABEL + interestingFName
-                                case.addDerivedFile(label_S, f_temp_path, 
-                                        f_size, 0, 0, 0, 0, True, abstract_f, 
-                                        "", FDRIModuleFactory.moduleName, 
-                                        FDRIModuleFactory.moduleVersion, 
-                                        "Image with faces",
-                                        TskData.EncodingType.NONE)
-                            except:
-                                self.log(Level.SEVERE,
-                                         "Error getting abs file")
-                    if self.generate_hash:
-                        dfxml_path = workspace + "\\" + C_DFXML_FNAME
-                        self.complete_dfxml(dfxml_path, interestingFile)
+        # Add the descriptors of this run to the face index
+        if self.face_index is not None:
+            try:
+                self.index_faces()
+            except Exception, e:
+                self.log(Level.SEVERE, "Error updating the face index: " +\
+                                                                    str(e))
 
-        #----------------------------------------
-        # End timer of last stage
-        #----------------------------------------
-        last_stage_time = time.time() - start_last_stage_time
+        last_stage_time = time.time() - start_last_stage_time +\
+                                                    self.post_time_secs
         Log_S = "Last stage took %f secs" % (last_stage_time)
         self.log(Level.INFO, Log_S)
 
         if C_COMPUTE_HASHES:
-            Log_S = "hashes took: MD5=%f secs; SHA1=%f secs; SHA256=%f secs" %\
-             (self.needed_time_MD5, self.needed_time_SHA1, self.needed_time_SHA256)
+            Log_S = "hashes (MD5+SHA1+SHA256, single pass) took: %f secs "\
+                    "(%d files, %d bytes read)" % (self.hasher.needed_time,
+                    self.hasher.hashed_count, self.hasher.bytes_read)
         else:
             Log_S = "hashes NOT computed"
         self.log(Level.INFO, Log_S)
 
-        IngestServices.getInstance().fireModuleDataEvent(
-            ModuleDataEvent(FDRIModuleFactory.moduleName,
-             BlackboardArtifact.ARTIFACT_TYPE.TSK_INTERESTING_FILE_HIT, None))
+        #----------------------------------------
+        # Update the manifest (each shard was
+        # marked done when posted): duplicates are
+        # done if their representative is
+        #----------------------------------------
+        for shard in self.posted_shards_L:
+            if shard.return_code in C_EXE_COMPLETED_CODES:
+                for file_id in shard.copied_ids_L:
+                    manifest.mark_done(self.duplicates_D.get(file_id, []))
+            else:
+                Log_S = "FDRI.exe didn't complete shard %d: %d files will "\
+                        "be processed again by the next run" %\
+                        (shard.index, len(shard.copied_ids_L))
+                self.log(Level.WARNING, Log_S)
+        manifest.close()
 
         # Should we delete the IMG files? (user's configuration)
         if self.deleteAfter:
@@ -828,9 +1392,23 @@ class FDRIModule(DataSourceIngestModule):
         else:
             recognition_S = "OFF"
             
-        ingest_msg_S = "Found %d images with faces: %f secs (FDRI.exe:%f secs). Recognition:%s" %\
-                (images_with_faces_count, FDRIModuleFactory.g_elapsed_time_secs,
+        if self.detector_backend.name == "prepass":
+            # FDRI.exe didn't run: the hits are the pre-pass's
+            ingest_msg_S = "Found %d images with possible faces: %f secs "\
+                    "(pre-pass only, no FDRI.exe)" % (self.possible_faces_count,
+                    FDRIModuleFactory.g_elapsed_time_secs)
+        else:
+            ingest_msg_S = "Found %d images with faces: %f secs (FDRI.exe:%f secs). Recognition:%s" %\
+                (self.images_with_faces_count, FDRIModuleFactory.g_elapsed_time_secs,
                         elapsed_FDRIexe_time_secs, recognition_S)
+        if self.stalled_count:
+            ingest_msg_S = ingest_msg_S + ". %d images stalled FDRI.exe "\
+                    "(put aside in '%s', see %s)" % (self.stalled_count,
+                    self.dir_stalled, C_STALLED_FNAME)
+
+        self.write_metrics(workspace, "done")
+        if self.metrics is not None and C_METRICS_IN_MESSAGE:
+            ingest_msg_S = ingest_msg_S + ". " + self.metrics.summary()
 
         message = IngestMessage.createMessage( IngestMessage.MessageType.DATA,
                 FDRIModuleFactory.moduleName, ingest_msg_S)
@@ -839,182 +1417,4047 @@ class FDRIModule(DataSourceIngestModule):
         return IngestModule.ProcessResult.OK
 
     #==========================================================================
-    # Helper functions
+    # Pipeline stages
     #==========================================================================
-    # File cleanup
-    def deleteFiles(self, path):
-        # ignoring the error if the directory is empty
-        shutil.rmtree(path, ignore_errors=True)
-
-    # Subprocess initiator
-    def thread_work(self, path, param_path, min_size=0, max_size=0):
+    #----------------------------------------------------------------
+    # New shard (of a resolution bucket). Without sharding nor buckets
+    # the only shard uses img/ and the run's workspace, as before.
+    #----------------------------------------------------------------
+    def new_shard(self, index, dir_img, bucket=None):
+        if not self.sharded:
+            return Shard(index, dir_img, self.workspace)
 
-        sub_args = [path, "--params", param_path]
-        if min_size > 0:
-            sub_args.extend(["--min", str(min_size)])
+        shard_S = C_SHARD_DIR_FMT % (index)
+        shard_dir_img = os.path.join(dir_img, shard_S)
+        if not os.path.exists(shard_dir_img):
+            os.mkdir(shard_dir_img)
+        return Shard(index, shard_dir_img,
+                        os.path.join(self.workspace, shard_S), bucket)
 
-        if max_size > 0:
-            sub_args.extend(["--max", str(max_size)])
+    #----------------------------------------------------------------
+    # Detector thread: runs FDRI.exe over each shard, once all its
+    # files are copied, and hands it to the poster thread
+    #----------------------------------------------------------------
+    def detect_stage(self, detect_queue, post_queue):
+        while True:
+            shard = self.get_shard("detect", detect_queue)
+            if shard is None:
+                post_queue.put(None)
+                break
+
+            shard.copied.wait()
+            if self.context.isJobCancelled():
+                continue
+            self.progress.begin_shard(len(shard.copied_ids_L))
+            try:
+                self.detect_shard(shard, post_queue)
+            except Exception, e:
+                Err_S = "Error running FDRI.exe over shard %d: %s" %\
+                                                    (shard.index, str(e))
+                self.log(Level.SEVERE, Err_S)
+                post_queue.put(shard)
+            self.progress.end_shard()
 
-        returnCode = subprocess.call(sub_args)
-        if returnCode:
-            Err_S = "Error in executable: got '%s'" % (str(returnCode))
-            self.log(Level.SEVERE,Err_S)
-            if returnCode <= len(self.errorList) and returnCode > 0:
-                self.log(Level.SEVERE, self.errorList[returnCode])
+    #----------------------------------------------------------------
+    # Runs FDRI.exe over a shard and hands it to the poster thread.
+    # If FDRI.exe runs out of GPU memory, the shards of the recovery
+    # are handed over instead; if the watchdog kills it, the shard is
+    # run again without the image it was stuck on.
+    #----------------------------------------------------------------
+    def detect_shard(self, shard, post_queue):
+        # Nothing to detect (duplicates, copy errors...)
+        if not shard.copied_ids_L:
+            shard.return_code = 0
+            post_queue.put(shard)
+            return
+
+        if C_DETECT_MAX_SIDE > 0:
+            self.reduce_images(shard)
+        self.detector_backend.detect(shard)
+        if shard.scales_D:
+            self.restore_images(shard)
+        Log_S = "Shard %d: FDRI.exe took %f secs (%d images)" %\
+                (shard.index, shard.detect_time, len(shard.copied_ids_L))
+        if shard.bucket is not None:
+            Log_S = Log_S + " [bucket %s]" % (shard.bucket)
+        self.log(Level.INFO, Log_S)
+        if self.metrics is not None:
+            self.metrics.record_shard("detect", shard, shard.detect_time)
+
+        if shard.return_code == C_EXE_OOM_CODE and C_OOM_RECOVERY and\
+                                    not self.context.isJobCancelled():
+            self.recover_oom(shard, post_queue)
+        elif shard.return_code == C_EXE_STALLED_CODE and\
+                                shard.stalled_fname is not None and\
+                                    not self.context.isJobCancelled():
+            self.recover_stall(shard, post_queue)
         else:
-            msg_S = "Child process FDRI.exe terminated with no problems"
-            self.log(Level.INFO, msg_S)
+            post_queue.put(shard)
 
     #----------------------------------------------------------------
-    # File mapping from temp folder to Autopsy files
+    # Downscaled detection: the images of the shard larger than
+    # C_DETECT_MAX_SIDE are replaced by reduced copies (the decoder
+    # subsamples them, so that the full image is never in memory) and
+    # the originals put aside, until restore_images()
     #----------------------------------------------------------------
-    def findByID(self, file_list, id):
-        for file in file_list:
-            if file.getId() == int(id):
-                return file
-
-        return None
+    def reduce_images(self, shard):
+        originals_dir = shard.dir_img.rstrip(os.sep) + C_ORIGINALS_DIR_SUFFIX
+        reduced_count = 0
+        start_time = time.time()
+        for fname in sorted(os.listdir(shard.dir_img)):
+            path = os.path.join(shard.dir_img, fname)
+            if not os.path.isfile(path):
+                continue
+            if not os.path.exists(originals_dir):
+                os.mkdir(originals_dir)
+            original_path = os.path.join(originals_dir, fname)
+            os.rename(path, original_path)
+            try:
+                reduced_D = reduce_image(original_path, path,
+                                                        C_DETECT_MAX_SIDE)
+            except Exception, e:
+                self.log(Level.FINE, "'%s' not downscaled: %s" % (fname,
+                                                                    str(e)))
+                reduced_D = None
+            if reduced_D is None:
+                # Small enough (or not decodable here): as it is
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(original_path, path)
+                continue
+            shard.scales_D[fname] = (original_path, reduced_D["scale"],
+                                    reduced_D["width"], reduced_D["height"])
+            reduced_count += 1
+        if not reduced_count and os.path.exists(originals_dir):
+            os.rmdir(originals_dir)
+
+        if reduced_count:
+            Log_S = "Shard %d: %d images downscaled to %d pixels (longest "\
+                    "side) in %f secs" % (shard.index, reduced_count,
+                    C_DETECT_MAX_SIDE, time.time() - start_time)
+            self.log(Level.INFO, Log_S)
 
     #----------------------------------------------------------------
-    # Complete the DFMXL file, adding the hashes 
-    # (MD5, SHA1 and SHA256) of each individual file.
+    # Back to the originals: the face boxes found by FDRI.exe in the
+    # downscaled images are projected to the originals, whose annotated
+    # copies are drawn again, and the originals replace the reduced
+    # copies (wherever the detector left them)
     #----------------------------------------------------------------
-    def complete_dfxml(self, dfxml_path, file):
-        xml_doc = None
+    def restore_images(self, shard):
+        boxes_path = os.path.join(shard.workspace, C_BOXES_FNAME)
+        boxes_D = {}
+        if os.path.exists(boxes_path):
+            try:
+                with open(boxes_path, "r") as boxes_F:
+                    boxes_D = json.load(boxes_F)["faces"]
+            except (IOError, ValueError, KeyError), e:
+                self.log(Level.WARNING, "Invalid face boxes file '%s': %s"\
+                                                    % (boxes_path, str(e)))
+
+        for fname, (original_path, scale, width, height) in \
+                                                    shard.scales_D.items():
+            if fname in boxes_D:
+                boxes_D[fname] = [[min(int(round(coord / scale)), limit)
+                            for coord, limit in zip(box_L[:4],
+                                    (width, height, width, height))]
+                            for box_L in boxes_D[fname]]
+                annotated_path = os.path.join(shard.workspace,
+                                                    C_ANNOTATED_DIR, fname)
+                if os.path.exists(annotated_path):
+                    try:
+                        annotate_image(original_path, annotated_path,
+                                                            boxes_D[fname])
+                    except Exception, e:
+                        # FDRI.exe's (downscaled) annotated copy stays
+                        self.log(Level.WARNING, "'%s' not annotated: %s" %\
+                                                        (fname, str(e)))
+
+            for dir_S in (shard.dir_img, self.dir_img_done):
+                path = os.path.join(dir_S, fname)
+                if os.path.exists(path):
+                    os.remove(path)
+                    os.rename(original_path, path)
+                    break
+            else:
+                os.remove(original_path)
 
-        # Should we compute hashes? 
-        do_compute_hashes = C_COMPUTE_HASHES
+        if boxes_D:
+            with open(boxes_path, "w") as boxes_F:
+                json.dump({"faces": boxes_D}, boxes_F)
+        os.rmdir(shard.dir_img.rstrip(os.sep) + C_ORIGINALS_DIR_SUFFIX)
+        shard.scales_D = {}
 
-        with open(dfxml_path, "r") as dfxml:
-            xml_doc = m_dom.parse(dfxml)
-            file_elements = xml_doc.getElementsByTagName("fileobject")
-
-            if file.isFile() and file.canRead():
-                #----------------------
-                # Append file hashes
-                #----------------------
-                # SHA1
-                hash_nodeSHA1 = xml_doc.createElement("hashdigest")
-                if do_compute_hashes:
-                    (sha1_hash,time_used) = self.create_hash(file, "sha1")
-                    self.needed_time_SHA1 = self.needed_time_SHA1 + time_used
-                else:
-                    sha1_hash = "0"
-                hash_nodeSHA1.setAttribute("type", "sha1")
-                hash_nodeSHA1.appendChild(xml_doc.createTextNode(sha1_hash))
-
-                # SHA256
-                hash_nodeSHA256 = xml_doc.createElement("hashdigest")
-                if do_compute_hashes:
-                    (sha256_hash,time_used) = self.create_hash(file, "sha256")
-                    self.needed_time_SHA256 = self.needed_time_SHA256+time_used
-                else:
-                    sha256_hash = "0"
-                hash_nodeSHA256.setAttribute("type", "sha256")
-                hash_nodeSHA256.appendChild(xml_doc.createTextNode(sha256_hash))
-
-                # MD5
-                hash_nodeMD5 = xml_doc.createElement("hashdigest")
-                if do_compute_hashes:
-                    (md5_hash,time_used) = self.create_hash(file, "md5")
-                    self.needed_time_MD5 = self.needed_time_MD5 + time_used
-                else:
-                    md5_hash = "0"
-                hash_nodeMD5.setAttribute("type", "md5")
-                hash_nodeMD5.appendChild(xml_doc.createTextNode(md5_hash))
+    #----------------------------------------------------------------
+    # Shards handed between the stages: the depth of the queue and the
+    # time blocked on it go to the metrics (a stage blocked on put is
+    # waiting for the next one; blocked on get, for the previous one)
+    #----------------------------------------------------------------
+    def put_shard(self, queue_S, shard_queue, shard):
+        if self.metrics is None:
+            shard_queue.put(shard)
+            return
+        self.metrics.queue_put(queue_S, shard_queue, shard)
+
+    def get_shard(self, queue_S, shard_queue):
+        if self.metrics is None:
+            return shard_queue.get()
+        return self.metrics.queue_get(queue_S, shard_queue)
+
+    # Metrics of the run to the workspace (and their location to the log)
+    def write_metrics(self, workspace, state_S):
+        if self.metrics is None:
+            return
+        try:
+            self.metrics.write(workspace, state_S)
+        except (IOError, OSError), e:
+            self.log(Level.WARNING, "Metrics not written: " + str(e))
+            return
+        self.log(Level.INFO, "Metrics: '%s' (%s)",
+                    os.path.join(workspace, C_METRICS_FNAME),
+                    self.metrics.summary())
 
-                for element in file_elements:
-                    file_name_node=element.getElementsByTagName("filename")[0]
-                    if file_name_node.firstChild.nodeValue == file.getName().split(".")[0]:
-                        element.appendChild(hash_nodeSHA1)
-                        element.appendChild(hash_nodeSHA256)
-                        element.appendChild(hash_nodeMD5)
+    #----------------------------------------------------------------
+    # Digest of the settings that decide the results of FDRI.exe: the
+    # models and the detector (and pre-pass). Files done with other
+    # settings are processed again (see IngestManifest.check). The
+    # reference images don't count: new wanted faces are searched in
+    # the face index (search_face_index), unless it is disabled.
+    #----------------------------------------------------------------
+    def settings_digest(self):
+        def file_key(path):
+            if path and os.path.isfile(path):
+                stat = os.stat(path)
+                return [path, stat.st_size, int(stat.st_mtime)]
+            return [path, None, None]
+
+        models_L = [file_key(self.userPaths[code])
+                                        for code in sorted(self.userPaths)]
+        settings_D = {
+            "models": models_L,
+            "recognition": self.doRecognition,
+            # The backend in use (the pre-pass may be unavailable)
+            "backend": self.detector_backend.name,
+            "detect_max_side": C_DETECT_MAX_SIDE,
+            # Header check (files left out are recorded as SKIPPED)
+            "header_check": [C_SNIFF_HEADERS, C_IMAGE_MIN_WIDTH,
+                                                        C_IMAGE_MIN_HEIGHT],
+        }
+        if self.detector_backend.name != "fdri":
+            settings_D["prepass"] = [file_key(prepass_cascade_path()),
+                                C_PREPASS_THRESHOLD, C_PREPASS_DETECT_SIDE]
+        if self.wanted_cache is not None and self.face_index is None:
+            settings_D["wanted"] = sorted(
+                                    self.wanted_cache.gallery_D.values())
+        return hashlib.sha256(json.dumps(settings_D,
+                                            sort_keys=True)).hexdigest()
+
+    # dir_img_done: where the images skipped by the pre-pass go
+    def new_detector_backend(self, name_S, dir_img_done):
+        if name_S not in ("fdri", "cascade", "prepass"):
+            self.log(Level.WARNING, "Unknown detector backend '%s': "\
+                                            "using FDRI.exe" % (name_S))
+            name_S = "fdri"
+        if name_S == "fdri":
+            return FDRIExeBackend(self.run_fdri)
+        try:
+            prepass = HaarFacePrepass(prepass_cascade_path(),
+                                                    C_PREPASS_DETECT_SIDE)
+        except (ImportError, IOError), e:
+            self.log(Level.WARNING, "Pre-pass unavailable (%s): using "\
+                                                "FDRI.exe" % (str(e)))
+            return FDRIExeBackend(self.run_fdri)
+        if name_S == "cascade":
+            return CascadeBackend(prepass, C_PREPASS_THRESHOLD,
+                            dir_img_done, FDRIExeBackend(self.run_fdri),
+                            C_PREPASS_CALIBRATE, self.log)
+        return CascadeBackend(prepass, C_PREPASS_THRESHOLD, dir_img_done,
+                                                        None, False, self.log)
 
-        with open(dfxml_path, "w") as out:
-            xml_doc.writexml(out, encoding="utf-8")
+    #----------------------------------------------------------------
+    # FDRI.exe ran out of GPU memory: the images of the shard are split
+    # in two shards (with half the batch size), each run on its own, so
+    # that only the part with the failing image fails again. A single
+    # failing image is processed downscaled.
+    #----------------------------------------------------------------
+    def recover_oom(self, shard, post_queue):
+        fnames_L = sorted([fname for fname in os.listdir(shard.dir_img)
+                    if os.path.isfile(os.path.join(shard.dir_img, fname))])
+        Log_S = "Shard %d: out of GPU memory with %d images, recovering" %\
+                                                (shard.index, len(fnames_L))
+        self.log(Level.WARNING, Log_S)
+
+        if len(fnames_L) == 1:
+            self.downscale_pass(shard, fnames_L[0], post_queue)
+            return
+        if not fnames_L:
+            post_queue.put(shard)
+            return
+
+        if shard.bucket is not None:
+            bucket = ResolutionBucket(shard.bucket.index,
+                        shard.bucket.min_pixels, shard.bucket.max_pixels,
+                        max(1, shard.bucket.batch_size // 2))
+        else:
+            bucket = None
+        half = (len(fnames_L) + 1) // 2
+        for part_L in (fnames_L[:half], fnames_L[half:]):
+            if self.context.isJobCancelled():
+                return
+            child = self.new_oom_shard(shard, bucket)
+            for fname in part_L:
+                dest_path = os.path.join(child.dir_img, fname)
+                os.rename(os.path.join(shard.dir_img, fname), dest_path)
+                file_id = self.file_index.parse_result_line(fname)
+                if file_id is not None:
+                    child.copied_ids_L.append(file_id)
+                    self.manifest.update_path(file_id, dest_path)
+            self.log_oom(shard, Level.INFO, "%d images moved to '%s'" %\
+                        (len(part_L), os.path.basename(child.dir_img)))
+            self.detect_shard(child, post_queue)
+        self.remove_oom_shard(shard)
 
     #----------------------------------------------------------------
-    # Hash calculation, Autopsy seems to not provide these
+    # A single image runs out of GPU memory: FDRI.exe is run over
+    # smaller copies of it until one fits. The original copy is kept
+    # (archived as usual); if no copy fits, the image is processed
+    # again by the next run.
     #----------------------------------------------------------------
-    def create_hash(self, f_target, algorithm):
-        time_start = time.time()
+    def downscale_pass(self, shard, fname, post_queue):
+        src_path = os.path.join(shard.dir_img, fname)
+        file_id = self.file_index.parse_result_line(fname)
+        for step in range(1, C_OOM_DOWNSCALE_STEPS + 1):
+            if self.context.isJobCancelled():
+                return
+            child = self.new_oom_shard(shard,
+                                            ResolutionBucket(None, 0, 0, 1))
+            dest_path = os.path.join(child.dir_img, fname)
+            try:
+                width, height, new_width, new_height = self.downscale_image(
+                        src_path, dest_path, C_OOM_DOWNSCALE_FACTOR ** step)
+            except Exception, e:
+                self.log_oom(shard, Level.WARNING,
+                    "'%s' can't be downscaled: %s" % (fname, str(e)))
+                self.deleteFiles(child.dir_img)
+                break
+
+            if file_id is not None:
+                child.copied_ids_L.append(file_id)
+            self.run_fdri(child)
+            if child.return_code != C_EXE_OOM_CODE:
+                self.log_oom(shard, Level.WARNING, "'%s' (%dx%d) processed "\
+                        "downscaled to %dx%d (FDRI.exe exit status: %s)" %\
+                        (fname, width, height, new_width, new_height,
+                        child.return_code))
+                os.remove(dest_path)
+                os.rename(src_path, dest_path)
+                if file_id is not None:
+                    self.manifest.update_path(file_id, dest_path)
+                self.remove_oom_shard(shard)
+                post_queue.put(child)
+                return
+
+            self.log_oom(shard, Level.INFO, "'%s' (%dx%d) downscaled to "\
+                    "%dx%d is still out of GPU memory" % (fname, width,
+                    height, new_width, new_height))
+            self.deleteFiles(child.dir_img)
+            self.deleteFiles(child.workspace)
+
+        self.log_oom(shard, Level.WARNING, "'%s' not processed (out of GPU "\
+                                "memory), left for the next run" % (fname))
+        post_queue.put(shard)
 
-        hash_creator = hashlib.new(algorithm)
+    #----------------------------------------------------------------
+    # FDRI.exe was killed by the watchdog, stuck on an image: the image
+    # is put aside (C_STALLED_DIR) and recorded as STALLED, so that the
+    # next runs only retry it C_STALL_MAX_TRIES times (C_STALLED_FNAME
+    # and the "Stalled FDRI.exe" artifacts list it, for a manual
+    # review), and the shard is run again without it
+    #----------------------------------------------------------------
+    def recover_stall(self, shard, post_queue):
+        fname = shard.stalled_fname
+        shard.stalled_fname = None
+        src_path = os.path.join(shard.dir_img, fname)
+        if not os.path.exists(src_path):
+            self.log(Level.WARNING, "Shard %d: stalled image '%s' not "\
+                                        "found", shard.index, fname)
+            post_queue.put(shard)
+            return
+
+        if not os.path.exists(self.dir_stalled):
+            os.mkdir(self.dir_stalled)
+        dest_path = os.path.join(self.dir_stalled, fname)
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        os.rename(src_path, dest_path)
+        file_id = self.file_index.parse_result_line(fname)
+        if file_id is not None:
+            if file_id in shard.copied_ids_L:
+                shard.copied_ids_L.remove(file_id)
+            self.manifest.mark_stalled(file_id, dest_path)
+            shard.stalled_ids_L.append(file_id)
+        self.stalled_count += 1
+        Log_S = "Shard %d: '%s' put aside in '%s', running the shard "\
+                "again without it" % (shard.index, fname, self.dir_stalled)
+        self.log(Level.WARNING, Log_S)
+        self.detect_shard(shard, post_queue)
+
+    def new_oom_shard(self, shard, bucket):
+        self.oom_shards_count += 1
+        shard_S = C_OOM_SHARD_DIR_FMT % (shard.index, self.oom_shards_count)
+        child = Shard(shard.index, os.path.join(self.dir_img, shard_S),
+                            os.path.join(self.workspace, shard_S), bucket)
+        if not os.path.exists(child.dir_img):
+            os.mkdir(child.dir_img)
+        return child
+
+    # A shard whose images went to the shards of the recovery: its
+    # output is partial
+    def remove_oom_shard(self, shard):
+        if shard.workspace != self.workspace:
+            self.deleteFiles(shard.workspace)
+        if shard.dir_img != self.dir_img and not os.listdir(shard.dir_img):
+            os.rmdir(shard.dir_img)
+
+    # Decisions of the recovery go to the log and to C_OOM_LOG_FNAME
+    def log_oom(self, shard, level, msg_S):
+        self.log_as("recover_oom", level, "Shard %d: %s", shard.index, msg_S)
+        timestamp_S = datetime.now().strftime('%Y-%m-%d_%Hh%Mm%Ss')
+        with open(os.path.join(self.workspace, C_OOM_LOG_FNAME), "a") as log_F:
+            log_F.write("%s shard %d: %s\n" % (timestamp_S, shard.index,
+                                                                    msg_S))
+
+    # embed_only: only the descriptors of the wanted faces are computed
+    # (see C_WANTED_DESCRIPTORS_OUT_FNAME)
+    def run_fdri(self, shard, embed_only=False):
+        if not os.path.exists(shard.workspace):
+            os.mkdir(shard.workspace)
+        configFilePath = os.path.join(shard.workspace,C_PARAMS_JSON_FNAME)
+
+        params_D = {
+            "paths": self.userPaths,#self.localSettings.getAllPaths(),
+            "wanted_faces" : self.localSettings.getPath("1"),
+            "imagesPath": shard.dir_img,
+            "doRecognition": self.doRecognition,
+            "workspace": shard.workspace,
+        }
 
-        inputStream = ReadContentInputStream(f_target)
-        buffer = jarray.zeros(BLOCKSIZE, "b")
-        len = inputStream.read(buffer)
+        # FDRI.exe only embeds the reference images that are not in
+        # the cache (versions ignoring these keys embed them all)
+        if self.wanted_cache is not None and\
+                                self.wanted_cache.model_key is not None:
+            params_D["wanted_descriptors"] = os.path.join(shard.workspace,
+                                                C_WANTED_DESCRIPTORS_FNAME)
+            params_D["wanted_descriptors_out"] = os.path.join(
+                            shard.workspace, C_WANTED_DESCRIPTORS_OUT_FNAME)
+            self.wanted_cache.export(params_D["wanted_descriptors"])
+            if embed_only:
+                params_D["embed_only"] = True
+
+        # Descriptors of the faces found go to the face index
+        if self.face_index is not None:
+            params_D["descriptors_out"] = os.path.join(shard.workspace,
+                                                        C_DESCRIPTORS_FNAME)
+
+        # Images per batch on the GPU (ignored by older versions)
+        if shard.bucket is not None and shard.bucket.batch_size:
+            params_D["batch_size"] = shard.bucket.batch_size
+
+        # Downscaled images: their originals (for the recognition crop)
+        # and the face boxes, projected back by the module
+        if shard.scales_D:
+            params_D["image_scales"] = os.path.join(shard.workspace,
+                                                    C_IMAGE_SCALES_FNAME)
+            params_D["boxes_out"] = os.path.join(shard.workspace,
+                                                            C_BOXES_FNAME)
+            with open(params_D["image_scales"], "w") as out:
+                json.dump({"images": dict([(fname, {"original": path,
+                                "scale": scale, "width": width,
+                                "height": height}) for fname, (path, scale,
+                                width, height) in shard.scales_D.items()])},
+                                                                        out)
+
+        # Progress of the run, read while FDRI.exe runs (versions that
+        # ignore the key only report the end of the shard)
+        params_D["progress_out"] = os.path.join(shard.workspace,
+                                                        C_PROGRESS_FNAME)
+        progress = ProgressStream(params_D["progress_out"], self.progress,
+                shard, os.path.join(self.workspace, C_STALLED_FNAME),
+                self.log, C_STALL_WARN_SECS, C_STALL_KILL_SECS,
+                C_STALL_START_SECS)
 
-        while (len != -1):
-            hash_creator.update(buffer)
-            len = inputStream.read(buffer)
+        with open(configFilePath, "w") as out:
+            json.dump(params_D, out)
 
-        time_consumed = time.time()-time_start
-        return (hash_creator.hexdigest(),time_consumed)
+        #
+        # The size of the images (in pixels) of the shard's bucket
+        # bounds the call (see C_GPU_MAX_PIXELS)
+        #
+        # Example:
+        #                                                   Required    Minimum size Maximum size
+        # self.thread_work(self.pathToExe, configFilePath, 1200*1200, 2000*2000))
+        # self.thread_work(self.pathToExe, configFilePath, 1200*1200))
+        start_FDRIexe_time = time.time()
+        self.exe_return_code = None
+        if shard.bucket is not None:
+            self.thread_work(self.pathToExe, configFilePath,
+                        shard.bucket.min_pixels, shard.bucket.max_pixels,
+                        progress)
+        else:
+            self.thread_work(self.pathToExe, configFilePath,
+                                                    progress=progress)
+        shard.return_code = self.exe_return_code
+        if shard.return_code == C_EXE_STALLED_CODE:
+            shard.stalled_fname = progress.stalled_S
+        if self.metrics is not None:
+            self.metrics.exit_code(shard.return_code)
+
+        # Descriptors computed by FDRI.exe go to the cache (and to the
+        # next shards)
+        if "wanted_descriptors_out" in params_D and\
+                        os.path.exists(params_D["wanted_descriptors_out"]):
+            new_count = self.wanted_cache.absorb(
+                                        params_D["wanted_descriptors_out"])
+            Log_S = "Wanted faces cache: %d reference images added" %\
+                                                                (new_count)
+            self.log(Level.INFO, Log_S)
+
+        shard.detect_time = time.time() - start_FDRIexe_time
+        self.detect_time_secs += shard.detect_time
 
+    #----------------------------------------------------------------
+    # Poster thread: adds the results of each shard to the case
+    #----------------------------------------------------------------
+    def post_stage(self, post_queue):
+        while True:
+            shard = self.get_shard("post", post_queue)
+            if shard is None:
+                break
+            if self.context.isJobCancelled():
+                continue
+            try:
+                self.post_shard(shard)
+            except Exception, e:
+                Err_S = "Error adding the results of shard %d: %s" %\
+                                                    (shard.index, str(e))
+                self.log(Level.SEVERE, Err_S)
+
+    def post_shard(self, shard):
+        start_post_time = time.time()
+
+        if shard.copied_ids_L:
+            # Duplicates known so far; the ones found later get the
+            # results at the end of the run
+            duplicates_D = {}
+            for file_id in shard.copied_ids_L:
+                dup_ids_L = list(self.duplicates_D.get(file_id, []))
+                if dup_ids_L:
+                    duplicates_D[file_id] = dup_ids_L
+                    self.fanned_out_S.update(dup_ids_L)
+            self.posted_reps_L.extend(shard.copied_ids_L)
+
+            # Files whose hashes go into the DFXML file (object id -> file)
+            dfxml_files_D = {}
+
+            # Add images with the wanted faces to blackboard
+            # (files may already have an "Images with faces" artifact)
+            self.post_hits(shard, C_FDRI_WANTED_FNAME, "/Wanted faces",
+                                                duplicates_D, dfxml_files_D,
+                                                check_set_name=True)
+
+            # Name of file that holds the data regarding detected faces
+            # Each row corresponds to a detected face
+            self.images_with_faces_count += self.post_hits(shard,
+                            C_FACES_FOUND_FNAME, "/Images with faces",
+                            duplicates_D, dfxml_files_D)
+
+            # Images tagged by the pre-pass alone (no CNN, no DFXML)
+            if os.path.exists(os.path.join(shard.workspace,
+                                                    C_PREPASS_FOUND_FNAME)):
+                self.possible_faces_count += self.post_hits(shard,
+                            C_PREPASS_FOUND_FNAME, "/Possible faces",
+                            duplicates_D, {})
+
+            #----------------------------------------
+            # Complete the DFXML file with the hashes
+            # of every hit (single streaming pass)
+            #----------------------------------------
+            if self.generate_hash and dfxml_files_D:
+                dfxml_path = os.path.join(shard.workspace, C_DFXML_FNAME)
+                if os.path.exists(dfxml_path):
+                    self.complete_dfxml(dfxml_path, dfxml_files_D.values())
+                else:
+                    self.log(Level.WARNING, "DFXML file not found: '%s'" %\
+                                                                (dfxml_path))
 
+            # Results appear in Autopsy shard by shard
+            self.bb_writer.commit()
 
+            # The DFXML file is complete: the digests of the shard and
+            # of its duplicates are no longer needed
+            self.hasher.evict(shard.copied_ids_L)
+            for dup_ids_L in duplicates_D.values():
+                self.hasher.evict(dup_ids_L)
 
-    #--------------------------------------------------------------------
-    # Split filename into basename and extension
-    #--------------------------------------------------------------------
-    def split_fname(self, fname):
-        if fname is None or len(fname)==0:
-            return "",""
-        fname_L = fname.split(".")
-        fname_L_len = len(fname_L)
-        if fname_L_len == 1:
-            # No extension
-            return fname,""
-        # Still here?
-        if fname_L_len == 2:
-            # simple: name + extension
-            return fname_L[0],fname_L[1]
-        else:
-            name_S = ""
-            for elm in fname_L[:-1]:
-                name_S = name_S + "." + elm
-            return name_S,fname_L[fname_L_len-1]
+        if shard.stalled_ids_L:
+            self.post_stalled(shard)
 
+        #----------------------------------------
+        # Update the manifest. If FDRI.exe ended
+        # well, the files of the shard are done and
+        # their copies leave img/, so that a rerun
+        # only processes new files
+        #----------------------------------------
+        if shard.return_code in C_EXE_COMPLETED_CODES:
+            self.manifest.mark_done(shard.copied_ids_L)
+            self.archive_images(shard.dir_img, self.dir_img_done)
+            if shard.dir_img != self.dir_img and\
+                                            not os.listdir(shard.dir_img):
+                os.rmdir(shard.dir_img)
+
+        self.posted_shards_L.append(shard)
+        shard.post_time = time.time() - start_post_time
+        self.post_time_secs += shard.post_time
+        if self.metrics is not None:
+            self.metrics.record_shard("post", shard, shard.post_time)
 
-#----------------------------------------------------------------------
-# Global settings UI class, responsible for AI models weights location
-# This is case independent
-#----------------------------------------------------------------------
-class UIGlobalSettingsPanel(IngestModuleGlobalSettingsPanel):
+    #----------------------------------------------------------------
+    # Images put aside by the watchdog are tagged in the case (set
+    # "Stalled FDRI.exe"), so that the analyst reviews them
+    #----------------------------------------------------------------
+    def post_stalled(self, shard):
+        set_name_S = self.dataSource.getName() + "/Stalled FDRI.exe"
+        for file in self.file_index.resolve_ids(shard.stalled_ids_L):
+            if file is None:
+                continue
+            if not self.bb_writer.has_artifact(file, set_name_S):
+                self.bb_writer.add_artifact(file, set_name_S)
+        self.bb_writer.commit()
 
-    def __init__(self):
-        self.save_file_cbox = JCheckBox(C_LABEL_INFO_AUTOPSY_TEMP)
-        ## "Save copied images outside of AUTOPSY's temp"
+    #----------------------------------------------------------------
+    # Add the hits listed in a result file of FDRI.exe to the case:
+    # a TSK_INTERESTING_FILE_HIT artifact per file and a derived file
+    # with the annotated image. Returns the number of hits.
+    #----------------------------------------------------------------
+    def post_hits(self, shard, result_fname, set_name_S, duplicates_D,
+                dfxml_files_D, include_detected=True, check_set_name=False):
+        hits_count = 0
+        outPositiveFile = os.path.join(shard.workspace, result_fname)
+        self.log(Level.INFO,"File with results from FDRI.exe:'%s'" %\
+                (outPositiveFile))
+        if not os.path.exists(outPositiveFile):
+            return hits_count
+
+        # Only artifacts of this set count (files may already have an
+        # "Images with faces" one); otherwise any interesting file hit
+        full_set_name_S = self.dataSource.getName() + set_name_S
+        if check_set_name:
+            existing_set_S = full_set_name_S
+        else:
+            existing_set_S = None
+
+        existing_summary = LogSummary(self.log_as,
+                                        "Artifact already exists! ignoring")
+
+        # All lines are resolved in bulk (None for unknown ids).
+        # Each hit is fanned out to the duplicates of the detected file
+        for interestingFile, detectedFile in \
+                self.file_index.resolve_result_file(outPositiveFile,
+                                        duplicates_D, include_detected):
+            # Another file with at least one face
+            hits_count += 1
+            if interestingFile == None:
+                continue
+
+            # Creating new artifacts with faces found (indexed for
+            # keyword search in batches)
+            if self.bb_writer.has_artifact(interestingFile, existing_set_S):
+                existing_summary.add(interestingFile.getName())
+            else:
+                self.bb_writer.add_artifact(interestingFile, full_set_name_S)
+
+                # Adding derivated files to case
+                # These are files with borders on the found faces
+
+                # The annotated image has the name of the copy of the
+                # detected file (which differs from interestingFile for
+                # duplicates)
+                interestingFName = interestingFile.getName()
+                f_path = self.copy_fname(detectedFile)
+
+                # We need path relative to temp folder since the 
+                # Autopsy's API requires files in the case's 
+                # TEMP folder
+                f_temp_path = os.path.join("Temp",self.dataSource.getName(),
+                        C_FDRI_DIR, C_ANNOTATED_DIR, f_path)
+
+                # Temporary fix
+                f_size = self.place_annotated(shard, f_path)
+                if f_size is not None:
+                    label_S = C_ANNOTATED_LABEL + interestingFName
+                    self.bb_writer.add_derived_file(label_S, f_temp_path,
+                                                    f_size, interestingFile)
+            # Hashes are added to the DFXML at the end, in one pass
+            dfxml_files_D[interestingFile.getId()] = interestingFile
+
+        existing_summary.log_summary()
+        return hits_count
 
-        self.textInputs = {
-            '0': JTextField('', 30),
-            '1': JTextField('', 30),
-            '2': JTextField('', 30)
-        }
+    #----------------------------------------------------------------
+    # Put the annotated image written by FDRI.exe in the shard's
+    # workspace into the case's Temp folder: a hard link, or a move
+    # (the workspace copy isn't used after). Returns its size (None:
+    # FDRI.exe didn't annotate the image). The duplicates of a
+    # detected file share its annotated image.
+    #----------------------------------------------------------------
+    def place_annotated(self, shard, f_path):
+        dest_path = os.path.join(self.temp_dir, C_ANNOTATED_DIR, f_path)
+        if dest_path in self.placed_annotated_S:
+            return os.path.getsize(dest_path)
+        src_path = os.path.join(shard.workspace, C_ANNOTATED_DIR, f_path)
+        if not os.path.exists(src_path):
+            return None
+
+        dest_dir = os.path.dirname(dest_path)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        # Left by a previous run over the data source
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        linked = False
+        if C_LINK_ANNOTATED:
+            try:
+                Files.createLink(File(dest_path).toPath(),
+                                                    File(src_path).toPath())
+                linked = True
+            except Exception:
+                # Other volume, no hard links (FAT): move
+                pass
+        if linked:
+            self.annotated_linked_count += 1
+        else:
+            shutil.move(src_path, dest_path)
+            self.annotated_moved_count += 1
+        self.placed_annotated_S.add(dest_path)
+        return os.path.getsize(dest_path)
 
-        self.buttons = {
-            '0': JButton("Choose file", actionPerformed=self.chooseFolder),
-            '1': JButton("Choose file", actionPerformed=self.chooseFolder),
-            '2': JButton("Choose file", actionPerformed=self.chooseFolder)
-        }
-        
-        self.initComponents()
-        self.load()
+    #----------------------------------------------------------------
+    # With dedupe, a duplicate may be found after the shard of its
+    # representative was posted: give it the results now
+    #----------------------------------------------------------------
+    def post_late_duplicates(self):
+        late_D = {}
+        for file_id in self.posted_reps_L:
+            late_L = [dup_id for dup_id in self.duplicates_D.get(file_id, [])
+                                    if dup_id not in self.fanned_out_S]
+            if late_L:
+                late_D[file_id] = late_L
+                self.hasher.evict(late_L)
+        if not late_D:
+            return
+
+        for shard in self.posted_shards_L:
+            if not shard.copied_ids_L:
+                continue
+            self.post_hits(shard, C_FDRI_WANTED_FNAME, "/Wanted faces",
+                                    late_D, {}, False, check_set_name=True)
+            self.images_with_faces_count += self.post_hits(shard,
+                            C_FACES_FOUND_FNAME, "/Images with faces",
+                            late_D, {}, False)
+            if os.path.exists(os.path.join(shard.workspace,
+                                                    C_PREPASS_FOUND_FNAME)):
+                self.possible_faces_count += self.post_hits(shard,
+                            C_PREPASS_FOUND_FNAME, "/Possible faces",
+                            late_D, {}, False)
 
-    def checkBoxEvent(self, event):
-        self.save_files = self.save_file_cbox.isSelected()
+    #----------------------------------------------------------------
+    # Add the face descriptors computed by FDRI.exe in this run to
+    # the face index (duplicates get the descriptors of their
+    # representative)
+    #----------------------------------------------------------------
+    def index_faces(self):
+        case_name_S = Case.getCurrentCase().getName()
+        ds_name_S = self.dataSource.getName()
+        indexed_count = 0
+        for shard in self.posted_shards_L:
+            descriptors_path = os.path.join(shard.workspace,
+                                                        C_DESCRIPTORS_FNAME)
+            if not os.path.exists(descriptors_path):
+                continue
+            try:
+                with open(descriptors_path, "r") as descriptors_F:
+                    faces_D = json.load(descriptors_F)["faces"]
+            except (IOError, ValueError, KeyError), e:
+                self.log(Level.WARNING, "Invalid descriptors file '%s': %s"\
+                                            % (descriptors_path, str(e)))
+                continue
+
+            for fname in sorted(faces_D):
+                file_id = self.file_index.parse_result_line(fname)
+                if file_id is None:
+                    continue
+                ids_L = [file_id] + self.duplicates_D.get(file_id, [])
+                for file, detected in zip(self.file_index.resolve_ids(ids_L),
+                                                                    ids_L):
+                    if file is None:
+                        continue
+                    if self.face_index.add_image(faces_D[fname],
+                            case_name_S, ds_name_S, detected, file.getName()):
+                        indexed_count += 1
+        self.face_index.flush()
+
+        Log_S = "Face index: %d images added" % (indexed_count)
+        self.log(Level.INFO, Log_S)
+
+    #----------------------------------------------------------------
+    # Search the wanted faces in the face index. Matches of every case
+    # are written to C_INDEX_MATCHES_FNAME; files of this data source
+    # are tagged as "Wanted faces". Returns the number of files tagged.
+    #----------------------------------------------------------------
+    def search_face_index(self):
+        start_time = time.time()
+
+        # Reference images never embedded: FDRI.exe in embed-only mode
+        # (an empty imagesPath, for versions that ignore it). Without
+        # the models nothing can be embedded.
+        if self.wanted_cache.model_key is not None and\
+                        len(self.wanted_cache.cached_faces()) <\
+                                        len(self.wanted_cache.gallery_D):
+            wanted_workspace = os.path.join(self.workspace, "wanted_faces")
+            dir_empty = os.path.join(wanted_workspace, "img")
+            if not os.path.exists(dir_empty):
+                os.makedirs(dir_empty)
+            self.run_fdri(Shard(-1, dir_empty, wanted_workspace), True)
+
+        wanted_D = self.wanted_cache.cached_faces()
+        if not wanted_D:
+            self.log(Level.WARNING,
+                    "Face index: no descriptors for the wanted faces")
+            return 0
+
+        matches_L = self.face_index.search(wanted_D, C_FACE_MATCH_THRESHOLD,
+                                                        C_FACE_INDEX_PROBES)
+
+        case_name_S = Case.getCurrentCase().getName()
+        ds_name_S = self.dataSource.getName()
+        wanted_ids_S = set()
+        with open(os.path.join(self.workspace, C_INDEX_MATCHES_FNAME),
+                                                        "w") as matches_F:
+            matches_F.write(C_SEP_S)
+            matches_F.write("# distance:wanted image:case:data source:"\
+                                                                "file:id\n")
+            matches_F.write(C_SEP_S)
+            for distance, wanted_fname, meta_L in matches_L:
+                matches_F.write("%f:%s:%s\n" % (distance, wanted_fname,
+                                                        ":".join(meta_L)))
+                if meta_L[0] == case_name_S and meta_L[1] == ds_name_S:
+                    wanted_ids_S.add(int(meta_L[3]))
+
+        # Tag the files through the usual path (by object id)
+        with open(os.path.join(self.workspace, C_INDEX_WANTED_FNAME),
+                                                        "w") as wanted_F:
+            for file_id in sorted(wanted_ids_S):
+                if file_id in self.file_index:
+                    wanted_F.write("__id__%d\n" % (file_id))
+        wanted_count = self.post_hits(Shard(-1, None, self.workspace),
+                    C_INDEX_WANTED_FNAME, "/Wanted faces", {}, {},
+                    check_set_name=True)
+        self.bb_writer.commit()
+
+        Log_S = "Face index: %d matches (%d files of this data source) in "\
+                "%d faces, took %f secs" % (len(matches_L), wanted_count,
+                self.face_index.searched_count, time.time() - start_time)
+        self.log(Level.INFO, Log_S)
+        return wanted_count
+
+    #----------------------------------------------------------------
+    # Merge the result files and the DFXML of the shards into the
+    # run's workspace
+    #----------------------------------------------------------------
+    def merge_shards_results(self, shards_L):
+        for result_fname in (C_FDRI_WANTED_FNAME, C_FACES_FOUND_FNAME,
+                                                    C_PREPASS_FOUND_FNAME):
+            # The pre-pass file only exists in prepass mode
+            if result_fname == C_PREPASS_FOUND_FNAME and not [shard
+                    for shard in shards_L if os.path.exists(os.path.join(
+                                    shard.workspace, result_fname))]:
+                continue
+            with open(os.path.join(self.workspace, result_fname), "w") as out:
+                for shard in shards_L:
+                    shard_path = os.path.join(shard.workspace, result_fname)
+                    if os.path.exists(shard_path):
+                        with open(shard_path, "r") as shard_F:
+                            shutil.copyfileobj(shard_F, out)
+
+        dfxml_L = [os.path.join(shard.workspace, C_DFXML_FNAME)
+                    for shard in shards_L if os.path.exists(
+                            os.path.join(shard.workspace, C_DFXML_FNAME))]
+        if dfxml_L:
+            with open(os.path.join(self.workspace, C_DFXML_FNAME), "w") as out:
+                generator = XMLGenerator(out, "utf-8")
+                generator.startDocument()
+                for i, dfxml_path in enumerate(dfxml_L):
+                    xml.sax.parse(dfxml_path, DFXMLMergeHandler(generator,
+                                        i == 0, i == len(dfxml_L) - 1))
+                generator.endDocument()
+
+    #==========================================================================
+    # Helper functions
+    #==========================================================================
+    #----------------------------------------------------------------
+    # Enumerate the image files of the data source: queries on the
+    # case DB select them by detected MIME type or by extension,
+    # leaving out directories. Images come first, then the small files
+    # (size < C_FILE_MIN_SIZE). This is a generator: files are read a
+    # page (C_ENUM_PAGE_SIZE files, by object id) at a time, so only
+    # one page is held in memory.
+    #----------------------------------------------------------------
+    def enumerate_files(self, dataSource):
+        case = Case.getCurrentCase().getSleuthkitCase()
+        self.enum_stats_D = {"files": 0, "pages": 0, "secs": 0.0}
+
+        for size_S in ("size >= %d" % (C_FILE_MIN_SIZE),
+                                        "size < %d" % (C_FILE_MIN_SIZE)):
+            for file in self.find_files(case, dataSource, size_S):
+                self.enum_stats_D["files"] += 1
+                yield file
+
+        Log_S = "Enumeration: %d files, %d queries (%f secs)" %\
+                (self.enum_stats_D["files"], self.enum_stats_D["pages"],
+                self.enum_stats_D["secs"])
+        self.log(Level.INFO, Log_S)
+
+    def find_files(self, case, dataSource, size_S):
+        extensions_L = [ext.lstrip(".") for ext in self.extensions]
+        mime_types_L = sorted(set([C_MIME_TYPES[ext]
+                                                for ext in extensions_L]))
+        mime_S = "mime_type IN (%s)" % (",".join(["'%s'" % (mime_type)
+                                            for mime_type in mime_types_L]))
+        base_S = "data_source_obj_id = %d AND meta_type != %d AND %s" %\
+            (dataSource.getId(),
+            TskData.TSK_FS_META_TYPE_ENUM.TSK_FS_META_TYPE_DIR.getValue(),
+                                                                    size_S)
+
+        # The extension column only exists in recent case DBs
+        ext_S = "LOWER(extension) IN (%s)" % (",".join(["'%s'" % (ext)
+                                                for ext in extensions_L]))
+        name_S = " OR ".join(["LOWER(name) LIKE '%%.%s'" % (ext)
+                                                for ext in extensions_L])
+        for select_S in (ext_S, name_S):
+            where_S = "%s AND (%s OR %s)" % (base_S, mime_S, select_S)
+            try:
+                page_L = self.find_page(case, where_S, -1)
+            except TskCoreException, e:
+                self.log(Level.WARNING, "Error in query '%s': %s" %\
+                                                        (where_S, str(e)))
+                continue
+
+            # Keyset pagination: the next page starts after the last id
+            while page_L:
+                for file in page_L:
+                    yield file
+                if len(page_L) < C_ENUM_PAGE_SIZE:
+                    break
+                page_L = self.find_page(case, where_S,
+                                                    page_L[-1].getId())
+            return
+
+        # Last resort: one name LIKE per extension through the FileManager
+        # FileManager API: http://sleuthkit.org/autopsy/docs/api-docs/4.4.1/classorg_1_1sleuthkit_1_1autopsy_1_1casemodule_1_1services_1_1_file_manager.html
+        fileManager = Case.getCurrentCase().getServices().getFileManager()
+        large = size_S.startswith("size >=")
+        seen_ids_S = set()
+        for extension in self.extensions:
+            try:
+                for file in fileManager.findFiles(dataSource, "%" + extension):
+                    if (file.getSize() >= C_FILE_MIN_SIZE) == large and\
+                            not file.isDir() and file.getId() not in seen_ids_S:
+                        seen_ids_S.add(file.getId())
+                        yield file
+            except TskCoreException:
+                self.log(Level.INFO, "Error getting files from: '" +
+                         extension + "'")
+
+    def find_page(self, case, where_S, last_id):
+        start_time = time.time()
+        page_L = list(case.findAllFilesWhere("%s AND obj_id > %d "\
+            "ORDER BY obj_id LIMIT %d" % (where_S, last_id, C_ENUM_PAGE_SIZE)))
+        self.enum_stats_D["pages"] += 1
+        self.enum_stats_D["secs"] += time.time() - start_time
+        return page_L
+
+    # File cleanup
+    def deleteFiles(self, path):
+        # ignoring the error if the directory is empty
+        shutil.rmtree(path, ignore_errors=True)
+
+    #----------------------------------------------------------------
+    # Move the processed copies from img/ to img_done/
+    # (rename: same volume, no data is copied)
+    #----------------------------------------------------------------
+    def archive_images(self, dir_img, dir_img_done):
+        if not os.path.exists(dir_img_done):
+            os.mkdir(dir_img_done)
+        for fname in os.listdir(dir_img):
+            # Shard dirs
+            if os.path.isdir(os.path.join(dir_img, fname)):
+                continue
+            dest_path = os.path.join(dir_img_done, fname)
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            os.rename(os.path.join(dir_img, fname), dest_path)
+
+    # Subprocess initiator
+    def thread_work(self, path, param_path, min_size=0, max_size=0,
+                                                            progress=None):
+
+        sub_args = [path, "--params", param_path]
+        if min_size > 0:
+            sub_args.extend(["--min", str(min_size)])
+
+        if max_size > 0:
+            sub_args.extend(["--max", str(max_size)])
+
+        # The resident FDRI.exe takes the shard as a batch; if it fails,
+        # FDRI.exe is run for this and the next shards
+        returnCode = None
+        cancelled = False
+        if self.detector_service is not None:
+            try:
+                returnCode = self.detector_service.run(param_path, min_size,
+                            max_size, self.context.isJobCancelled, progress)
+                cancelled = returnCode is None
+            except (IOError, ValueError), e:
+                Msg_S = "Detector service failed (%s): running FDRI.exe" %\
+                                                                    (str(e))
+                self.log(Level.WARNING, Msg_S)
+                self.detector_service = None
+            else:
+                # Stuck on an image: the service may not take more batches
+                if returnCode == C_EXE_STALLED_CODE:
+                    self.log(Level.WARNING, "Detector service stalled: "\
+                                    "running FDRI.exe for the next shards")
+                    self.detector_service.stop()
+                    self.detector_service = None
+                    self.exe_return_code = returnCode
+                    return
+
+        # FDRI.exe is killed if the user cancels the job, or if it
+        # makes no progress (see ProgressStream)
+        if self.detector_service is None:
+            on_tick = None
+            if progress is not None:
+                on_tick = progress.poll
+            supervisor = ExeSupervisor(self.context.isJobCancelled, self.log,
+                                                            on_tick=on_tick)
+            returnCode = supervisor.run(sub_args)
+            cancelled = supervisor.cancelled
+            if supervisor.stalled:
+                returnCode = C_EXE_STALLED_CODE
+            elif progress is not None:
+                # Events written just before the exit
+                progress.read()
+        self.exe_return_code = returnCode
+        if cancelled:
+            Msg_S = "FDRI.exe cancelled by the user (exit status: %s)" %\
+                                                        (str(returnCode))
+            self.log(Level.INFO, Msg_S)
+        elif returnCode == C_EXE_STALLED_CODE:
+            Msg_S = "FDRI.exe killed by the watchdog (no progress, see "\
+                                                    "%s)" % (C_STALLED_FNAME)
+            self.log(Level.WARNING, Msg_S)
+        elif returnCode:
+            Err_S = "Error in executable: got '%s'" % (str(returnCode))
+            self.log(Level.SEVERE,Err_S)
+            if returnCode <= len(self.errorList) and returnCode > 0:
+                self.log(Level.SEVERE, self.errorList[returnCode])
+        else:
+            msg_S = "Child process FDRI.exe terminated with no problems"
+            self.log(Level.INFO, msg_S)
+
+    #----------------------------------------------------------------
+    # Complete the DFMXL file, adding the hashes 
+    # (MD5, SHA1 and SHA256) of each individual file.
+    # All the hashes are collected first; the DFXML emitted by
+    # FDRI.exe is then streamed once (SAX) and written once.
+    #----------------------------------------------------------------
+    def complete_dfxml(self, dfxml_path, file_list):
+        start_time = time.time()
+        # Should we compute hashes? 
+        do_compute_hashes = C_COMPUTE_HASHES
+
+        #----------------------
+        # Collect file hashes
+        # (taken from the hash cache: the file
+        # is read at most once per run)
+        #----------------------
+        hashes_by_id_D = {}
+        hashes_by_name_D = {}
+        for file in file_list:
+            if not (file.isFile() and file.canRead()):
+                continue
+            if do_compute_hashes:
+                hashes_D = self.hasher.get_hashes(file)
+            else:
+                hashes_D = {"sha1": "0", "sha256": "0", "md5": "0"}
+            hashes_by_id_D[file.getId()] = hashes_D
+            hashes_by_name_D[file.getName().split(".")[0]] = hashes_D
+
+        tmp_path = dfxml_path + ".tmp"
+        with open(tmp_path, "w") as out:
+            handler = DFXMLHashWriter(out, hashes_by_id_D, hashes_by_name_D)
+            xml.sax.parse(dfxml_path, handler)
+
+        # os.rename() doesn't overwrite on Windows
+        os.remove(dfxml_path)
+        os.rename(tmp_path, dfxml_path)
+        if self.metrics is not None:
+            self.metrics.record("dfxml", time.time() - start_time,
+                        os.path.getsize(dfxml_path), items=len(file_list))
+
+        Log_S = "DFXML: hashes added to %d of %d fileobjects" %\
+                                (handler.matched_count, handler.total_count)
+        self.log(Level.INFO, Log_S)
+
+    #----------------------------------------------------------------
+    # Smaller copy of an image (scale: factor per side), in the format
+    # of its extension. Returns (width, height, new width, new height).
+    #----------------------------------------------------------------
+    def downscale_image(self, src_path, dest_path, scale):
+        image = ImageIO.read(File(src_path))
+        if image is None:
+            raise IOError("unsupported image format")
+        width = image.getWidth()
+        height = image.getHeight()
+        new_width = max(1, int(width * scale))
+        new_height = max(1, int(height * scale))
+
+        scaled = BufferedImage(new_width, new_height,
+                                                BufferedImage.TYPE_INT_RGB)
+        graphics = scaled.createGraphics()
+        try:
+            graphics.setRenderingHint(RenderingHints.KEY_INTERPOLATION,
+                                RenderingHints.VALUE_INTERPOLATION_BILINEAR)
+            graphics.drawImage(image, 0, 0, new_width, new_height, None)
+        finally:
+            graphics.dispose()
+
+        write_image(scaled, dest_path)
+        return (width, height, new_width, new_height)
+
+    #----------------------------------------------------------------
+    # Name of the copy of a file: name__id__N.ext. Images found by
+    # their MIME type only get the extension of the type, so that
+    # FDRI.exe takes them.
+    #----------------------------------------------------------------
+    def copy_fname(self, file):
+        filename, file_extension = os.path.splitext(file.getName())
+        if file_extension.lower() not in self.extensions:
+            file_extension = C_MIME_EXTENSIONS.get(file.getMIMEType(),
+                                                            file_extension)
+        return "%s__id__%d%s" % (filename, file.getId(), file_extension)
+
+
+#----------------------------------------------------------------------
+# Hashing engine. Autopsy seems to not provide the hashes we need, so
+# we compute all of them (MD5, SHA1 and SHA256) with a single read of
+# the file's content. The digests are cached by object id until the
+# shard of the file is posted: the dedupe, the manifest and the DFXML
+# stage share them.
+#----------------------------------------------------------------------
+class FileHasher(object):
+
+    def __init__(self, algorithms=C_HASH_ALGORITHMS, metrics=None):
+        self.algorithms = algorithms
+        self.metrics = metrics
+        # object id -> {algorithm: hexdigest}
+        self.cache = {}
+        # Cumulative files, time and bytes spent hashing
+        self.hashed_count = 0
+        self.needed_time = 0.0
+        self.bytes_read = 0
+        # Files may be hashed by several threads
+        self.lock = Lock()
+
+    def get_hashes(self, f_target):
+        file_id = f_target.getId()
+        hashes_D = self.cache.get(file_id)
+        if hashes_D is None:
+            hashes_D = self.compute_hashes(f_target)
+            self.cache[file_id] = hashes_D
+        return hashes_D
+
+    # Digests no longer needed (see post_shard)
+    def evict(self, ids_L):
+        for file_id in ids_L:
+            self.cache.pop(file_id, None)
+
+    def compute_hashes(self, f_target):
+        time_start = time.time()
+
+        hash_creators = [hashlib.new(algorithm)
+                                        for algorithm in self.algorithms]
+
+        inputStream = ReadContentInputStream(f_target)
+        buffer = jarray.zeros(BLOCKSIZE, "b")
+        total_len = 0
+        try:
+            read_len = inputStream.read(buffer)
+            while (read_len != -1):
+                # Last block is usually not full
+                if read_len < BLOCKSIZE:
+                    data = buffer[:read_len]
+                else:
+                    data = buffer
+                for hash_creator in hash_creators:
+                    hash_creator.update(data)
+                total_len = total_len + read_len
+                read_len = inputStream.read(buffer)
+        finally:
+            inputStream.close()
+
+        hashes_D = {}
+        for algorithm, hash_creator in zip(self.algorithms, hash_creators):
+            hashes_D[algorithm] = hash_creator.hexdigest()
+
+        elapsed = time.time() - time_start
+        with self.lock:
+            self.hashed_count += 1
+            self.needed_time = self.needed_time + elapsed
+            self.bytes_read = self.bytes_read + total_len
+        if self.metrics is not None:
+            self.metrics.record("hash", elapsed, total_len, f_target)
+        return hashes_D
+
+    #----------------------------------------------------------------
+    # Copy the file's content to dest_path and compute its hashes with
+    # the same read (the copy is not read back)
+    #----------------------------------------------------------------
+    def copy_and_hash(self, f_target, dest_path):
+        time_start = time.time()
+
+        hash_creators = [hashlib.new(algorithm)
+                                        for algorithm in self.algorithms]
+
+        inputStream = ReadContentInputStream(f_target)
+        outputStream = FileOutputStream(dest_path)
+        buffer = jarray.zeros(BLOCKSIZE, "b")
+        total_len = 0
+        try:
+            read_len = inputStream.read(buffer)
+            while (read_len != -1):
+                outputStream.write(buffer, 0, read_len)
+                # Last block is usually not full
+                if read_len < BLOCKSIZE:
+                    data = buffer[:read_len]
+                else:
+                    data = buffer
+                for hash_creator in hash_creators:
+                    hash_creator.update(data)
+                total_len = total_len + read_len
+                read_len = inputStream.read(buffer)
+        finally:
+            outputStream.close()
+            inputStream.close()
+
+        hashes_D = {}
+        for algorithm, hash_creator in zip(self.algorithms, hash_creators):
+            hashes_D[algorithm] = hash_creator.hexdigest()
+        self.cache[f_target.getId()] = hashes_D
+
+        # Counted as extraction (see ExtractionPool.extract)
+        with self.lock:
+            self.hashed_count += 1
+            self.needed_time = self.needed_time + (time.time() - time_start)
+            self.bytes_read = self.bytes_read + total_len
+        return hashes_D
+
+
+#----------------------------------------------------------------------
+# Buffered reader over the first bytes of a file's content: reads
+# C_SNIFF_CHUNK_SIZE bytes at a time and skips over the bytes not
+# needed. EOFError is raised when the content ends.
+#----------------------------------------------------------------------
+class HeaderInput(object):
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.buffer = jarray.zeros(chunk_size, "b")
+        # Bytes read but not yet consumed
+        self.data = ""
+        # Offset (in the file) of the next byte
+        self.position = 0
+        self.bytes_read = 0
+
+    def read(self, num_bytes):
+        while len(self.data) < num_bytes:
+            read_len = self.stream.read(self.buffer)
+            if read_len == -1:
+                raise EOFError()
+            self.data = self.data + self.buffer[:read_len].tostring()
+            self.bytes_read = self.bytes_read + read_len
+        data = self.data[:num_bytes]
+        self.data = self.data[num_bytes:]
+        self.position = self.position + num_bytes
+        return data
+
+    def skip(self, num_bytes):
+        if num_bytes <= len(self.data):
+            self.data = self.data[num_bytes:]
+        else:
+            left = num_bytes - len(self.data)
+            self.data = ""
+            while left > 0:
+                skipped = self.stream.skip(left)
+                if skipped <= 0:
+                    raise EOFError()
+                left = left - skipped
+        self.position = self.position + num_bytes
+
+
+#----------------------------------------------------------------------
+# Reads the header of JPEG and PNG images (only the first bytes of the
+# file, through the case's content) to get their dimensions without
+# extracting them. Files that are not valid images, or that are smaller
+# than the minimum resolution, are skipped. JPEG segments before the
+# SOF one (EXIF, thumbnails) are skipped over, not read.
+#----------------------------------------------------------------------
+class ImageHeaderSniffer(object):
+
+    PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+    # Start Of Frame markers (all but DHT, JPG and DAC)
+    JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) -\
+                                            frozenset([0xC4, 0xC8, 0xCC])
+    # Markers without a length (TEM, RSTn, SOI)
+    JPEG_STANDALONE_MARKERS = frozenset([0x01] + range(0xD0, 0xD9))
+
+    def __init__(self, min_width, min_height, chunk_size, max_offset):
+        self.min_width = min_width
+        self.min_height = min_height
+        self.chunk_size = chunk_size
+        self.max_offset = max_offset
+        # kind of reason -> number of skipped files
+        self.skipped_D = {}
+        self.skipped_count = 0
+        # Cumulative time and bytes spent reading headers
+        self.files_count = 0
+        self.needed_time = 0.0
+        self.bytes_read = 0
+
+    #----------------------------------------------------------------
+    # Returns (why the file is skipped or None, pixels or None). Valid
+    # images whose dimensions aren't found are processed, as are the
+    # files whose content can't be read (the copy reports it).
+    #----------------------------------------------------------------
+    def check(self, f_target):
+        time_start = time.time()
+        reason_S = None
+        kind_S = None
+        pixels = None
+        try:
+            format_S, width, height = self.read_header(f_target)
+            if width and height:
+                pixels = width * height
+            if width and height and (width < self.min_width or
+                                                height < self.min_height):
+                kind_S = "below %dx%d" % (self.min_width, self.min_height)
+                reason_S = "%s %dx%d %s" % (format_S, width, height, kind_S)
+        except EOFError:
+            kind_S = reason_S = "truncated header"
+        except ValueError, e:
+            kind_S = reason_S = str(e)
+        except Exception:
+            # Unreadable content: the copy reports the error
+            pass
+        self.files_count = self.files_count + 1
+        self.needed_time = self.needed_time + (time.time() - time_start)
+
+        if reason_S is not None:
+            self.skipped_count = self.skipped_count + 1
+            self.skipped_D[kind_S] = self.skipped_D.get(kind_S, 0) + 1
+        return (reason_S, pixels)
+
+    #----------------------------------------------------------------
+    # Returns (format, width, height); width and height are None if not
+    # found. Raises ValueError if the file is not a valid JPEG/PNG image.
+    #----------------------------------------------------------------
+    def read_header(self, f_target):
+        stream = ReadContentInputStream(f_target)
+        header = HeaderInput(stream, self.chunk_size)
+        try:
+            signature = header.read(2)
+            if signature == "\xff\xd8":
+                return self.read_jpeg_header(header)
+            if signature == self.PNG_SIGNATURE[:2] and\
+                            signature + header.read(6) == self.PNG_SIGNATURE:
+                return self.read_png_header(header)
+            raise ValueError("not a JPEG/PNG image")
+        finally:
+            stream.close()
+            self.bytes_read = self.bytes_read + header.bytes_read
+
+    def read_png_header(self, header):
+        # The first chunk is always IHDR: width and height first
+        length, type_S, width, height = struct.unpack(">I4sII",
+                                                            header.read(16))
+        if type_S != "IHDR":
+            raise ValueError("corrupt PNG header")
+        return ("PNG", width, height)
+
+    def read_jpeg_header(self, header):
+        while header.position < self.max_offset:
+            # Bytes between segments are tolerated (decoders do)
+            if header.read(1) != "\xff":
+                continue
+            marker = ord(header.read(1))
+            # Fill bytes
+            while marker == 0xFF:
+                marker = ord(header.read(1))
+            if marker == 0x00 or marker in self.JPEG_STANDALONE_MARKERS:
+                continue
+            # Image data or end of image before any frame header
+            if marker in (0xD9, 0xDA):
+                raise ValueError("corrupt JPEG header")
+            length = struct.unpack(">H", header.read(2))[0]
+            if length < 2:
+                raise ValueError("corrupt JPEG header")
+            if marker in self.JPEG_SOF_MARKERS:
+                precision, height, width = struct.unpack(">BHH",
+                                                            header.read(5))
+                return ("JPEG", width, height)
+            header.skip(length - 2)
+        return ("JPEG", None, None)
+
+#----------------------------------------------------------------------
+# Persistent cache of the descriptors of the wanted faces. Descriptors
+# are keyed by the SHA-256 of the reference image and by a digest of
+# the model files, so they are shared by every data source and every
+# case using the same reference photos, and a new model invalidates
+# them. The digests of the reference images are themselves cached by
+# path, size and modification time.
+#----------------------------------------------------------------------
+class WantedFacesCache(object):
+
+    def __init__(self, cache_path, model_paths_L):
+        self.cache_path = cache_path
+        # path -> [size, mtime, sha256]
+        self.files_D = {}
+        # model key -> {sha256 of the image: descriptors}
+        self.descriptors_D = {}
+        self.load()
+        self.changed = False
+        try:
+            self.model_key = hashlib.sha256("".join([self.file_digest(path)
+                                for path in model_paths_L])).hexdigest()
+        except (IOError, OSError):
+            # Missing model: FDRI.exe will complain, nothing is cached
+            self.model_key = None
+        # Reference images: filename -> sha256
+        self.gallery_D = {}
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "r") as cache_F:
+                content = json.load(cache_F)
+            self.files_D = content["files"]
+            self.descriptors_D = content["descriptors"]
+        except (IOError, ValueError, KeyError):
+            # Corrupted cache: start again
+            self.files_D = {}
+            self.descriptors_D = {}
+
+    def file_digest(self, path):
+        stat = os.stat(path)
+        record_L = self.files_D.get(path)
+        if record_L is not None and record_L[0] == stat.st_size and\
+                                            record_L[1] == stat.st_mtime:
+            return record_L[2]
+
+        hash_creator = hashlib.sha256()
+        with open(path, "rb") as file_F:
+            data = file_F.read(BLOCKSIZE)
+            while data:
+                hash_creator.update(data)
+                data = file_F.read(BLOCKSIZE)
+        digest_S = hash_creator.hexdigest()
+        self.files_D[path] = [stat.st_size, stat.st_mtime, digest_S]
+        self.changed = True
+        return digest_S
+
+    #----------------------------------------------------------------
+    # Digests of the reference images. Returns the number of images
+    # with cached descriptors.
+    #----------------------------------------------------------------
+    def scan(self, folder, extensions_L):
+        self.gallery_D = {}
+        for fname in sorted(os.listdir(folder)):
+            path = os.path.join(folder, fname)
+            if os.path.isfile(path) and\
+                    os.path.splitext(fname)[1].lower() in extensions_L:
+                self.gallery_D[fname] = self.file_digest(path)
+        return len(self.cached_faces())
+
+    def cached_faces(self):
+        cached_D = self.descriptors_D.get(self.model_key, {})
+        faces_D = {}
+        for fname, digest_S in self.gallery_D.iteritems():
+            if digest_S in cached_D:
+                faces_D[fname] = cached_D[digest_S]
+        return faces_D
+
+    # Write the cached descriptors for FDRI.exe
+    def export(self, out_path):
+        with open(out_path, "w") as out:
+            json.dump({"model": self.model_key,
+                       "faces": self.cached_faces()}, out)
+
+    # Add the descriptors computed by FDRI.exe
+    def absorb(self, in_path):
+        try:
+            with open(in_path, "r") as in_F:
+                faces_D = json.load(in_F)["faces"]
+        except (IOError, ValueError, KeyError):
+            return 0
+        cached_D = self.descriptors_D.setdefault(self.model_key, {})
+        count = 0
+        for fname, descriptors_L in faces_D.iteritems():
+            digest_S = self.gallery_D.get(fname)
+            if digest_S is not None and digest_S not in cached_D:
+                cached_D[digest_S] = descriptors_L
+                count += 1
+        if count:
+            self.changed = True
+        return count
+
+    #----------------------------------------------------------------
+    # Save the cache, merged with what other jobs may have saved
+    # meanwhile (the file is replaced atomically)
+    #----------------------------------------------------------------
+    def save(self):
+        if not self.changed:
+            return
+        files_D = self.files_D
+        descriptors_D = self.descriptors_D
+        self.load()
+        self.files_D.update(files_D)
+        for model_key, cached_D in descriptors_D.iteritems():
+            self.descriptors_D.setdefault(model_key, {}).update(cached_D)
+
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as cache_F:
+            json.dump({"files": self.files_D,
+                       "descriptors": self.descriptors_D}, cache_F)
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+        os.rename(tmp_path, self.cache_path)
+        self.changed = False
+
+
+#----------------------------------------------------------------------
+# Runs FDRI.exe and waits for either its end or the cancellation of the
+# job. A waiter thread blocks on the process and sets an event, so the
+# end is noticed at once; cancellation is polled every
+# C_CANCEL_CHECK_SECS. On cancellation the process tree is asked to
+# exit and, after C_EXE_KILL_GRACE_SECS, killed (taskkill /T on
+# Windows, so that no child keeps using the GPU). on_tick() is called
+# at each poll too: if it returns True (the watchdog), the process tree
+# is killed the same way.
+#----------------------------------------------------------------------
+class ExeSupervisor(object):
+
+    def __init__(self, is_cancelled, log, grace_secs=C_EXE_KILL_GRACE_SECS,
+                                                                on_tick=None):
+        self.is_cancelled = is_cancelled
+        self.log = log
+        self.grace_secs = grace_secs
+        self.on_tick = on_tick
+        self.process = None
+        self.exited = Event()
+        self.cancelled = False
+        self.stalled = False
+
+    # Returns the exit status of the process
+    def run(self, args_L):
+        self.process = subprocess.Popen(args_L)
+        waiter = Thread(target=self.wait_exit)
+        waiter.setDaemon(True)
+        waiter.start()
+
+        while not self.exited.wait(C_CANCEL_CHECK_SECS):
+            if self.is_cancelled():
+                self.cancelled = True
+                self.kill_tree()
+                break
+            if self.on_tick is not None and self.on_tick():
+                self.stalled = True
+                self.kill_tree()
+                break
+        self.exited.wait()
+        return self.process.returncode
+
+    def wait_exit(self):
+        try:
+            self.process.wait()
+        finally:
+            self.exited.set()
+
+    def is_windows(self):
+        # Under Jython os.name is "java"
+        return getattr(os, "_name", os.name) == "nt"
+
+    def kill_tree(self):
+        pid = getattr(self.process, "pid", None)
+        self.log(Level.INFO, "Terminating FDRI.exe (pid %s) and its children",
+                                                                    str(pid))
+        # Ask first...
+        try:
+            if self.is_windows() and pid:
+                subprocess.call(["taskkill", "/PID", str(pid), "/T"])
+            else:
+                self.process.terminate()
+        except OSError, e:
+            self.log(Level.WARNING, "Error terminating FDRI.exe: %s", str(e))
+        if self.exited.wait(self.grace_secs):
+            return
+
+        # ... then kill
+        self.log(Level.WARNING, "FDRI.exe didn't exit in %d secs: killing it",
+                                                            self.grace_secs)
+        try:
+            if self.is_windows() and pid:
+                subprocess.call(["taskkill", "/PID", str(pid), "/T", "/F"])
+            else:
+                self.process.kill()
+        except OSError, e:
+            self.log(Level.SEVERE, "Error killing FDRI.exe: %s", str(e))
+
+
+#----------------------------------------------------------------------
+# Detector backends (new_detector_backend() picks one by name). Each
+# concrete backend has detect(shard): it runs over the images of the
+# shard (shard.dir_img), writes the result files of FDRI.exe into the
+# shard's workspace and sets shard.return_code. report() logs (and
+# writes into the run's workspace) whatever the backend measured; by
+# default there is nothing to report.
+#----------------------------------------------------------------------
+class DetectorBackend(object):
+
+    name = None
+
+    def report(self, workspace):
+        pass
+
+
+# FDRI.exe (MMOD CNN on the GPU): one run, or one batch of the resident
+# service, per shard
+class FDRIExeBackend(DetectorBackend):
+
+    name = "fdri"
+
+    def __init__(self, run_fdri):
+        self.run_fdri = run_fdri
+
+    def detect(self, shard):
+        self.run_fdri(shard)
+
+
+#----------------------------------------------------------------------
+# Cheap-first cascade: a CPU pre-pass scores every image, and only the
+# images scoring at least the threshold go to the next backend
+# (FDRI.exe); the others are archived at once, as processed (no faces).
+# Without a next backend the images that pass are the result
+# (C_PREPASS_FOUND_FNAME). In calibration mode every image goes to the
+# next backend, and the report compares its results with what each
+# threshold would have skipped.
+#----------------------------------------------------------------------
+class CascadeBackend(DetectorBackend):
+
+    def __init__(self, prepass, threshold, dir_img_done, next_backend,
+                                                            calibrate, log):
+        self.prepass = prepass
+        self.threshold = threshold
+        self.dir_img_done = dir_img_done
+        self.next_backend = next_backend
+        self.calibrate = calibrate and next_backend is not None
+        self.log = log
+        if next_backend is None:
+            self.name = "prepass"
+        else:
+            self.name = "cascade (%s)" % (next_backend.name)
+        # (image, score, has faces or None), for the report
+        self.scores_L = []
+        self.skipped_count = 0
+        self.errors_count = 0
+        self.next_time = 0.0
+        self.next_images_count = 0
+
+    def detect(self, shard):
+        scores_L = []
+        for fname in sorted(os.listdir(shard.dir_img)):
+            path = os.path.join(shard.dir_img, fname)
+            if not os.path.isfile(path):
+                continue
+            try:
+                score = self.prepass.score(path)
+            except Exception, e:
+                # Can't be scored: the next backend decides
+                self.errors_count += 1
+                self.log(Level.FINE, "Pre-pass: '%s' not scored: %s",
+                                                            fname, str(e))
+                score = None
+            scores_L.append((fname, score))
+
+        passed_L = [fname for fname, score in scores_L
+                                if score is None or score >= self.threshold]
+        if self.next_backend is None:
+            if not os.path.exists(shard.workspace):
+                os.mkdir(shard.workspace)
+            with open(os.path.join(shard.workspace,
+                                C_PREPASS_FOUND_FNAME), "w") as found_F:
+                for fname in passed_L:
+                    found_F.write(os.path.join(shard.dir_img, fname) + "\n")
+            shard.return_code = 0
+            self.skipped_count += len(scores_L) - len(passed_L)
+            self.scores_L.extend([(fname, score, None)
+                                            for fname, score in scores_L])
+            return
+
+        if not self.calibrate:
+            # Processed: no faces
+            passed_S = set(passed_L)
+            if not os.path.exists(self.dir_img_done):
+                os.mkdir(self.dir_img_done)
+            for fname, score in scores_L:
+                if fname not in passed_S:
+                    dest_path = os.path.join(self.dir_img_done, fname)
+                    if os.path.exists(dest_path):
+                        os.remove(dest_path)
+                    os.rename(os.path.join(shard.dir_img, fname), dest_path)
+                    self.skipped_count += 1
+            if not passed_L:
+                shard.return_code = 0
+                self.scores_L.extend([(fname, score, False)
+                                            for fname, score in scores_L])
+                return
+
+        self.next_backend.detect(shard)
+        self.next_time += shard.detect_time
+        if self.calibrate:
+            self.next_images_count += len(scores_L)
+        else:
+            self.next_images_count += len(passed_L)
+
+        # Images with faces, according to the next backend
+        faces_S = set()
+        faces_path = os.path.join(shard.workspace, C_FACES_FOUND_FNAME)
+        if os.path.exists(faces_path):
+            with open(faces_path, "r") as faces_F:
+                for line in faces_F:
+                    faces_S.add(os.path.basename(line.strip()))
+        self.scores_L.extend([(fname, score, fname in faces_S)
+                                            for fname, score in scores_L])
+
+    def report(self, workspace):
+        scored_L = [score for fname, score, has_faces in self.scores_L
+                                                        if score is not None]
+        prepass_secs = self.prepass.needed_time
+        Log_S = "Pre-pass: %d images scored in %f secs (%f secs/image), "\
+                "%d not scored, %d skipped (threshold %g)" %\
+                (len(scored_L), prepass_secs,
+                prepass_secs / max(1, len(scored_L)), self.errors_count,
+                self.skipped_count, self.threshold)
+        if self.next_images_count:
+            Log_S = Log_S + "; %s: %f secs/image" % (self.next_backend.name,
+                            self.next_time / self.next_images_count)
+        self.log(Level.INFO, Log_S)
+        if not self.calibrate or not self.scores_L:
+            return
+
+        # The next backend saw every image: its results are the truth
+        report_path = os.path.join(workspace, C_PREPASS_REPORT_FNAME)
+        write_prepass_report(report_path, self.scores_L, prepass_secs,
+                    self.next_backend.name, C_PREPASS_REPORT_THRESHOLDS,
+                    self.next_time / max(1, self.next_images_count))
+        self.log(Level.INFO, "Pre-pass calibration report: '%s'",
+                                                                report_path)
+
+
+#----------------------------------------------------------------------
+# Accuracy and throughput of each threshold of the pre-pass. scores_L:
+# (image, score or None, has faces) with the truth given by truth_S
+# (e.g. FDRI.exe); next_secs: time per image of the backend that runs
+# after the pre-pass (None: not known, no time estimate).
+#----------------------------------------------------------------------
+def write_prepass_report(report_path, scores_L, prepass_secs, truth_S,
+                                            thresholds_L, next_secs=None):
+    images_count = len(scores_L)
+    scored_count = len([1 for fname, score, has_faces in scores_L
+                                                    if score is not None])
+    faces_count = len([1 for fname, score, has_faces in scores_L
+                                                            if has_faces])
+    with open(report_path, "w") as report_F:
+        report_F.write(C_SEP_S)
+        report_F.write("# Pre-pass calibration: %d images, %d with faces"\
+                                " (%s)\n" % (images_count, faces_count, truth_S))
+        times_S = "# Pre-pass: %f secs/image" % (prepass_secs /
+                                                    max(1, scored_count))
+        if next_secs is not None:
+            times_S = times_S + "; %s: %f secs/image" % (truth_S, next_secs)
+        report_F.write(times_S + "\n")
+        report_F.write(C_SEP_S)
+        header_S = "threshold\tskipped\tskipped%\tmissed\trecall"
+        if next_secs is not None:
+            header_S = header_S + "\test.secs"
+        report_F.write(header_S + "\n")
+        for threshold in thresholds_L:
+            skipped_count = 0
+            missed_count = 0
+            for fname, score, has_faces in scores_L:
+                if score is not None and score < threshold:
+                    skipped_count += 1
+                    if has_faces:
+                        missed_count += 1
+            if faces_count:
+                recall = 1.0 - float(missed_count) / faces_count
+            else:
+                recall = 1.0
+            row_S = "%g\t%d\t%.1f\t%d\t%.3f" % (threshold, skipped_count,
+                        100.0 * skipped_count / max(1, images_count),
+                        missed_count, recall)
+            # Estimated time: pre-pass of every image plus the next
+            # backend over the images that pass
+            if next_secs is not None:
+                row_S = row_S + "\t%.1f" % (prepass_secs +
+                                (images_count - skipped_count) * next_secs)
+            report_F.write(row_S + "\n")
+        report_F.write(C_SEP_S)
+        report_F.write("# image\tscore\tfaces\n")
+        for fname, score, has_faces in sorted(scores_L):
+            if score is None:
+                score_S = "-"
+            else:
+                score_S = "%g" % (score)
+            report_F.write("%s\t%s\t%d\n" % (fname, score_S,
+                                                            bool(has_faces)))
+
+
+#----------------------------------------------------------------------
+# CPU pre-pass: Haar frontal face detector of OpenCV (Viola-Jones), run
+# over a greyscale copy of the image reduced to detect_side (the decoder
+# subsamples the image while reading it, so the full image is never in
+# memory). The raw detections are grouped as detectMultiScale does with
+# minNeighbors, and the score of an image is the number of neighbours
+# of its best face (0: no face). Raises ImportError/IOError if OpenCV
+# or the cascade can't be loaded.
+#----------------------------------------------------------------------
+class HaarFacePrepass(object):
+
+    # Smallest face (pixels, at detect_side), scale step and grouping
+    # tolerance of the detections (OpenCV's defaults)
+    MIN_FACE_SIDE = 24
+    SCALE_FACTOR = 1.1
+    GROUP_EPS = 0.2
+
+    def __init__(self, cascade_path, detect_side):
+        load_opencv()
+        from org.opencv.core import CvType, Mat, MatOfRect, Size
+        from org.opencv.imgproc import Imgproc
+        from org.opencv.objdetect import CascadeClassifier
+        self.CvType = CvType
+        self.Mat = Mat
+        self.MatOfRect = MatOfRect
+        self.Size = Size
+        self.Imgproc = Imgproc
+        if not os.path.isfile(cascade_path):
+            raise IOError("no cascade file '%s'" % (cascade_path))
+        self.classifier = CascadeClassifier(cascade_path)
+        if self.classifier.empty():
+            raise IOError("bad cascade file '%s'" % (cascade_path))
+        self.detect_side = detect_side
+        self.needed_time = 0.0
+
+    def score(self, path):
+        time_start = time.time()
+        try:
+            detections = self.MatOfRect()
+            self.classifier.detectMultiScale(self.read_grey(path),
+                        detections, self.SCALE_FACTOR, 0, 0,
+                        self.Size(self.MIN_FACE_SIDE, self.MIN_FACE_SIDE),
+                        self.Size())
+            return self.best_neighbours([(rect.x, rect.y, rect.width,
+                        rect.height) for rect in detections.toArray()])
+        finally:
+            self.needed_time += time.time() - time_start
+
+    # Greyscale copy (at most detect_side), equalized, as a Mat
+    def read_grey(self, path):
+        image, width, height = read_subsampled(path, self.detect_side)
+        scale = min(1.0, float(self.detect_side) /
+                                    max(image.getWidth(), image.getHeight()))
+        grey_width = max(1, int(round(image.getWidth() * scale)))
+        grey_height = max(1, int(round(image.getHeight() * scale)))
+        grey = BufferedImage(grey_width, grey_height,
+                                                BufferedImage.TYPE_BYTE_GRAY)
+        graphics = grey.createGraphics()
+        try:
+            graphics.setRenderingHint(RenderingHints.KEY_INTERPOLATION,
+                                RenderingHints.VALUE_INTERPOLATION_BILINEAR)
+            graphics.drawImage(image, 0, 0, grey_width, grey_height, None)
+        finally:
+            graphics.dispose()
+        mat = self.Mat(grey_height, grey_width, self.CvType.CV_8UC1)
+        mat.put(0, 0, grey.getRaster().getDataBuffer().getData())
+        self.Imgproc.equalizeHist(mat, mat)
+        return mat
+
+    #----------------------------------------------------------------
+    # Groups the raw detections (x, y, width, height) into faces, as
+    # OpenCV's groupRectangles: two detections are neighbours if their
+    # sides are within GROUP_EPS of their size. Returns the neighbours
+    # of the largest group (its size - 1), 0 without detections.
+    #----------------------------------------------------------------
+    def best_neighbours(self, rects_L):
+        if not rects_L:
+            return 0
+        parents_L = range(len(rects_L))
+
+        def find(i):
+            while parents_L[i] != i:
+                parents_L[i] = parents_L[parents_L[i]]
+                i = parents_L[i]
+            return i
+
+        for i, (x1, y1, w1, h1) in enumerate(rects_L):
+            for j in range(i):
+                x2, y2, w2, h2 = rects_L[j]
+                delta = self.GROUP_EPS * (min(w1, w2) + min(h1, h2)) * 0.5
+                if abs(x1 - x2) <= delta and abs(y1 - y2) <= delta and\
+                        abs(x1 + w1 - x2 - w2) <= delta and\
+                        abs(y1 + h1 - y2 - h2) <= delta:
+                    parents_L[find(i)] = find(j)
+        sizes_D = {}
+        for i in range(len(rects_L)):
+            root = find(i)
+            sizes_D[root] = sizes_D.get(root, 0) + 1
+        return max(sizes_D.values()) - 1
+
+
+# Haar cascade of the pre-pass (see C_PREPASS_CASCADE_FNAME)
+def prepass_cascade_path():
+    return os.path.join(os.path.dirname(GLOBAL_CONFIGURATION_PATH),
+                                                    C_PREPASS_CASCADE_FNAME)
+
+
+#----------------------------------------------------------------------
+# Native library of OpenCV: loaded by Autopsy (OpenCvLoader, whose name
+# of the check changed across versions) or, outside Autopsy, from the
+# java.library.path. Raises ImportError if it can't be loaded.
+#----------------------------------------------------------------------
+def load_opencv():
+    try:
+        from org.sleuthkit.autopsy.coreutils import OpenCvLoader
+    except ImportError:
+        OpenCvLoader = None
+    for method_S in ("openCvIsLoaded", "isOpenCvLoaded"):
+        if OpenCvLoader is not None and hasattr(OpenCvLoader, method_S):
+            if not getattr(OpenCvLoader, method_S)():
+                raise ImportError("OpenCV not loaded by Autopsy")
+            return
+    from java.lang import UnsatisfiedLinkError
+    from org.opencv.core import Core
+    try:
+        System.loadLibrary(Core.NATIVE_LIBRARY_NAME)
+    except UnsatisfiedLinkError, e:
+        raise ImportError(str(e))
+
+
+#----------------------------------------------------------------------
+# Decode an image subsampled by the largest whole factor that keeps its
+# longest side at least max_side: the decoder drops the pixels while
+# reading, so that the full image is never in memory. Returns (image,
+# original width, original height).
+#----------------------------------------------------------------------
+def read_subsampled(path, max_side):
+    stream = ImageIO.createImageInputStream(File(path))
+    if stream is None:
+        raise IOError("can't be read")
+    try:
+        readers = ImageIO.getImageReaders(stream)
+        if not readers.hasNext():
+            raise ValueError("unsupported image format")
+        reader = readers.next()
+        try:
+            reader.setInput(stream, True, True)
+            width = reader.getWidth(0)
+            height = reader.getHeight(0)
+            step = max(1, max(width, height) // max_side)
+            param = reader.getDefaultReadParam()
+            param.setSourceSubsampling(step, step, 0, 0)
+            image = reader.read(0, param)
+        finally:
+            reader.dispose()
+    finally:
+        stream.close()
+    return (image, width, height)
+
+
+#----------------------------------------------------------------------
+# Reduced copy of an image whose longest side is larger than max_side:
+# subsampled while decoding, then scaled (bilinear) to max_side. Returns
+# the scale (reduced/original) and the original's size, or None if the
+# image is small enough.
+#----------------------------------------------------------------------
+def reduce_image(src_path, dest_path, max_side):
+    image, width, height = read_subsampled(src_path, max_side)
+    if max(width, height) <= max_side:
+        return None
+    scale = float(max_side) / max(width, height)
+    new_width = max(1, int(round(width * scale)))
+    new_height = max(1, int(round(height * scale)))
+    if image.getWidth() != new_width or image.getHeight() != new_height:
+        scaled = BufferedImage(new_width, new_height,
+                                                BufferedImage.TYPE_INT_RGB)
+        graphics = scaled.createGraphics()
+        try:
+            graphics.setRenderingHint(RenderingHints.KEY_INTERPOLATION,
+                                RenderingHints.VALUE_INTERPOLATION_BILINEAR)
+            graphics.drawImage(image, 0, 0, new_width, new_height, None)
+        finally:
+            graphics.dispose()
+        image = scaled
+
+    write_image(image, dest_path)
+    return {"scale": scale, "width": width, "height": height}
+
+
+# Annotated copy of an image: the face boxes drawn on it
+def annotate_image(src_path, dest_path, boxes_L):
+    image = ImageIO.read(File(src_path))
+    if image is None:
+        raise IOError("unsupported image format")
+    annotated = BufferedImage(image.getWidth(), image.getHeight(),
+                                                BufferedImage.TYPE_INT_RGB)
+    graphics = annotated.createGraphics()
+    try:
+        graphics.drawImage(image, 0, 0, None)
+        graphics.setColor(C_ANNOTATION_COLOR)
+        graphics.setStroke(BasicStroke(C_ANNOTATION_STROKE))
+        for left, top, right, bottom in boxes_L:
+            graphics.drawRect(left, top, right - left, bottom - top)
+    finally:
+        graphics.dispose()
+    write_image(annotated, dest_path)
+
+
+# Write an image in the format of the extension of its path
+def write_image(image, dest_path):
+    if dest_path.lower().endswith(".png"):
+        format_S = "png"
+    else:
+        format_S = "jpg"
+    if not ImageIO.write(image, format_S, File(dest_path)):
+        raise IOError("no %s writer" % (format_S))
+
+
+#----------------------------------------------------------------------
+# Client of the resident FDRI.exe (started with --serve --port N): the
+# models stay loaded across shards, data sources and jobs. The protocol
+# is JSON, one object per line, over a local TCP connection per batch:
+#   -> {"cmd": "run", "params": <params.json>, "min": N, "max": N}
+#   <- {"event": "start", "images": N}
+#   <- {"event": "begin", "file": <name>}
+#   <- {"event": "image", "file": <name>, "faces": N}   (streamed)
+#   <- {"event": "log", "message": <text>}
+#   <- {"event": "done", "return_code": N}
+#   -> {"cmd": "cancel"}       (the user cancelled the job, or stalled)
+# The results are written to the batch's workspace, as by FDRI.exe.
+# The start, begin and image events go to the ProgressStream of the
+# batch, as the progress_out file of FDRI.exe.
+#----------------------------------------------------------------------
+class DetectorService(object):
+
+    def __init__(self, host, port, log):
+        self.host = host
+        self.port = port
+        self.log = log
+        # Service started by this client (None: it was already running)
+        self.process = None
+        self.batches_count = 0
+        self.images_count = 0
+
+    def connect(self, timeout=C_CANCEL_CHECK_SECS):
+        try:
+            return socket.create_connection((self.host, self.port), timeout)
+        except socket.error:
+            return None
+
+    #----------------------------------------------------------------
+    # Reuse the running service or start one. Returns False if there
+    # is no service (an FDRI.exe without --serve exits at once)
+    #----------------------------------------------------------------
+    def ensure_started(self, exe_path, start_secs, idle_secs):
+        sock = self.connect()
+        if sock is not None:
+            sock.close()
+            self.log(Level.INFO, "Detector service: reusing %s:%d",
+                                                        self.host, self.port)
+            return True
+
+        try:
+            self.process = subprocess.Popen([exe_path, "--serve", "--port",
+                    str(self.port), "--idle-timeout", str(idle_secs)])
+        except OSError, e:
+            self.log(Level.WARNING, "Detector service not started: %s",
+                                                                    str(e))
+            return False
+
+        deadline = time.time() + start_secs
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                self.log(Level.WARNING, "Detector service: FDRI.exe exited "\
+                        "(status %s), running it once per shard",
+                        str(self.process.returncode))
+                return False
+            sock = self.connect()
+            if sock is not None:
+                sock.close()
+                self.log(Level.INFO, "Detector service started (pid %s, "\
+                        "port %d)", str(self.process.pid), self.port)
+                return True
+            time.sleep(C_CANCEL_CHECK_SECS)
+
+        self.log(Level.WARNING, "Detector service didn't answer in %d secs",
+                                                                start_secs)
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        return False
+
+    # A service started by this client that is stuck (see the watchdog)
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+        except OSError, e:
+            self.log(Level.WARNING, "Error killing the detector service: %s",
+                                                                    str(e))
+
+    #----------------------------------------------------------------
+    # Run a batch. Returns the exit status of the batch, None if the
+    # user cancelled the job, or C_EXE_STALLED_CODE if the watchdog of
+    # the progress stops it. Raises IOError if the service is lost.
+    #----------------------------------------------------------------
+    def run(self, params_path, min_size, max_size, is_cancelled,
+                                                            progress=None):
+        sock = self.connect()
+        if sock is None:
+            raise IOError("no answer from %s:%d" % (self.host, self.port))
+        try:
+            request_D = {"cmd": "run", "params": params_path,
+                                            "min": min_size, "max": max_size}
+            sock.sendall(json.dumps(request_D) + "\n")
+            self.batches_count += 1
+
+            data_S = ""
+            while True:
+                cancelled = is_cancelled()
+                stalled = not cancelled and progress is not None and\
+                                                    progress.check_stall()
+                if cancelled or stalled:
+                    try:
+                        sock.sendall(json.dumps({"cmd": "cancel"}) + "\n")
+                    except socket.error:
+                        pass
+                    if stalled:
+                        return C_EXE_STALLED_CODE
+                    return None
+                try:
+                    chunk_S = sock.recv(BLOCKSIZE)
+                except socket.timeout:
+                    continue
+                if not chunk_S:
+                    raise IOError("connection closed by the service")
+                data_S = data_S + chunk_S
+                while "\n" in data_S:
+                    line_S, data_S = data_S.split("\n", 1)
+                    event_D = json.loads(line_S)
+                    event_S = event_D.get("event")
+                    if event_S in ("start", "begin", "image") and\
+                                                    progress is not None:
+                        progress.feed(event_D)
+                    if event_S == "image":
+                        if event_D.get("faces"):
+                            self.images_count += 1
+                    elif event_S == "log":
+                        self.log(Level.INFO, "Detector service: %s",
+                                                    event_D.get("message"))
+                    elif event_S == "done":
+                        return event_D.get("return_code", 0)
+        finally:
+            sock.close()
+
+
+#----------------------------------------------------------------------
+# Progress bar of the job. Until all the images are copied the bar is
+# indeterminate (the total is unknown); it is then determinate, in
+# images. Images are done as FDRI.exe reports them (ProgressStream) and,
+# for the images it doesn't report (older versions, images skipped by
+# the pre-pass), when their shard ends. The throughput is measured over
+# the last rate_secs and gives the ETA.
+#----------------------------------------------------------------------
+class ProgressMonitor(object):
+
+    def __init__(self, progress_bar, update_secs=C_PROGRESS_UPDATE_SECS,
+                                            rate_secs=C_PROGRESS_RATE_SECS):
+        self.progress_bar = progress_bar
+        self.update_secs = update_secs
+        self.rate_secs = rate_secs
+        # Images to detect (None: still copying)
+        self.total = None
+        self.done = 0
+        self.faces = 0
+        # Images of the shard being detected, and those already done
+        self.shard_images = 0
+        self.shard_done_S = set()
+        self.stalled_S = None
+        self.start_time = None
+        # Set by the first progress event of the run: FDRI.exe sends them
+        self.streaming = False
+        # (time, images done), over the last rate_secs
+        self.samples_L = []
+        self.last_update = 0.0
+        self.lock = Lock()
+
+    def begin_shard(self, num_images):
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+            self.shard_images = num_images
+            self.shard_done_S = set()
+        self.update()
+
+    # An image reported by FDRI.exe (the images of a shard are only
+    # counted once, even if it is run again: OOM recovery, watchdog)
+    def image_done(self, fname_S, faces):
+        with self.lock:
+            if fname_S not in self.shard_done_S and\
+                                len(self.shard_done_S) < self.shard_images:
+                self.shard_done_S.add(fname_S)
+                self.done += 1
+                if faces:
+                    self.faces += 1
+            self.stalled_S = None
+        self.update()
+
+    def end_shard(self):
+        with self.lock:
+            self.done += self.shard_images - len(self.shard_done_S)
+            self.shard_images = 0
+            self.shard_done_S = set()
+        self.update(True)
+
+    def set_total(self, total):
+        with self.lock:
+            self.total = total
+            self.progress_bar.switchToDeterminate(max(total, 1))
+        self.update(True)
+
+    def stalled(self, fname_S):
+        with self.lock:
+            self.stalled_S = fname_S
+        self.update(True)
+
+    # Images per second over the last rate_secs
+    def rate(self, now):
+        self.samples_L.append((now, self.done))
+        while len(self.samples_L) > 2 and\
+                                now - self.samples_L[1][0] >= self.rate_secs:
+            del self.samples_L[0]
+        first_time, first_done = self.samples_L[0]
+        if now - first_time <= 0:
+            return 0.0
+        return (self.done - first_done) / (now - first_time)
+
+    def update(self, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_update < self.update_secs:
+                return
+            self.last_update = now
+            rate = self.rate(now)
+            if self.total is None:
+                msg_S = "Copying images; faces detected in %d images of "\
+                        "%d, %.1f images/s" % (self.faces, self.done, rate)
+            else:
+                msg_S = "Detecting faces: %d of %d images (%d with faces)"\
+                        ", %.1f images/s" % (self.done, self.total,
+                                                        self.faces, rate)
+                if rate > 0 and self.done < self.total:
+                    msg_S = msg_S + ", ETA %s" % (format_secs(
+                                        (self.total - self.done) / rate))
+            if self.stalled_S is not None:
+                msg_S = msg_S + " - no progress on '%s'" % (self.stalled_S)
+            if self.total is None:
+                self.progress_bar.progress(msg_S)
+            else:
+                self.progress_bar.progress(msg_S, min(self.done, self.total))
+
+    # Images and rate of the whole detection, for the log
+    def summary(self):
+        with self.lock:
+            secs = 0.0
+            if self.start_time is not None:
+                secs = time.time() - self.start_time
+            rate = self.done / secs if secs > 0 else 0.0
+            return "%d images (%d with faces) in %s, %.1f images/s" %\
+                        (self.done, self.faces, format_secs(secs), rate)
+
+
+# Seconds as h:mm:ss
+def format_secs(secs):
+    secs = int(secs)
+    return "%d:%02d:%02d" % (secs // 3600, (secs // 60) % 60, secs % 60)
+
+
+#----------------------------------------------------------------------
+# Progress of one run of FDRI.exe (or batch of the service) and its
+# watchdog. FDRI.exe appends to the "progress_out" file of params.json
+# (the service streams them instead) one JSON object per line:
+#   {"event": "start", "images": N}        (models loaded)
+#   {"event": "begin", "file": <name>}     (before decoding an image)
+#   {"event": "image", "file": <name>, "faces": N}
+# read() reads the lines added since the last call (poll(): and checks
+# for a stall, while FDRI.exe runs). check_stall() is
+# True once FDRI.exe must be killed: no event for kill_secs, since the
+# first one. stalled_S is then the image being processed (None: not
+# known, FDRI.exe doesn't send "begin"). Before the first event (models
+# being loaded) FDRI.exe is killed after start_secs, once an earlier
+# shard has shown that it sends events (versions that don't are only
+# warned about).
+#----------------------------------------------------------------------
+class ProgressStream(object):
+
+    def __init__(self, path, monitor, shard, stalled_path, log,
+                                    warn_secs=C_STALL_WARN_SECS,
+                                    kill_secs=C_STALL_KILL_SECS,
+                                    start_secs=C_STALL_START_SECS):
+        self.path = path
+        self.monitor = monitor
+        self.shard = shard
+        self.stalled_path = stalled_path
+        self.log = log
+        self.warn_secs = warn_secs
+        self.kill_secs = kill_secs
+        self.start_secs = start_secs
+        self.start_time = time.time()
+        self.offset = 0
+        self.partial_S = ""
+        # Time of the last event (None: none yet) and current image
+        self.last_event_time = None
+        self.current_S = None
+        self.warned = False
+        self.stalled_S = None
+        self.images_count = 0
+        # Left by a previous run over the same shard
+        if os.path.exists(path):
+            os.remove(path)
+
+    def poll(self):
+        self.read()
+        return self.check_stall()
+
+    def read(self):
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as progress_F:
+                progress_F.seek(self.offset)
+                data_S = progress_F.read()
+            self.offset += len(data_S)
+            lines_L = (self.partial_S + data_S).split("\n")
+            # The last line may be incomplete
+            self.partial_S = lines_L.pop()
+            for line_S in lines_L:
+                if not line_S.strip():
+                    continue
+                try:
+                    self.feed(json.loads(line_S))
+                except ValueError:
+                    self.log(Level.FINE, "Progress: bad line '%s'", line_S)
+
+    def feed(self, event_D):
+        self.last_event_time = time.time()
+        self.warned = False
+        self.monitor.streaming = True
+        event_S = event_D.get("event")
+        if event_S == "begin":
+            self.current_S = event_D.get("file")
+        elif event_S == "image":
+            self.current_S = None
+            self.images_count += 1
+            self.monitor.image_done(event_D.get("file"),
+                                                    event_D.get("faces"))
+        elif event_S == "start":
+            self.log(Level.FINE, "Shard %d: FDRI.exe started over %s "\
+                    "images", self.shard.index, str(event_D.get("images")))
+
+    def check_stall(self):
+        if self.last_event_time is None:
+            return self.check_start()
+        stall_secs = time.time() - self.last_event_time
+        if stall_secs >= self.warn_secs and not self.warned:
+            self.warned = True
+            self.record("no progress for %d secs" % (stall_secs))
+            self.monitor.stalled(self.current_S or "?")
+        if self.kill_secs > 0 and stall_secs >= self.kill_secs:
+            self.stalled_S = self.current_S
+            self.record("killed after %d secs without progress" %\
+                                                            (stall_secs))
+            return True
+        self.monitor.update()
+        return False
+
+    # No event yet: FDRI.exe may be stuck loading the models
+    def check_start(self):
+        start_secs = time.time() - self.start_time
+        if start_secs < self.start_secs:
+            return False
+        if not self.warned:
+            self.warned = True
+            self.record("no progress for %d secs since its start" %\
+                                                                (start_secs))
+        if self.kill_secs > 0 and self.monitor.streaming:
+            self.stalled_S = None
+            self.record("killed after %d secs while loading the models" %\
+                                                                (start_secs))
+            return True
+        return False
+
+    # Stalls go to the log and to C_STALLED_FNAME
+    def record(self, msg_S):
+        image_S = self.current_S
+        if image_S is None:
+            image_S = "(unknown image, %d done)" % (self.images_count)
+        self.log(Level.WARNING, "Shard %d: FDRI.exe %s on '%s'",
+                                        self.shard.index, msg_S, image_S)
+        timestamp_S = datetime.now().strftime('%Y-%m-%d_%Hh%Mm%Ss')
+        try:
+            with open(self.stalled_path, "a") as stalled_F:
+                stalled_F.write("%s shard %d: %s: %s\n" % (timestamp_S,
+                                        self.shard.index, image_S, msg_S))
+        except (IOError, OSError), e:
+            self.log(Level.WARNING, "Error writing '%s': %s",
+                                                self.stalled_path, str(e))
+
+
+#----------------------------------------------------------------------
+# Aggregates a per-file log message: each file is logged at FINE level
+# and a summary (count and some filenames) is logged at INFO level every
+# C_LOG_SUMMARY_SECS seconds and when log_summary() is called. Messages
+# are logged on behalf of the method that created the summary.
+#----------------------------------------------------------------------
+class LogSummary(object):
+
+    def __init__(self, log_as, title_S, interval=C_LOG_SUMMARY_SECS,
+                                    max_examples=C_LOG_SUMMARY_EXAMPLES):
+        self.log_as = log_as
+        self.method_S = sys._getframe(1).f_code.co_name
+        self.title_S = title_S
+        self.interval = interval
+        self.max_examples = max_examples
+        self.total_count = 0
+        self.count = 0
+        self.examples_L = []
+        self.last_time = time.time()
+
+    def add(self, fname_S, size=None):
+        if size is None:
+            self.log_as(self.method_S, Level.FINE, "%s: '%s'", self.title_S,
+                                                                    fname_S)
+        else:
+            self.log_as(self.method_S, Level.FINE, "%s: '%s' (%d bytes)",
+                                                self.title_S, fname_S, size)
+        self.total_count += 1
+        self.count += 1
+        if len(self.examples_L) < self.max_examples:
+            self.examples_L.append(fname_S)
+        if time.time() - self.last_time >= self.interval:
+            self.log_summary()
+
+    def log_summary(self):
+        if self.count:
+            if self.count > len(self.examples_L):
+                more_S = ", ..."
+            else:
+                more_S = ""
+            self.log_as(self.method_S, Level.INFO,
+                    "%s: %d files (%d in total): %s%s",
+                    self.title_S, self.count, self.total_count,
+                    ", ".join(self.examples_L), more_S)
+        self.count = 0
+        self.examples_L = []
+        self.last_time = time.time()
+
+
+#----------------------------------------------------------------------
+# Instrumentation of a run: time, bytes and items of each stage
+# (enumerate, header, extract, hash, detect, post, dfxml), per file
+# and in total, with a histogram of the throughput of each call
+# (MB/s, or items/s for stages without bytes), the depth of the queues
+# between the stages and the time blocked on them, and the exit codes
+# of FDRI.exe. Detection and posting work on shards: their time is
+# shared among the files of the shard. Stages run in several threads.
+#----------------------------------------------------------------------
+class RunMetrics(object):
+
+    # Upper bounds of the histogram buckets (MB/s or items/s)
+    C_HISTOGRAM_BOUNDS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+    # Columns of the per-file CSV
+    C_FILE_FIELDS = ("file_id", "name", "size", "shard", "extract_mode",
+                    "extract_secs", "extract_bytes", "hash_secs",
+                    "hash_bytes", "detect_secs", "post_secs")
+
+    def __init__(self, per_file=True):
+        self.per_file = per_file
+        self.start_time = time.time()
+        self.lock = Lock()
+        # stage -> {"calls", "items", "secs", "bytes", "histogram"}
+        self.stages_D = {}
+        # stage -> elapsed (wall clock) secs, when known
+        self.wall_D = {}
+        # queue -> {"puts", "max_depth", "depth_sum", "put_wait_secs"}
+        # (producer side) and {"gets", "get_wait_secs"} (consumer side)
+        self.queues_D = {}
+        self.exit_codes_D = {}
+        self.shards_L = []
+        # file id -> row of C_FILE_FIELDS
+        self.files_D = {}
+
+    def stage(self, stage_S):
+        stage_D = self.stages_D.get(stage_S)
+        if stage_D is None:
+            stage_D = {"calls": 0, "items": 0, "secs": 0.0, "bytes": 0,
+                "histogram": [0] * (len(self.C_HISTOGRAM_BOUNDS) + 1)}
+            self.stages_D[stage_S] = stage_D
+        return stage_D
+
+    def histogram_index(self, rate):
+        for i, bound in enumerate(self.C_HISTOGRAM_BOUNDS):
+            if rate < bound:
+                return i
+        return len(self.C_HISTOGRAM_BOUNDS)
+
+    #----------------------------------------------------------------
+    # A call of a stage: secs, bytes and items (of the given file, if
+    # any; mode_S tells how the file was extracted)
+    #----------------------------------------------------------------
+    def record(self, stage_S, secs, num_bytes=0, file=None, mode_S=None,
+                                                                items=1):
+        with self.lock:
+            stage_D = self.stage(stage_S)
+            stage_D["calls"] += 1
+            stage_D["items"] += items
+            stage_D["secs"] += secs
+            stage_D["bytes"] += num_bytes
+            if secs > 0 and (num_bytes or items):
+                if num_bytes:
+                    rate = num_bytes / 1048576.0 / secs
+                else:
+                    rate = items / secs
+                stage_D["histogram"][self.histogram_index(rate)] += 1
+
+            row_L = None
+            if file is not None and self.per_file:
+                row_L = self.files_D.get(file.getId())
+            if row_L is not None:
+                if stage_S == "extract":
+                    row_L[4] = mode_S
+                    row_L[5] += secs
+                    row_L[6] += num_bytes
+                elif stage_S == "hash":
+                    row_L[7] += secs
+                    row_L[8] += num_bytes
+
+    # A shard went through detection or posting
+    def record_shard(self, stage_S, shard, secs):
+        num_files = len(shard.copied_ids_L)
+        self.record(stage_S, secs, items=num_files)
+        with self.lock:
+            if self.per_file and num_files:
+                column = {"detect": 9, "post": 10}[stage_S]
+                for file_id in shard.copied_ids_L:
+                    row_L = self.files_D.get(file_id)
+                    if row_L is not None:
+                        row_L[column] += secs / num_files
+            if stage_S == "post":
+                self.shards_L.append({"index": shard.index,
+                    "dir": os.path.basename(shard.dir_img),
+                    "bucket": str(shard.bucket) if shard.bucket else None,
+                    "images": num_files, "return_code": shard.return_code,
+                    "detect_secs": shard.detect_time,
+                    "post_secs": shard.post_time})
+
+    def add_file(self, file, shard=None):
+        if not self.per_file:
+            return
+        if shard is None:
+            shard_index = None
+        else:
+            shard_index = shard.index
+        with self.lock:
+            self.files_D[file.getId()] = [file.getId(), file.getName(),
+                        file.getSize(), shard_index, None, 0.0, 0, 0.0, 0,
+                                                                0.0, 0.0]
+
+    def add_wall(self, stage_S, secs):
+        with self.lock:
+            self.wall_D[stage_S] = self.wall_D.get(stage_S, 0.0) + secs
+
+    def exit_code(self, return_code):
+        with self.lock:
+            key_S = str(return_code)
+            self.exit_codes_D[key_S] = self.exit_codes_D.get(key_S, 0) + 1
+
+    def queue_put(self, queue_S, item_queue, item):
+        depth = item_queue.qsize()
+        start_time = time.time()
+        item_queue.put(item)
+        with self.lock:
+            queue_D = self.queues_D.setdefault(queue_S, {})
+            queue_D["puts"] = queue_D.get("puts", 0) + 1
+            queue_D["depth_sum"] = queue_D.get("depth_sum", 0) + depth
+            queue_D["max_depth"] = max(queue_D.get("max_depth", 0), depth)
+            queue_D["put_wait_secs"] = queue_D.get("put_wait_secs", 0.0) +\
+                                                (time.time() - start_time)
+
+    def queue_get(self, queue_S, item_queue):
+        start_time = time.time()
+        item = item_queue.get()
+        with self.lock:
+            queue_D = self.queues_D.setdefault(queue_S, {})
+            queue_D["gets"] = queue_D.get("gets", 0) + 1
+            queue_D["get_wait_secs"] = queue_D.get("get_wait_secs", 0.0) +\
+                                                (time.time() - start_time)
+        return item
+
+    # One line: busy time (and rate) of the main stages, slowest first
+    def summary(self):
+        with self.lock:
+            busy_L = sorted([(stage_D["secs"], stage_S)
+                    for stage_S, stage_D in self.stages_D.items()
+                    if stage_S in ("extract", "hash", "detect", "post")],
+                    reverse=True)
+            parts_L = []
+            for secs, stage_S in busy_L:
+                stage_D = self.stages_D[stage_S]
+                if stage_D["bytes"] and secs:
+                    rate_S = "%.1f MB/s" % (stage_D["bytes"] / 1048576.0 /
+                                                                    secs)
+                elif secs:
+                    rate_S = "%.1f files/s" % (stage_D["items"] / secs)
+                else:
+                    rate_S = "-"
+                parts_L.append("%s %.1f secs (%s)" % (stage_S, secs,
+                                                                    rate_S))
+        if not parts_L:
+            return "no stage recorded"
+        return "busy: " + ", ".join(parts_L) + "; slowest: " + busy_L[0][1]
+
+    #----------------------------------------------------------------
+    # C_METRICS_FNAME (JSON) and C_METRICS_FILES_FNAME (CSV) in the
+    # workspace
+    #----------------------------------------------------------------
+    def write(self, workspace, state_S):
+        with self.lock:
+            # Histogram: [upper bound (None: no bound), count] pairs
+            bounds_L = list(self.C_HISTOGRAM_BOUNDS) + [None]
+            stages_D = {}
+            for stage_S, stage_D in self.stages_D.items():
+                stage_D = dict(stage_D)
+                stage_D["histogram"] = [list(pair) for pair in
+                                    zip(bounds_L, stage_D["histogram"])]
+                if stage_D["secs"]:
+                    stage_D["items_per_sec"] = stage_D["items"] /\
+                                                            stage_D["secs"]
+                    stage_D["mb_per_sec"] = stage_D["bytes"] / 1048576.0 /\
+                                                            stage_D["secs"]
+                if stage_S in self.wall_D:
+                    stage_D["wall_secs"] = self.wall_D[stage_S]
+                stages_D[stage_S] = stage_D
+            metrics_D = {
+                "state": state_S,
+                "elapsed_secs": time.time() - self.start_time,
+                "stages": stages_D,
+                "queues": self.queues_D,
+                "exit_codes": self.exit_codes_D,
+                "shards": sorted(self.shards_L,
+                        key=lambda shard_D: (shard_D["index"], shard_D["dir"])),
+                "files": len(self.files_D),
+            }
+            with open(os.path.join(workspace, C_METRICS_FNAME), "w") as out:
+                json.dump(metrics_D, out, indent=1, sort_keys=True)
+
+            if not self.per_file:
+                return
+            with open(os.path.join(workspace, C_METRICS_FILES_FNAME),
+                                                                "wb") as out:
+                writer = csv.writer(out)
+                writer.writerow(self.C_FILE_FIELDS)
+                for file_id in sorted(self.files_D):
+                    row_L = list(self.files_D[file_id])
+                    for i in (5, 7, 9, 10):
+                        row_L[i] = "%.6f" % (row_L[i])
+                    if isinstance(row_L[1], unicode):
+                        row_L[1] = row_L[1].encode("utf-8")
+                    writer.writerow(["" if value is None else value
+                                                        for value in row_L])
+
+
+#----------------------------------------------------------------------
+# Writes the results to the blackboard in batches. Files that already
+# have an artifact are found with one case DB query per set, or for the
+# data source (instead of a query per file). With Sleuth Kit 4.11 and
+# later the artifacts of a batch are created in a single case DB
+# transaction. New artifacts are indexed for keyword search and
+# announced with a single ModuleDataEvent per batch; with the case
+# Blackboard's postArtifacts a batch is indexed and announced in one
+# call. Derived files are added with the batch.
+#----------------------------------------------------------------------
+class BlackboardWriter(object):
+
+    def __init__(self, case, blackboard, artifact_type, data_source_id,
+                                                        batch_size, log):
+        self.case = case
+        self.blackboard = blackboard
+        self.artifact_type = artifact_type
+        self.data_source_id = data_source_id
+        self.batch_size = max(1, batch_size)
+        self.log = log
+        # Blackboard of the case DB (org.sleuthkit.datamodel, not the
+        # services one): postArtifacts, artifacts of a data source and,
+        # from Sleuth Kit 4.11, artifacts created in a transaction
+        try:
+            from org.sleuthkit.datamodel import Blackboard as CaseBlackboard
+            self.case_blackboard = case.getBlackboard()
+            self.case_blackboard_exception =\
+                                            CaseBlackboard.BlackboardException
+        except (ImportError, AttributeError):
+            self.case_blackboard = None
+        self.result_score = None
+        if hasattr(self.case_blackboard, "newAnalysisResult"):
+            from org.sleuthkit.datamodel import Score
+            self.result_type = BlackboardArtifact.Type(artifact_type)
+            self.result_score = Score.SCORE_LIKELY_NOTABLE
+        # Set name (None: any set) -> ids of the files with an artifact
+        # (None: query failed, files are checked one by one)
+        self.existing_D = {}
+        # (file, set name) of the artifacts of the batch
+        self.pending_L = []
+        self.derived_L = []
+        self.artifacts_count = 0
+        self.derived_count = 0
+        self.batches_count = 0
+
+    def existing_ids(self, set_name_S):
+        if set_name_S in self.existing_D:
+            return self.existing_D[set_name_S]
+        try:
+            if set_name_S is not None:
+                artifacts_L = self.case.getBlackboardArtifacts(
+                    BlackboardAttribute.ATTRIBUTE_TYPE.TSK_SET_NAME,
+                                                                set_name_S)
+            elif hasattr(self.case_blackboard, "getArtifacts"):
+                # Only the artifacts of this data source
+                artifacts_L = self.case_blackboard.getArtifacts(
+                        self.artifact_type.getTypeID(), self.data_source_id)
+            else:
+                # Older Sleuth Kit: no query by data source, files are
+                # checked one by one rather than loading the whole case
+                artifacts_L = None
+            if artifacts_L is None:
+                ids_S = None
+            else:
+                ids_S = set([art.getObjectID() for art in artifacts_L])
+                # Artifacts of the batch are not in the case DB yet
+                ids_S.update([file.getId()
+                    for file, pending_set_name_S in self.pending_L
+                        if set_name_S in (None, pending_set_name_S)])
+        except TskCoreException, e:
+            self.log(Level.WARNING, "Error getting artifacts: " + str(e))
+            ids_S = None
+        self.existing_D[set_name_S] = ids_S
+        return ids_S
+
+    def has_artifact(self, file, set_name_S=None):
+        ids_S = self.existing_ids(set_name_S)
+        if ids_S is not None:
+            return file.getId() in ids_S
+
+        artifacts_L = file.getArtifacts(self.artifact_type)
+        if set_name_S is not None:
+            artifacts_L = [art for art in artifacts_L
+                        if set_name_S in [att.getValueString()
+                                            for att in art.getAttributes()]]
+        if len(artifacts_L) > 0:
+            return True
+        # Artifacts of the batch are not in the case DB yet
+        return any([pending.getId() == file.getId() and
+                                    set_name_S in (None, pending_set_name_S)
+                            for pending, pending_set_name_S in self.pending_L])
+
+    def add_artifact(self, file, set_name_S):
+        for key in (None, set_name_S):
+            ids_S = self.existing_D.get(key)
+            if ids_S is not None:
+                ids_S.add(file.getId())
+
+        self.pending_L.append((file, set_name_S))
+        if len(self.pending_L) >= self.batch_size:
+            self.commit()
+
+    # Annotated image of parent_file (path relative to the case)
+    def add_derived_file(self, label_S, temp_path, size, parent_file):
+        self.derived_L.append((label_S, temp_path, size, parent_file))
+
+    def set_name_attribute(self, set_name_S):
+        return BlackboardAttribute(
+                BlackboardAttribute.ATTRIBUTE_TYPE.TSK_SET_NAME.getTypeID(),
+                FDRIModuleFactory.moduleName, set_name_S)
+
+    #----------------------------------------------------------------
+    # Creates the artifacts of the batch: in one case DB transaction
+    # (rolled back as a whole on error) when the case Blackboard can
+    # create analysis results, otherwise one by one (older Sleuth Kit
+    # has no transaction for artifacts). Returns the artifacts created.
+    #----------------------------------------------------------------
+    def create_artifacts(self, pending_L):
+        if self.result_score is None:
+            artifacts_L = []
+            for file, set_name_S in pending_L:
+                try:
+                    art = file.newArtifact(self.artifact_type)
+                    art.addAttribute(self.set_name_attribute(set_name_S))
+                    artifacts_L.append(art)
+                except TskCoreException, e:
+                    self.log(Level.SEVERE, "Error adding artifact to '%s': "
+                                        "%s" % (file.getName(), str(e)))
+                    self.forget(file, set_name_S)
+            return artifacts_L
+
+        artifacts_L = []
+        transaction = self.case.beginTransaction()
+        try:
+            for file, set_name_S in pending_L:
+                artifacts_L.append(self.case_blackboard.newAnalysisResult(
+                        self.result_type, file.getId(),
+                        self.data_source_id, self.result_score,
+                        None, set_name_S, None,
+                        [self.set_name_attribute(set_name_S)],
+                        transaction).getAnalysisResult())
+            transaction.commit()
+        except (TskCoreException, self.case_blackboard_exception), e:
+            self.log(Level.SEVERE, "Error adding %d artifacts: %s" %\
+                                                    (len(pending_L), str(e)))
+            try:
+                transaction.rollback()
+            except TskCoreException, e:
+                self.log(Level.SEVERE, "Error rolling back: " + str(e))
+            for file, set_name_S in pending_L:
+                self.forget(file, set_name_S)
+            return []
+        return artifacts_L
+
+    # The artifact of file wasn't created: no longer counted as existing
+    def forget(self, file, set_name_S):
+        for key in (None, set_name_S):
+            ids_S = self.existing_D.get(key)
+            if ids_S is not None:
+                ids_S.discard(file.getId())
+
+    def commit(self):
+        # https://sleuthkit.org/autopsy/docs/api-docs/4.4/classorg_1_1sleuthkit_1_1autopsy_1_1casemodule_1_1services_1_1_file_manager.html
+        for label_S, temp_path, size, parent_file in self.derived_L:
+            try:
+                self.case.addDerivedFile(label_S, temp_path,
+                        size, 0, 0, 0, 0, True, parent_file,
+                        "", FDRIModuleFactory.moduleName,
+                        FDRIModuleFactory.moduleVersion,
+                        "Image with faces",
+                        TskData.EncodingType.NONE)
+                self.derived_count += 1
+            except TskCoreException, e:
+                self.log(Level.SEVERE, "Error adding derived file '%s': %s"\
+                                                    % (label_S, str(e)))
+        self.derived_L = []
+
+        if not self.pending_L:
+            return
+        pending_L = self.pending_L
+        self.pending_L = []
+        artifacts_L = self.create_artifacts(pending_L)
+        if not artifacts_L:
+            return
+        if hasattr(self.case_blackboard, "postArtifacts"):
+            try:
+                self.case_blackboard.postArtifacts(artifacts_L,
+                                            FDRIModuleFactory.moduleName)
+            except self.case_blackboard_exception, e:
+                self.log(Level.SEVERE, "Error posting %d artifacts: %s" %\
+                                                (len(artifacts_L), str(e)))
+        else:
+            for art in artifacts_L:
+                try:
+                    # index the artifact for keyword search
+                    self.blackboard.indexArtifact(art)
+                except Blackboard.BlackboardException, e:
+                    self.log(Level.SEVERE,
+                     "Error indexing artifact " + art.getDisplayName())
+            IngestServices.getInstance().fireModuleDataEvent(
+                ModuleDataEvent(FDRIModuleFactory.moduleName,
+                                            self.artifact_type, artifacts_L))
+        self.artifacts_count += len(artifacts_L)
+        self.batches_count += 1
+
+
+#----------------------------------------------------------------------
+# On-disk index of face descriptors, shared by all cases. Each
+# partition is a pair of files: the descriptors (float32, little
+# endian, C_FACE_DESCRIPTOR_DIM per face) and their metadata (one tab
+# separated line per face: case, data source, file name, object id).
+# Searches memory-map the descriptors (java.nio), a window of
+# C_FACE_INDEX_CHUNK faces at a time. With partitions, the faces wait
+# in a staging partition until train_faces per partition are indexed:
+# the centroids are then built by k-means over them, and each face
+# goes to the partition of its nearest centroid. A search only reads
+# the partitions nearest to each wanted face (and the staging one).
+#----------------------------------------------------------------------
+class FaceIndex(object):
+
+    # Partition of the faces added before the centroids exist
+    STAGING = -1
+
+    def __init__(self, index_dir, dim=C_FACE_DESCRIPTOR_DIM,
+                            num_partitions=C_FACE_INDEX_PARTITIONS,
+                            train_faces=C_FACE_INDEX_TRAIN_FACES,
+                            kmeans_passes=C_FACE_INDEX_KMEANS_PASSES):
+        self.index_dir = index_dir
+        if not os.path.exists(index_dir):
+            os.mkdir(index_dir)
+
+        # The layout of an existing index wins
+        info_path = os.path.join(index_dir, "index.json")
+        if os.path.exists(info_path):
+            with open(info_path, "r") as info_F:
+                info_D = json.load(info_F)
+        else:
+            info_D = {"dim": dim, "partitions": num_partitions}
+            with open(info_path, "w") as info_F:
+                json.dump(info_D, info_F)
+        self.dim = info_D["dim"]
+        self.num_partitions = info_D["partitions"]
+        self.train_faces = train_faces
+        self.kmeans_passes = kmeans_passes
+
+        self.centroids_path = os.path.join(index_dir, "centroids.f32")
+        self.centroids = self.read_vectors(self.centroids_path)
+        # Partition -> (descriptors, metadata lines) not yet written
+        self.pending_D = {}
+        # Images already indexed (case, data source, object id)
+        self.keys_S = None
+        self.searched_count = 0
+
+    def vectors_path(self, partition):
+        if partition == self.STAGING:
+            return os.path.join(self.index_dir, "staging.f32")
+        return os.path.join(self.index_dir, "part_%04d.f32" % (partition))
+
+    def meta_path(self, partition):
+        if partition == self.STAGING:
+            return os.path.join(self.index_dir, "staging.tsv")
+        return os.path.join(self.index_dir, "part_%04d.tsv" % (partition))
+
+    def read_vectors(self, path):
+        vectors = array("f")
+        if os.path.exists(path):
+            with open(path, "rb") as vectors_F:
+                try:
+                    vectors.fromfile(vectors_F,
+                                        os.path.getsize(path) // 4)
+                except EOFError:
+                    pass
+            if sys.byteorder == "big":
+                vectors.byteswap()
+        return vectors
+
+    def write_vectors(self, path, vectors, mode_S):
+        vectors = array("f", vectors)
+        if sys.byteorder == "big":
+            vectors.byteswap()
+        with open(path, mode_S) as vectors_F:
+            vectors.tofile(vectors_F)
+
+    def num_centroids(self):
+        return len(self.centroids) // self.dim
+
+    # Partitions nearest to the vector (the staging one until the
+    # centroids exist)
+    def nearest_partitions(self, vector, count):
+        if self.num_partitions <= 0:
+            return [0]
+        if not self.num_centroids():
+            return [self.STAGING]
+        return nearest_vectors(vector, self.centroids, self.dim, count)
+
+    def load_keys(self):
+        self.keys_S = set()
+        for name in os.listdir(self.index_dir):
+            if not name.endswith(".tsv"):
+                continue
+            with open(os.path.join(self.index_dir, name), "r") as meta_F:
+                for line in meta_F:
+                    fields_L = line.rstrip("\n").split("\t")
+                    if len(fields_L) == 4:
+                        self.keys_S.add((fields_L[0], fields_L[1],
+                                                            fields_L[3]))
+
+    #----------------------------------------------------------------
+    # Add the descriptors of the faces of an image. Returns False if
+    # the image was already indexed.
+    #----------------------------------------------------------------
+    def add_image(self, descriptors_L, case_name_S, ds_name_S, file_id,
+                                                                fname_S):
+        if self.keys_S is None:
+            self.load_keys()
+        fields_L = [field_S.replace("\t", " ").replace("\n", " ")
+                                for field_S in (case_name_S, ds_name_S,
+                                                    fname_S, str(file_id))]
+        key = (fields_L[0], fields_L[1], fields_L[3])
+        if key in self.keys_S:
+            return False
+        self.keys_S.add(key)
+
+        meta_S = "\t".join(fields_L) + "\n"
+        for descriptor_L in descriptors_L:
+            if len(descriptor_L) != self.dim:
+                continue
+            vector = array("f", descriptor_L)
+            partition = self.nearest_partitions(vector, 1)[0]
+            vectors, lines_L = self.pending_D.setdefault(partition,
+                                                        (array("f"), []))
+            vectors.extend(vector)
+            lines_L.append(meta_S)
+        return True
+
+    # Drop the descriptors without metadata (interrupted flush).
+    # Returns the number of faces of the partition.
+    def align(self, partition):
+        vectors_path = self.vectors_path(partition)
+        if not os.path.exists(vectors_path):
+            return 0
+        num_lines = 0
+        if os.path.exists(self.meta_path(partition)):
+            with open(self.meta_path(partition), "r") as meta_F:
+                for line in meta_F:
+                    num_lines += 1
+        size = num_lines * self.dim * 4
+        if os.path.getsize(vectors_path) > size:
+            with open(vectors_path, "r+b") as vectors_F:
+                vectors_F.truncate(size)
+        return min(num_lines, os.path.getsize(vectors_path) // (self.dim * 4))
+
+    def flush(self):
+        self.write_pending(self.pending_D)
+        self.pending_D = {}
+        if self.num_partitions > 0 and not self.num_centroids() and\
+                        self.align(self.STAGING) >=\
+                                self.num_partitions * self.train_faces:
+            self.train()
+
+    def write_pending(self, pending_D):
+        for partition, (vectors, lines_L) in pending_D.iteritems():
+            self.align(partition)
+            # Descriptors first: a line of metadata always has its
+            # descriptor (searches ignore descriptors without one)
+            self.write_vectors(self.vectors_path(partition), vectors, "ab")
+            with open(self.meta_path(partition), "a") as meta_F:
+                meta_F.writelines(lines_L)
+
+    #----------------------------------------------------------------
+    # Centroids of the partitions: k-means over a sample of the staged
+    # faces (the first centroids are faces spread over it), which then
+    # go to their partitions. The centroids are written first: if the run is
+    # interrupted, the staged faces are still searched.
+    #----------------------------------------------------------------
+    def train(self):
+        dim = self.dim
+        vectors = self.read_vectors(self.vectors_path(self.STAGING))
+        with open(self.meta_path(self.STAGING), "r") as meta_F:
+            lines_L = meta_F.readlines()
+        count = min(len(lines_L), len(vectors) // dim)
+        vectors_L = [vectors[i * dim:(i + 1) * dim] for i in xrange(count)]
+        # Sample of train_faces per partition
+        step = max(1, count // (self.num_partitions * self.train_faces))
+        sample_L = vectors_L[::step]
+        num_centroids = min(self.num_partitions, len(sample_L))
+        centroids_L = [sample_L[i * len(sample_L) // num_centroids]
+                                        for i in xrange(num_centroids)]
+        for kmeans_pass in xrange(self.kmeans_passes):
+            sums_L = [[0.0] * dim for centroid in centroids_L]
+            counts_L = [0] * num_centroids
+            centroids = array("f")
+            for centroid in centroids_L:
+                centroids.extend(centroid)
+            for vector in sample_L:
+                nearest = nearest_vectors(vector, centroids, dim, 1)[0]
+                sum_L = sums_L[nearest]
+                for j in xrange(dim):
+                    sum_L[j] += vector[j]
+                counts_L[nearest] += 1
+            # An empty partition keeps its centroid
+            for i in xrange(num_centroids):
+                if counts_L[i]:
+                    centroids_L[i] = array("f", [total / counts_L[i]
+                                                    for total in sums_L[i]])
+
+        self.centroids = array("f")
+        for centroid in centroids_L:
+            self.centroids.extend(centroid)
+        self.write_vectors(self.centroids_path, self.centroids, "wb")
+
+        pending_D = {}
+        for i in xrange(count):
+            partition = self.nearest_partitions(vectors_L[i], 1)[0]
+            part_vectors, part_lines_L = pending_D.setdefault(partition,
+                                                        (array("f"), []))
+            part_vectors.extend(vectors_L[i])
+            part_lines_L.append(lines_L[i])
+        self.write_pending(pending_D)
+        os.remove(self.meta_path(self.STAGING))
+        os.remove(self.vectors_path(self.STAGING))
+
+    #----------------------------------------------------------------
+    # Faces within threshold of any wanted face (wanted_D: image ->
+    # descriptors). Returns (distance, wanted image, metadata fields)
+    # per matching face, nearest first.
+    #----------------------------------------------------------------
+    def search(self, wanted_D, threshold, probes):
+        # Partition -> wanted faces to compare with it
+        queries_D = {}
+        for wanted_fname in sorted(wanted_D):
+            for descriptor_L in wanted_D[wanted_fname]:
+                if len(descriptor_L) != self.dim:
+                    continue
+                vector = array("f", descriptor_L)
+                partitions_L = self.nearest_partitions(vector, probes)
+                # Left by an interrupted training
+                if self.STAGING not in partitions_L:
+                    partitions_L.append(self.STAGING)
+                for partition in partitions_L:
+                    queries_D.setdefault(partition, []).append(
+                                                    (wanted_fname, vector))
+
+        self.searched_count = 0
+        matches_L = []
+        for partition in sorted(queries_D):
+            rows_D = self.scan(partition, queries_D[partition],
+                                                    threshold * threshold)
+            for row, meta_L in self.read_meta(partition, rows_D):
+                distance_sq, wanted_fname = rows_D[row]
+                matches_L.append((distance_sq ** 0.5, wanted_fname, meta_L))
+        matches_L.sort()
+        return matches_L
+
+    #----------------------------------------------------------------
+    # Returns row -> (squared distance, wanted image) of the best match.
+    # The descriptors are memory-mapped a window at a time (no 2 GB
+    # limit of a single mapping) and copied in bulk into a Java float
+    # array, so the loop reads no Python objects. A comparison stops
+    # once the threshold is exceeded, which is where most of them end
+    # for faces of other people.
+    #----------------------------------------------------------------
+    def scan(self, partition, queries_L, threshold_sq):
+        rows_D = {}
+        path = self.vectors_path(partition)
+        if not os.path.exists(path):
+            return rows_D
+        dim = self.dim
+        count = os.path.getsize(path) // (dim * 4)
+        window = jarray.zeros(C_FACE_INDEX_CHUNK * dim, "f")
+        vectors_F = RandomAccessFile(path, "r")
+        try:
+            channel = vectors_F.getChannel()
+            row = 0
+            while row < count:
+                window_count = min(C_FACE_INDEX_CHUNK, count - row)
+                buffer = channel.map(FileChannel.MapMode.READ_ONLY,
+                                row * dim * 4, window_count * dim * 4)
+                buffer.order(ByteOrder.LITTLE_ENDIAN).asFloatBuffer().get(
+                                            window, 0, window_count * dim)
+                for i in xrange(window_count):
+                    base = i * dim
+                    for wanted_fname, query in queries_L:
+                        # Early exit as soon as the threshold is exceeded
+                        distance_sq = 0.0
+                        for j in xrange(dim):
+                            d = window[base + j] - query[j]
+                            distance_sq += d * d
+                            if distance_sq > threshold_sq:
+                                break
+                        else:
+                            best = rows_D.get(row + i)
+                            if best is None or distance_sq < best[0]:
+                                rows_D[row + i] = (distance_sq, wanted_fname)
+                row += window_count
+        finally:
+            vectors_F.close()
+        self.searched_count += count
+        return rows_D
+
+    # Metadata of the given rows, streamed from the partition's file
+    def read_meta(self, partition, rows_D):
+        if not rows_D:
+            return
+        last_row = max(rows_D)
+        with open(self.meta_path(partition), "r") as meta_F:
+            for row, line in enumerate(meta_F):
+                if row in rows_D:
+                    yield row, line.rstrip("\n").split("\t")
+                if row >= last_row:
+                    break
+
+
+# Indices of the count vectors (dim floats each, in vectors) nearest
+# to the vector, nearest first
+def nearest_vectors(vector, vectors, dim, count):
+    distances_L = []
+    for i in xrange(len(vectors) // dim):
+        base = i * dim
+        distance_sq = 0.0
+        for j in xrange(dim):
+            d = vectors[base + j] - vector[j]
+            distance_sq += d * d
+        distances_L.append((distance_sq, i))
+    distances_L.sort()
+    return [i for distance_sq, i in distances_L[:count]]
+
+
+#----------------------------------------------------------------------
+# A shard is a batch of images processed by one call of FDRI.exe, with
+# its own images dir and workspace. The main thread adds files to it
+# and seals it once full; the copied event is set when the workers
+# have copied all its files.
+#----------------------------------------------------------------------
+class Shard(object):
+
+    def __init__(self, index, dir_img, workspace, bucket=None):
+        self.index = index
+        self.dir_img = dir_img
+        self.workspace = workspace
+        # Resolution bucket of the images (None: any size)
+        self.bucket = bucket
+        self.num_files = 0
+        # Files copied into dir_img (not duplicates, nor errors)
+        self.copied_ids_L = []
+        self.return_code = None
+        self.detect_time = 0.0
+        self.post_time = 0.0
+        # Images given downscaled to FDRI.exe: name -> (original path,
+        # scale, original width, original height)
+        self.scales_D = {}
+        # Image on which the watchdog killed FDRI.exe (None: unknown)
+        self.stalled_fname = None
+        # Files put aside by the watchdog (see recover_stall)
+        self.stalled_ids_L = []
+        self.copied = Event()
+        self.pending = 0
+        self.sealed = False
+        self.lock = Lock()
+
+    def add_pending(self):
+        with self.lock:
+            self.num_files += 1
+            self.pending += 1
+
+    def file_done(self, copied_id=None):
+        with self.lock:
+            if copied_id is not None:
+                self.copied_ids_L.append(copied_id)
+            self.pending -= 1
+            self.check_copied()
+
+    def seal(self):
+        with self.lock:
+            self.sealed = True
+            self.check_copied()
+
+    def check_copied(self):
+        if self.sealed and not self.pending:
+            self.copied_ids_L.sort()
+            self.copied.set()
+
+
+#----------------------------------------------------------------------
+# Resolution buckets of the images, given the GPU memory: the images
+# of a bucket are processed by the same FDRI.exe calls, bounded by
+# --min/--max, with as many images per batch as the GPU memory allows
+# (one for the largest ones). Images of unknown size (no header read)
+# are not bucketed. Without GPU memory there is a single bucket (None).
+#----------------------------------------------------------------------
+class ResolutionBucket(object):
+
+    def __init__(self, index, min_pixels, max_pixels, batch_size):
+        self.index = index
+        # Images with min_pixels < pixels <= max_pixels (0: no bound)
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.batch_size = batch_size
+
+    def __str__(self):
+        if self.max_pixels:
+            return "%d-%d px x%d" % (self.min_pixels, self.max_pixels,
+                                                        self.batch_size)
+        return "> %d px x%d" % (self.min_pixels, self.batch_size)
+
+
+class ResolutionBuckets(object):
+
+    def __init__(self, gpu_memory_mb, gpu_max_pixels_L, bounds_L,
+                                                            max_batch_size):
+        self.buckets_L = []
+        self.max_pixels = 0
+        self.enabled = gpu_memory_mb > 0
+        if not self.enabled:
+            return
+
+        # Largest image handled by the GPU memory (scaled down below
+        # the smallest known amount of memory)
+        memory_mb, max_pixels = gpu_max_pixels_L[0]
+        self.max_pixels = max_pixels * gpu_memory_mb // memory_mb
+        for memory_mb, max_pixels in gpu_max_pixels_L:
+            if gpu_memory_mb >= memory_mb:
+                self.max_pixels = max_pixels
+
+        min_pixels = 0
+        for bound in sorted(bounds_L) + [self.max_pixels]:
+            if min_pixels < bound <= self.max_pixels:
+                batch_size = max(1, min(max_batch_size,
+                                                self.max_pixels // bound))
+                self.buckets_L.append(ResolutionBucket(len(self.buckets_L),
+                                        min_pixels, bound, batch_size))
+                min_pixels = bound
+        # Too large for the GPU: one at a time
+        self.buckets_L.append(ResolutionBucket(len(self.buckets_L),
+                                                    self.max_pixels, 0, 1))
+
+    def find(self, pixels):
+        if not self.enabled or pixels is None:
+            return None
+        for bucket in self.buckets_L:
+            if not bucket.max_pixels or pixels <= bucket.max_pixels:
+                return bucket
+
+
+#----------------------------------------------------------------------
+# Pool of threads that extract files and hash them: local files are
+# hard linked, the others are copied and hashed with a single read.
+# Work is handed over through a bounded queue, so the enumeration never
+# gets too far ahead of the copies. Errors are kept per file and
+# returned sorted by sequence number.
+#----------------------------------------------------------------------
+class ExtractionPool(object):
+
+    def __init__(self, hasher, num_workers, queue_size, manifest=None,
+                                    link_local_files=False, metrics=None):
+        self.hasher = hasher
+        self.manifest = manifest
+        self.link_local_files = link_local_files
+        self.metrics = metrics
+        self.queue = Queue(queue_size)
+        self.errors_L = []
+        # Files hard linked and files copied (reused copies not counted)
+        self.linked_count = 0
+        self.copied_count = 0
+        # Deduplication: MD5 -> claim of its representative file and
+        # representative id -> ids of its duplicates (not copied). The
+        # MD5s are claimed in submission order: each dedupe job gets a
+        # ticket and waits for its turn (see claim())
+        self.claims_D = {}
+        self.duplicates_D = {}
+        self.duplicates_count = 0
+        self.lock = Lock()
+        self.claim_cond = Condition(self.lock)
+        self.claim_tickets = 0
+        self.claim_turn = 0
+        self.workers_L = []
+        for i in range(max(1, num_workers)):
+            worker = Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers_L.append(worker)
+
+    #----------------------------------------------------------------
+    # With dedupe, the file is hashed first and only copied if it is
+    # the first file submitted with its MD5 (or if the copies of the
+    # files submitted before with that MD5 failed).
+    # reuse_path is a copy left by a previous run: it is moved to
+    # dest_path instead of copying the file again.
+    # The shard (if any) is told when the file is done.
+    #----------------------------------------------------------------
+    def submit(self, seq_num, file, dest_path, do_hash, dedupe=False,
+                                            reuse_path=None, shard=None):
+        if shard is not None:
+            shard.add_pending()
+        if self.metrics is not None:
+            self.metrics.add_file(file, shard)
+        ticket = None
+        if dedupe:
+            ticket = self.claim_tickets
+            self.claim_tickets += 1
+        # Blocks while the queue is full
+        job = (seq_num, file, dest_path, do_hash, ticket, reuse_path, shard)
+        if self.metrics is not None:
+            self.metrics.queue_put("extract", self.queue, job)
+        else:
+            self.queue.put(job)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            seq_num, file, dest_path, do_hash, ticket, reuse_path, shard =\
+                                                                        job
+            copied_id = None
+            # Claim of the MD5 held by this file (dedupe)
+            claim = None
+            try:
+                reuse_copy = reuse_path is not None and\
+                                                os.path.exists(reuse_path)
+                if ticket is not None:
+                    claim = self.claim(ticket, file)
+                    if claim.file_id != file.getId():
+                        claim = self.wait_representative(claim, file)
+                    if claim is None:
+                        # A copy left by a previous run is not needed
+                        if reuse_copy:
+                            os.remove(reuse_path)
+                        self.record(file, IngestManifest.DUPLICATE)
+                        continue
+                if not reuse_copy:
+                    self.extract(file, dest_path, do_hash)
+                elif reuse_path != dest_path:
+                    os.rename(reuse_path, dest_path)
+                if do_hash:
+                    self.hasher.get_hashes(file)
+                self.record(file, IngestManifest.EXTRACTED, dest_path)
+                # Small file (no shard): its MD5 is in the manifest
+                if shard is None:
+                    self.hasher.evict([file.getId()])
+                copied_id = file.getId()
+                if claim is not None:
+                    self.decide(claim, True)
+            except Exception, e:
+                if claim is not None:
+                    self.decide(claim, False)
+                with self.lock:
+                    self.errors_L.append((seq_num, file.getName(), str(e)))
+            finally:
+                if shard is not None:
+                    shard.file_done(copied_id)
+
+    #----------------------------------------------------------------
+    # Put the file at dest_path: a hard link to the local file, if
+    # there is one, or a copy (hashed while copying)
+    #----------------------------------------------------------------
+    def extract(self, file, dest_path, do_hash):
+        start_time = time.time()
+        local_path = None
+        if self.link_local_files:
+            local_path = file.getLocalAbsPath()
+        if local_path and os.path.isfile(local_path):
+            try:
+                Files.createLink(File(dest_path).toPath(),
+                                                    File(local_path).toPath())
+                with self.lock:
+                    self.linked_count += 1
+                if self.metrics is not None:
+                    self.metrics.record("extract", time.time() - start_time,
+                                                            0, file, "link")
+                return
+            except Exception:
+                # Other volume, no hard links (FAT): copy
+                pass
+
+        if do_hash and file.getId() not in self.hasher.cache:
+            self.hasher.copy_and_hash(file, dest_path)
+            mode_S = "copy+hash"
+        else:
+            ContentUtils.writeToFile(file, File(dest_path))
+            mode_S = "copy"
+        with self.lock:
+            self.copied_count += 1
+        if self.metrics is not None:
+            self.metrics.record("extract", time.time() - start_time,
+                                            file.getSize(), file, mode_S)
+
+    def record(self, file, state_S, path=None):
+        if self.manifest is not None:
+            hashes_D = self.hasher.cache.get(file.getId())
+            if hashes_D is None:
+                md5_hash = None
+            else:
+                md5_hash = hashes_D["md5"]
+            self.manifest.update(file.getId(), file.getSize(), state_S,
+                                                        md5_hash, path)
+
+    #----------------------------------------------------------------
+    # Claim of the MD5 of the file (the MD5 computed by Autopsy's hash
+    # lookup module saves a read): its own, if it is the first file
+    # with the MD5, or the claim of the representative. Files are
+    # hashed concurrently, but claim in the order of their tickets, so
+    # the representative doesn't depend on the timing of the workers.
+    #----------------------------------------------------------------
+    def claim(self, ticket, file):
+        try:
+            md5_hash = file.getMd5Hash()
+            if not md5_hash:
+                md5_hash = self.hasher.get_hashes(file)["md5"]
+        except Exception:
+            self.take_turn(ticket)
+            raise
+
+        with self.claim_cond:
+            self.wait_turn(ticket)
+            claim = self.claims_D.get(md5_hash)
+            if claim is None:
+                claim = DedupeClaim(md5_hash, file.getId())
+                self.claims_D[md5_hash] = claim
+            elif not claim.decided.isSet():
+                claim.waiting_L.append(file.getId())
+            return claim
+
+    def take_turn(self, ticket):
+        with self.claim_cond:
+            self.wait_turn(ticket)
+
+    # Called with claim_cond held
+    def wait_turn(self, ticket):
+        while self.claim_turn != ticket:
+            self.claim_cond.wait()
+        self.claim_turn += 1
+        self.claim_cond.notifyAll()
+
+    #----------------------------------------------------------------
+    # A duplicate waits for the copy of its representative. Returns
+    # None if it was copied (the file is a duplicate), or the claim of
+    # the file if it failed and the file is promoted in its place.
+    #----------------------------------------------------------------
+    def wait_representative(self, claim, file):
+        file_id = file.getId()
+        while True:
+            claim.decided.wait()
+            with self.lock:
+                if claim.extracted:
+                    self.duplicates_D.setdefault(claim.file_id,
+                                                        []).append(file_id)
+                    self.duplicates_count += 1
+                    return None
+                claim = claim.promoted
+                if claim.file_id == file_id:
+                    return claim
+
+    # Outcome of the copy of a representative: if it failed, the first
+    # duplicate waiting for it (in submission order) is promoted
+    def decide(self, claim, extracted):
+        with self.lock:
+            if claim.decided.isSet():
+                return
+            claim.extracted = extracted
+            if not extracted:
+                if claim.waiting_L:
+                    promoted = DedupeClaim(claim.md5_hash,
+                                                        claim.waiting_L[0])
+                    promoted.waiting_L = claim.waiting_L[1:]
+                    claim.promoted = promoted
+                    self.claims_D[claim.md5_hash] = promoted
+                else:
+                    del self.claims_D[claim.md5_hash]
+            claim.decided.set()
+
+    #----------------------------------------------------------------
+    # Wait for all the submitted files; returns the list of errors
+    # (sequence number, filename, error) sorted by sequence number
+    #----------------------------------------------------------------
+    def close(self):
+        for worker in self.workers_L:
+            self.queue.put(None)
+        for worker in self.workers_L:
+            worker.join()
+        for dup_ids_L in self.duplicates_D.values():
+            dup_ids_L.sort()
+        return sorted(self.errors_L)
+
+
+# Representative of an MD5 (dedupe) and the duplicates waiting for its
+# copy. If the copy fails, promoted is the claim of the next duplicate.
+class DedupeClaim(object):
+
+    def __init__(self, md5_hash, file_id):
+        self.md5_hash = md5_hash
+        self.file_id = file_id
+        self.waiting_L = []
+        self.extracted = False
+        self.promoted = None
+        self.decided = Event()
+
+
+#----------------------------------------------------------------------
+# Persistent manifest of a data source: records, for each file, its
+# object id, size, MD5 and processing state. It is a journal (one JSON
+# record per line, the last record of an id wins) that is flushed on
+# every update, so a crash or a cancellation loses nothing: the next
+# run only copies and processes new, changed or unfinished files.
+#----------------------------------------------------------------------
+class IngestManifest(object):
+
+    # States of a file
+    EXTRACTED = "extracted"     # copied into img/, waiting for FDRI.exe
+    DUPLICATE = "duplicate"     # not copied (dedupe), waiting for FDRI.exe
+    DONE = "done"               # results of FDRI.exe added to the case
+    SKIPPED = "skipped"         # left out by the header check
+    STALLED = "stalled"         # put aside by the watchdog of FDRI.exe
+
+    # Results of check()
+    NEW = "new"
+    CHANGED = "changed"
+
+    def __init__(self, manifest_path, settings_S=None,
+                                        stall_max_tries=C_STALL_MAX_TRIES):
+        self.manifest_path = manifest_path
+        # A STALLED file is retried until it has stalled this many times
+        self.stall_max_tries = stall_max_tries
+        # Digest of the settings of this run (see settings_digest()),
+        # recorded with each file done
+        self.settings_S = settings_S
+        # DONE files of previous runs with other settings
+        self.other_settings_count = 0
+        # object id -> record
+        self.records_D = {}
+        self.lock = Lock()
+        journal_len = self.load()
+        # Rewrite the journal if it is mostly superseded records
+        if journal_len > 2 * len(self.records_D):
+            self.compact()
+        self.journal_F = open(self.manifest_path, "a")
+
+    def __len__(self):
+        return len(self.records_D)
+
+    def load(self):
+        journal_len = 0
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as manifest_F:
+                for line in manifest_F:
+                    try:
+                        record_D = json.loads(line)
+                    except ValueError:
+                        # Last line of a run that crashed
+                        continue
+                    self.records_D[record_D["id"]] = record_D
+                    journal_len += 1
+        return journal_len
+
+    def compact(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as manifest_F:
+            for record_D in self.records_D.itervalues():
+                manifest_F.write(json.dumps(record_D) + "\n")
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        os.rename(tmp_path, self.manifest_path)
+
+    #----------------------------------------------------------------
+    # What to do with a file: DONE, SKIPPED or STALLED (nothing),
+    # EXTRACTED (a copy already exists, it only needs FDRI.exe: also a
+    # STALLED file to retry), NEW or CHANGED (the file, or the settings
+    # it was done with)
+    #----------------------------------------------------------------
+    def check(self, file):
+        record_D = self.records_D.get(file.getId())
+        if record_D is None:
+            return self.NEW
+        if record_D["size"] != file.getSize():
+            return self.CHANGED
+        # MD5 computed by Autopsy's hash lookup module (if it ran)
+        md5_hash = file.getMd5Hash()
+        if md5_hash and record_D["md5"] and md5_hash != record_D["md5"]:
+            return self.CHANGED
+        if record_D["state"] in (self.DONE, self.SKIPPED, self.STALLED):
+            if record_D.get("settings") != self.settings_S:
+                self.other_settings_count += 1
+                return self.CHANGED
+            # Its copy (in C_STALLED_DIR) goes back to FDRI.exe
+            if record_D["state"] == self.STALLED and\
+                        record_D.get("stalls", 0) < self.stall_max_tries:
+                return self.EXTRACTED
+            return record_D["state"]
+        if record_D["state"] == self.EXTRACTED:
+            return self.EXTRACTED
+        return self.NEW
+
+    def update(self, file_id, size, state_S, md5_hash=None, path=None):
+        with self.lock:
+            # Closed (cancelled run)
+            if self.journal_F is None:
+                return
+            record_D = self.records_D.get(file_id)
+            if record_D is None or record_D["size"] != size:
+                record_D = {"id": file_id, "size": size, "md5": None}
+                self.records_D[file_id] = record_D
+            if md5_hash is not None:
+                record_D["md5"] = md5_hash
+            record_D["path"] = path
+            record_D["state"] = state_S
+            self.journal_F.write(json.dumps(record_D) + "\n")
+            self.journal_F.flush()
+
+    def mark_done(self, ids_L):
+        with self.lock:
+            if self.journal_F is None:
+                return
+            for file_id in ids_L:
+                record_D = self.records_D.get(file_id)
+                if record_D is None:
+                    # Not copied (e.g. copy error): retried next run
+                    continue
+                record_D["state"] = self.DONE
+                record_D["settings"] = self.settings_S
+                self.journal_F.write(json.dumps(record_D) + "\n")
+            self.journal_F.flush()
+
+    # A file left out by the header check (not an image, too small...)
+    def skip(self, file, reason_S):
+        with self.lock:
+            if self.journal_F is None:
+                return
+            record_D = {"id": file.getId(), "size": file.getSize(),
+                        "md5": file.getMd5Hash(), "path": None,
+                        "state": self.SKIPPED, "reason": reason_S,
+                        "settings": self.settings_S}
+            self.records_D[file.getId()] = record_D
+            self.journal_F.write(json.dumps(record_D) + "\n")
+            self.journal_F.flush()
+
+    def skip_reason(self, file_id):
+        return self.records_D[file_id].get("reason")
+
+    # A file put aside by the watchdog (its copy moved to path). The
+    # stalls are counted across runs.
+    def mark_stalled(self, file_id, path):
+        with self.lock:
+            if self.journal_F is None:
+                return
+            record_D = self.records_D.get(file_id)
+            if record_D is None:
+                return
+            record_D["path"] = path
+            record_D["state"] = self.STALLED
+            record_D["stalls"] = record_D.get("stalls", 0) + 1
+            record_D["settings"] = self.settings_S
+            self.journal_F.write(json.dumps(record_D) + "\n")
+            self.journal_F.flush()
+
+    # The copy of an EXTRACTED file was moved (to another shard)
+    def update_path(self, file_id, path):
+        with self.lock:
+            if self.journal_F is None:
+                return
+            record_D = self.records_D.get(file_id)
+            if record_D is None:
+                return
+            record_D["path"] = path
+            self.journal_F.write(json.dumps(record_D) + "\n")
+            self.journal_F.flush()
+
+    # MD5 of a file (None: unknown, or not hashed)
+    def md5(self, file_id):
+        record_D = self.records_D.get(file_id)
+        if record_D is None:
+            return None
+        return record_D["md5"]
+
+    # Path of the copy of an EXTRACTED file
+    def copy_path(self, file_id):
+        record_D = self.records_D.get(file_id)
+        if record_D is None:
+            return None
+        return record_D.get("path")
+
+    def close(self):
+        with self.lock:
+            if self.journal_F is not None:
+                self.journal_F.close()
+                self.journal_F = None
+
+
+#----------------------------------------------------------------------
+# File mapping from the output of FDRI.exe to Autopsy files.
+# The files found by the enumeration are indexed by object id, so each
+# result line ("...name__id__N.ext") is resolved in constant time.
+# In lazy mode only the ids are indexed and the AbstractFiles are
+# fetched in bulk from the case DB (SleuthkitCase) when needed.
+#----------------------------------------------------------------------
+class FileIdIndex(object):
+
+    def __init__(self, case, lazy=False):
+        self.case = case
+        self.lazy = lazy
+        # object id -> AbstractFile (None in lazy mode)
+        self.files_D = {}
+
+    def add(self, file):
+        if self.lazy:
+            self.files_D[file.getId()] = None
+        else:
+            self.files_D[file.getId()] = file
+
+    def __len__(self):
+        return len(self.files_D)
+
+    def __contains__(self, file_id):
+        return file_id in self.files_D
+
+    #----------------------------------------------------------------
+    # Extract the object id from a line of FDRI_wanted.txt or
+    # FDRI_faces_found.txt. Returns None if the line has no id.
+    #----------------------------------------------------------------
+    def parse_result_line(self, line):
+        if "__id__" not in line:
+            return None
+        id_S = line.split("__id__")[1].split(".")[0]
+        try:
+            return int(id_S)
+        except ValueError:
+            return None
+
+    #----------------------------------------------------------------
+    # Resolve all the lines of a result file at once.
+    # Returns one (file, detected file) pair per line and per
+    # duplicate of the detected file (duplicates_D: id -> duplicate
+    # ids), or only the duplicates if include_detected is False.
+    # Unknown ids give (None, None).
+    #----------------------------------------------------------------
+    def resolve_result_file(self, result_path, duplicates_D=None,
+                                                    include_detected=True):
+        if duplicates_D is None:
+            duplicates_D = {}
+        with open(result_path, "r") as result_F:
+            ids_L = [self.parse_result_line(line) for line in result_F
+                                                        if line.strip()]
+        pairs_L = []
+        for file_id in ids_L:
+            if include_detected:
+                pairs_L.append((file_id, file_id))
+            for dup_id in duplicates_D.get(file_id, []):
+                pairs_L.append((dup_id, file_id))
+
+        files_L = self.resolve_ids([file_id for file_id, det_id in pairs_L]
+                                + [det_id for file_id, det_id in pairs_L])
+        num_pairs = len(pairs_L)
+        resolved_L = []
+        for i in range(num_pairs):
+            if files_L[i] is None or files_L[num_pairs + i] is None:
+                resolved_L.append((None, None))
+            else:
+                resolved_L.append((files_L[i], files_L[num_pairs + i]))
+        return resolved_L
+
+    def resolve_ids(self, ids_L):
+        if self.lazy:
+            self.fetch([file_id for file_id in set(ids_L)
+                        if file_id in self.files_D
+                                and self.files_D[file_id] is None])
+        return [self.files_D.get(file_id) for file_id in ids_L]
+
+    #----------------------------------------------------------------
+    # Fetch AbstractFiles from the case DB, a chunk of ids per query
+    #----------------------------------------------------------------
+    def fetch(self, ids_L):
+        for start in range(0, len(ids_L), C_RESOLVE_CHUNK_SIZE):
+            chunk_L = ids_L[start:start + C_RESOLVE_CHUNK_SIZE]
+            where_S = "obj_id IN (%s)" % (",".join([str(file_id)
+                                                for file_id in chunk_L]))
+            try:
+                for file in self.case.findAllFilesWhere(where_S):
+                    self.files_D[file.getId()] = file
+            except TskCoreException:
+                # Fall back to one query per id
+                for file_id in chunk_L:
+                    self.files_D[file_id] = \
+                                self.case.getAbstractFileById(file_id)
+
+
+#----------------------------------------------------------------------
+# SAX handler that copies the DFXML file emitted by FDRI.exe and appends
+# the hashdigest elements to each matching fileobject. Fileobjects are
+# matched through an index: by the object id embedded in the filename
+# ("name__id__N") or, failing that, by the file's basename.
+#----------------------------------------------------------------------
+class DFXMLHashWriter(xml.sax.handler.ContentHandler):
+
+    def __init__(self, out, hashes_by_id_D, hashes_by_name_D):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.generator = XMLGenerator(out, "utf-8")
+        self.hashes_by_id_D = hashes_by_id_D
+        self.hashes_by_name_D = hashes_by_name_D
+        self.in_filename = False
+        self.filename_L = []
+        self.total_count = 0
+        self.matched_count = 0
+
+    def startDocument(self):
+        self.generator.startDocument()
+
+    def endDocument(self):
+        self.generator.endDocument()
+
+    def startElement(self, name, attrs):
+        if name == "fileobject":
+            self.filename_L = []
+        elif name == "filename":
+            self.in_filename = True
+        self.generator.startElement(name, attrs)
+
+    def endElement(self, name):
+        if name == "filename":
+            self.in_filename = False
+        elif name == "fileobject":
+            self.total_count += 1
+            hashes_D = self.lookup("".join(self.filename_L).strip())
+            if hashes_D is not None:
+                self.matched_count += 1
+                for algorithm in ("sha1", "sha256", "md5"):
+                    self.generator.startElement("hashdigest",
+                            xml.sax.xmlreader.AttributesImpl(
+                                                    {"type": algorithm}))
+                    self.generator.characters(hashes_D[algorithm])
+                    self.generator.endElement("hashdigest")
+        self.generator.endElement(name)
+
+    def characters(self, content):
+        if self.in_filename:
+            self.filename_L.append(content)
+        self.generator.characters(content)
+
+    def ignorableWhitespace(self, content):
+        self.generator.ignorableWhitespace(content)
+
+    def processingInstruction(self, target, data):
+        self.generator.processingInstruction(target, data)
+
+    def lookup(self, filename_S):
+        if "__id__" in filename_S:
+            id_S = filename_S.split("__id__")[-1].split(".")[0]
+            try:
+                return self.hashes_by_id_D.get(int(id_S))
+            except ValueError:
+                pass
+        return self.hashes_by_name_D.get(filename_S)
+
+
+#----------------------------------------------------------------------
+# SAX handler that merges the DFXML files of the shards: the first file
+# is copied whole (but for the root's end tag, written by the last one)
+# and only the fileobjects of the others are appended to it.
+#----------------------------------------------------------------------
+class DFXMLMergeHandler(xml.sax.handler.ContentHandler):
+
+    def __init__(self, generator, is_first, is_last):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.generator = generator
+        self.is_first = is_first
+        self.is_last = is_last
+        self.depth = 0
+        # Depth of the fileobject being copied (0: outside fileobjects)
+        self.fileobject_depth = 0
+
+    def copying(self):
+        return self.is_first or self.fileobject_depth
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        if name == "fileobject" and not self.fileobject_depth:
+            self.fileobject_depth = self.depth
+        if self.copying():
+            self.generator.startElement(name, attrs)
+
+    def endElement(self, name):
+        if self.depth == 1:
+            # Root element
+            if self.is_last:
+                self.generator.endElement(name)
+        elif self.copying():
+            self.generator.endElement(name)
+        if self.depth == self.fileobject_depth:
+            self.fileobject_depth = 0
+        self.depth -= 1
+
+    def characters(self, content):
+        if self.copying():
+            self.generator.characters(content)
+
+    def ignorableWhitespace(self, content):
+        if self.copying():
+            self.generator.ignorableWhitespace(content)
+
+
+#----------------------------------------------------------------------
+# Global settings UI class, responsible for AI models weights location
+# This is case independent
+#----------------------------------------------------------------------
+class UIGlobalSettingsPanel(IngestModuleGlobalSettingsPanel):
+
+    def __init__(self):
+        self.save_file_cbox = JCheckBox(C_LABEL_INFO_AUTOPSY_TEMP)
+        ## "Save copied images outside of AUTOPSY's temp"
+
+        self.textInputs = {
+            '0': JTextField('', 30),
+            '1': JTextField('', 30),
+            '2': JTextField('', 30)
+        }
+
+        self.buttons = {
+            '0': JButton("Choose file", actionPerformed=self.chooseFolder),
+            '1': JButton("Choose file", actionPerformed=self.chooseFolder),
+            '2': JButton("Choose file", actionPerformed=self.chooseFolder)
+        }
+
+        self.gpu_memory_input = JTextField('', 8)
+        
+        self.initComponents()
+        self.load()
+
+    def checkBoxEvent(self, event):
+        self.save_files = self.save_file_cbox.isSelected()
 
     def saveSettings(self):
         all_paths = {}
         for code in self.textInputs:
             all_paths[code] = self.textInputs[code].text
         
+        try:
+            gpu_memory_mb = int(self.gpu_memory_input.text or 0)
+        except ValueError:
+            gpu_memory_mb = C_GPU_MEMORY_MB
+
         with open(GLOBAL_CONFIGURATION_PATH, "w") as out:
             json.dump({
                 "save_files": self.save_file_cbox.isSelected(),
-                "paths": all_paths
+                "paths": all_paths,
+                "gpu_memory_mb": gpu_memory_mb
             }, out)
 
     def load(self):
@@ -1026,6 +5469,8 @@ class UIGlobalSettingsPanel(IngestModuleGlobalSettingsPanel):
                 self.textInputs['0'].text = content['paths']['0']
                 self.textInputs['1'].text = content['paths']['1']
                 self.textInputs['2'].text = content['paths']['2']
+                self.gpu_memory_input.text = str(content.get(
+                                        'gpu_memory_mb', C_GPU_MEMORY_MB))
                 
 
     def chooseFolder(self, e):
@@ -1084,6 +5529,13 @@ class UIGlobalSettingsPanel(IngestModuleGlobalSettingsPanel):
         self.save_file_cbox.setBounds(45, 98, 300, 25)
         self.add(self.save_file_cbox)
 
+        lblGpuMemory = JLabel("GPU memory (MB, 0 if unknown):")
+        lblGpuMemory.setBounds(45, 340, 227, 16)
+        self.add(lblGpuMemory)
+
+        self.gpu_memory_input.setBounds(284, 337, 97, 22)
+        self.add(self.gpu_memory_input)
+
 
 #----------------------------------------------------------------
 # Case level settings object class
@@ -1092,8 +5544,8 @@ class UISettings(IngestModuleIngestJobSettings):
     serialVersionUID = 1L
 
     def __init__(self):
-        #             JPG   JPEG  PNG   Delete file after
-        self.flags = [True, True, True, True]
+        #             JPG   JPEG  PNG   Hash  Dedupe
+        self.flags = list(C_DEFAULT_FLAGS)
         self.paths = {
             "1": ""
         }
@@ -1102,9 +5554,14 @@ class UISettings(IngestModuleIngestJobSettings):
         return self.serialVersionUID
 
     def getFlag(self, pos):
+        # Settings saved by older versions have fewer flags
+        if pos >= len(self.flags):
+            return C_DEFAULT_FLAGS[pos]
         return self.flags[pos]
 
     def setFlag(self, flag, pos):
+        while pos >= len(self.flags):
+            self.flags.append(C_DEFAULT_FLAGS[len(self.flags)])
         self.flags[pos] = flag
 
     def setPath(self, code, path):
@@ -1150,6 +5607,7 @@ class UISettingsPanel(IngestModuleIngestJobSettingsPanel):
         self.localSettings.setFlag(self.checkboxJPEG.isSelected(), 1)
         self.localSettings.setFlag(self.checkboxPNG.isSelected(), 2)
         self.localSettings.setFlag(self.chckbxGenerateImageHash.isSelected(), 3)
+        self.localSettings.setFlag(self.chckbxDedupe.isSelected(), 4)
 
     def clear(self, e):
         button = e.getSource()
@@ -1209,12 +5667,18 @@ class UISettingsPanel(IngestModuleIngestJobSettingsPanel):
         self.chckbxGenerateImageHash.setBounds(43, 239, 223, 25)
         self.add(self.chckbxGenerateImageHash)
 
+        self.chckbxDedupe = JCheckBox("Process only one copy of identical images",
+                                      actionPerformed=self.checkBoxEvent)
+        self.chckbxDedupe.setBounds(43, 269, 300, 25)
+        self.add(self.chckbxDedupe)
+
     def customizeComponents(self):
         self.localSettings.loadConfig()
         self.checkboxJPG.setSelected(self.localSettings.getFlag(0))
         self.checkboxJPEG.setSelected(self.localSettings.getFlag(1))
         self.checkboxPNG.setSelected(self.localSettings.getFlag(2))
         self.chckbxGenerateImageHash.setSelected(self.localSettings.getFlag(3))
+        self.chckbxDedupe.setSelected(self.localSettings.getFlag(4))
 
         for code in self.textInputs:
             self.textInputs[code].text = self.localSettings.getPath(code)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#----------------------------------------------------------------------
+# Standalone calibration of the pre-pass of the "cascade" and "prepass"
+# backends (HaarFacePrepass in FDRI.py): every image of the folders is
+# scored, and the report (C_PREPASS_REPORT_FNAME format) gives, for each
+# threshold, the images skipped and the faces missed. The truth is the
+# folder of each image: --faces (default: testing_data/case_data) or
+# --no-faces.
+#
+# The pre-pass needs OpenCV: run it with Autopsy's Jython and jars, e.g.
+#   jython -J-cp "<Autopsy>/autopsy/modules/*;<Autopsy>/autopsy/modules/ext/*"
+#       -J-Djava.library.path=<OpenCV native library folder>
+#       benchmark/calibrate_prepass.py --no-faces <folder>
+# Under CPython the mock Autopsy API and OpenCV of the benchmark are
+# used: the scores then only come from the names of the files (see
+# mock_autopsy.py), which checks the script, not the pre-pass.
+#----------------------------------------------------------------------
+import argparse
+import imp
+import os
+import sys
+
+C_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+C_REPO_DIR = os.path.dirname(C_BENCH_DIR)
+
+C_DEFAULT_FACES_DIR = os.path.join(C_REPO_DIR, "testing_data", "case_data")
+
+
+def load_module(module_path):
+    if not sys.platform.startswith("java"):
+        sys.path.insert(0, C_BENCH_DIR)
+        import mock_autopsy
+        mock_autopsy.install()
+        print("CPython: mock OpenCV, the scores are made up")
+    return imp.load_source("FDRI", module_path)
+
+
+def list_images(dir_path):
+    return [os.path.join(dir_path, fname)
+                    for fname in sorted(os.listdir(dir_path))
+                    if os.path.isfile(os.path.join(dir_path, fname))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the pre-pass "
+                                "of FDRI.py over folders of images")
+    parser.add_argument("--faces", metavar="DIR", action="append",
+                    help="folder of images with faces (repeatable, "
+                    "default: %s)" % (C_DEFAULT_FACES_DIR))
+    parser.add_argument("--no-faces", metavar="DIR", action="append",
+                    default=[], help="folder of images without faces "
+                    "(repeatable)")
+    parser.add_argument("--cascade", metavar="FILE", help="Haar cascade "
+                    "(default: C_PREPASS_CASCADE_FNAME, next to FDRI.py)")
+    parser.add_argument("--detect-side", type=int, help="longest side of "
+                    "the image scanned (default: C_PREPASS_DETECT_SIDE)")
+    parser.add_argument("--out", default="FDRI_prepass_report.txt",
+                    help="report file (default: %(default)s)")
+    parser.add_argument("--module", default=os.path.join(C_REPO_DIR,
+                    "FDRI.py"), help="FDRI.py to calibrate")
+    options = parser.parse_args()
+
+    fdri = load_module(options.module)
+    cascade_path = options.cascade or fdri.prepass_cascade_path()
+    detect_side = options.detect_side or fdri.C_PREPASS_DETECT_SIDE
+    prepass = fdri.HaarFacePrepass(cascade_path, detect_side)
+
+    # (image, has faces)
+    images_L = []
+    for dir_path in options.faces or [C_DEFAULT_FACES_DIR]:
+        images_L.extend([(path, True) for path in list_images(dir_path)])
+    for dir_path in options.no_faces:
+        images_L.extend([(path, False) for path in list_images(dir_path)])
+
+    scores_L = []
+    for path, has_faces in images_L:
+        try:
+            score = prepass.score(path)
+        except Exception, e:
+            print("'%s' not scored: %s" % (path, str(e)))
+            score = None
+        scores_L.append((path, score, has_faces))
+
+    fdri.write_prepass_report(options.out, scores_L, prepass.needed_time,
+                "folders", fdri.C_PREPASS_REPORT_THRESHOLDS)
+    with open(options.out, "r") as report_F:
+        sys.stdout.write(report_F.read())
+    print("Report: '%s' (cascade '%s', side %d, threshold in use: %g)" %
+                (options.out, cascade_path, detect_side,
+                fdri.C_PREPASS_THRESHOLD))
+
+
+if __name__ == "__main__":
+    main()
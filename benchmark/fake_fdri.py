@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#----------------------------------------------------------------------
+# Stand-in for FDRI.exe: same command line (--params params.json
+# [--min N] [--max N], or --serve --port N [--idle-timeout S]) and the
+# same output files, without a GPU. Faces are decided by the names of
+# the images (see make_corpus.py): "_face" has a face, "_wanted" has a
+# face of the wanted person. The cost of the detector is scripted
+# through the environment:
+#   FDRI_BENCH_RUN_SECS    fixed cost of each run (loading the models)
+#   FDRI_BENCH_IMAGE_SECS  cost of each image
+#   FDRI_BENCH_MAX_PIXELS  exit with status 10 (CUDA out of memory) if
+#                          an image is larger (pixels, from its header)
+#   FDRI_BENCH_EXIT_CODE   exit status of the runs
+#   FDRI_BENCH_STALL       hang (as a stuck decode) on the images whose
+#                          name contains this text
+# The progress events (start, begin, image) go to params["progress_out"]
+# or, for the service, to the connection.
+#----------------------------------------------------------------------
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import time
+
+C_EXIT_OOM = 10
+C_DESCRIPTOR_DIM = 128
+
+
+def env_float(name_S, default=0.0):
+    return float(os.environ.get(name_S, default))
+
+
+# Width and height of a JPEG or PNG, from its header (None: unknown)
+def image_size(path):
+    with open(path, "rb") as image_F:
+        data = image_F.read(64 * 1024)
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", data[16:24])
+    pos = 2
+    while data[:2] == b"\xff\xd8" and pos + 9 <= len(data):
+        marker = bytearray(data[pos:pos + 2])
+        if marker[0] != 0xff:
+            return None
+        if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7:
+            pos += 2
+            continue
+        if marker[1] in (0xd9, 0xda):
+            return None
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return (width, height)
+        pos += 2 + length
+    return None
+
+
+def descriptor(fname_S):
+    value = 0.1 if "_wanted" in fname_S else 0.9
+    return [value] * C_DESCRIPTOR_DIM
+
+
+# Progress events appended to a file, one JSON object per line
+def progress_writer(path):
+    def write(event_D):
+        with open(path, "a") as progress_F:
+            progress_F.write(json.dumps(event_D) + "\n")
+    return write
+
+
+#----------------------------------------------------------------------
+# One run over the images of params["imagesPath"] whose size (pixels)
+# is within [min_size, max_size] (0: no bound). on_event() gets the
+# progress events, as the service streams them.
+#----------------------------------------------------------------------
+def detect(params_D, min_size=0, max_size=0, on_event=None,
+                                                    is_cancelled=None):
+    time.sleep(env_float("FDRI_BENCH_RUN_SECS"))
+    image_secs = env_float("FDRI_BENCH_IMAGE_SECS")
+    max_pixels = int(env_float("FDRI_BENCH_MAX_PIXELS"))
+    stall_S = os.environ.get("FDRI_BENCH_STALL")
+    # Only the wanted faces are embedded: the images are not read
+    if params_D.get("embed_only"):
+        embed_wanted(params_D)
+        return int(env_float("FDRI_BENCH_EXIT_CODE"))
+    if on_event is None and "progress_out" in params_D:
+        on_event = progress_writer(params_D["progress_out"])
+
+    images_dir = params_D["imagesPath"]
+    workspace = params_D["workspace"]
+    annotated_dir = os.path.join(workspace, "annotated")
+    if not os.path.exists(annotated_dir):
+        os.makedirs(annotated_dir)
+
+    images_L = []
+    for fname_S in sorted(os.listdir(images_dir)):
+        path = os.path.join(images_dir, fname_S)
+        if not os.path.isfile(path):
+            continue
+        size = image_size(path)
+        pixels = size[0] * size[1] if size else 0
+        if min_size and pixels < min_size:
+            continue
+        if max_size and pixels > max_size:
+            continue
+        if max_pixels and pixels > max_pixels:
+            return C_EXIT_OOM
+        images_L.append((fname_S, path))
+
+    faces_L = []
+    wanted_L = []
+    fileobjects_L = []
+    if on_event is not None:
+        on_event({"event": "start", "images": len(images_L)})
+    for fname_S, path in images_L:
+        if is_cancelled is not None and is_cancelled():
+            return 1
+        if on_event is not None:
+            on_event({"event": "begin", "file": fname_S})
+        while stall_S and stall_S in fname_S:
+            time.sleep(1)
+        time.sleep(image_secs)
+        fileobjects_L.append("<fileobject><filename>%s</filename>"
+                "<filesize>%d</filesize></fileobject>" %
+                (os.path.splitext(fname_S)[0], os.path.getsize(path)))
+        has_face = "_face" in fname_S or "_wanted" in fname_S
+        if has_face:
+            faces_L.append(fname_S)
+            shutil.copyfile(path, os.path.join(annotated_dir, fname_S))
+            if "_wanted" in fname_S and params_D.get("doRecognition"):
+                wanted_L.append(fname_S)
+        if on_event is not None:
+            on_event({"event": "image", "file": fname_S,
+                                                    "faces": int(has_face)})
+
+    for result_fname, fnames_L in (("FDRI_faces_found.txt", faces_L),
+                                        ("FDRI_wanted.txt", wanted_L)):
+        with open(os.path.join(workspace, result_fname), "w") as result_F:
+            for fname_S in fnames_L:
+                result_F.write(os.path.join(images_dir, fname_S) + "\n")
+    with open(os.path.join(workspace, "dfxml.xml"), "w") as dfxml_F:
+        dfxml_F.write('<?xml version="1.0" encoding="utf-8"?>'
+                '<dfxml version="1.0"><source><image_filename>%s'
+                '</image_filename></source>%s</dfxml>' %
+                (images_dir, "".join(fileobjects_L)))
+
+    if "descriptors_out" in params_D:
+        with open(params_D["descriptors_out"], "w") as out_F:
+            json.dump({"faces": dict([(fname_S, [descriptor(fname_S)])
+                                        for fname_S in faces_L])}, out_F)
+    embed_wanted(params_D)
+    if "boxes_out" in params_D:
+        with open(params_D["boxes_out"], "w") as out_F:
+            json.dump({"faces": dict([(fname_S, [[10, 10, 60, 60]])
+                                        for fname_S in faces_L])}, out_F)
+
+    return int(env_float("FDRI_BENCH_EXIT_CODE"))
+
+
+# Descriptors of the reference images that are not cached
+def embed_wanted(params_D):
+    if "wanted_descriptors_out" not in params_D:
+        return
+    with open(params_D["wanted_descriptors"], "r") as in_F:
+        cached_D = json.load(in_F)["faces"]
+    wanted_dir = params_D["wanted_faces"]
+    new_D = dict([(fname_S, [descriptor("_wanted")])
+                    for fname_S in sorted(os.listdir(wanted_dir))
+                                            if fname_S not in cached_D])
+    with open(params_D["wanted_descriptors_out"], "w") as out_F:
+        json.dump({"faces": new_D}, out_F)
+
+
+#----------------------------------------------------------------------
+# Resident service (see DetectorService in FDRI.py): one batch per
+# connection, JSON lines
+#----------------------------------------------------------------------
+def serve(port, idle_secs):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(5)
+    if idle_secs:
+        server.settimeout(idle_secs)
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            return 0
+        conn.settimeout(None)
+        conn_F = conn.makefile("rw")
+        try:
+            line_S = conn_F.readline()
+            if not line_S:
+                continue
+            request_D = json.loads(line_S)
+            if request_D.get("cmd") != "run":
+                continue
+            with open(request_D["params"], "r") as params_F:
+                params_D = json.load(params_F)
+
+            def send(event_D):
+                conn_F.write(json.dumps(event_D) + "\n")
+                conn_F.flush()
+
+            return_code = detect(params_D, request_D.get("min", 0),
+                                        request_D.get("max", 0), send)
+            send({"event": "done", "return_code": return_code})
+        except (IOError, socket.error):
+            pass
+        finally:
+            conn_F.close()
+            conn.close()
+
+
+def option(args_L, name_S, default=0):
+    if name_S in args_L:
+        return int(args_L[args_L.index(name_S) + 1])
+    return default
+
+
+def main(args_L):
+    if "--serve" in args_L:
+        return serve(option(args_L, "--port"),
+                                        option(args_L, "--idle-timeout"))
+    with open(args_L[args_L.index("--params") + 1], "r") as params_F:
+        params_D = json.load(params_F)
+    return detect(params_D, option(args_L, "--min"),
+                                                option(args_L, "--max"))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#----------------------------------------------------------------------
+# Synthetic corpus for the benchmark: a TSV file with one row per file
+# of the data source (object id, name, kind, source image, content id,
+# size, MIME type, local path). The contents are generated by the mock
+# (mock_autopsy.make_content) when the module reads them, so a corpus
+# of millions of files takes a few hundred MB of TSV and no images.
+#
+# Kinds of files (--size-mix):
+#   photo  an image of --sources (testing_data by default)
+#   large  a photo padded to --large-mb MB
+#   tiny   a 16x16 PNG (icons, thumbnails...)
+#   other  a text file with an image extension
+# Each image is tagged in its name ("_face", "_wanted", "_none"): the
+# stand-in FDRI.exe finds faces from the tag, so the results are known.
+# --dup-ratio of the files repeat the content of an earlier file.
+#----------------------------------------------------------------------
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_autopsy
+
+C_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+C_DEFAULT_SOURCES = os.path.join(C_REPO_DIR, "testing_data", "case_data")
+C_DEFAULT_SIZE_MIX = "photo=0.85,large=0.05,tiny=0.07,other=0.03"
+C_FIRST_OBJ_ID = 1000
+
+C_MIME_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+
+# Length of the trailer added to each content
+C_TRAILER_LEN = len("%s%012d" % (mock_autopsy.C_TRAILER_MAGIC, 0))
+
+
+def parse_mix(mix_S):
+    mix_L = []
+    for item_S in mix_S.split(","):
+        kind_S, _, weight_S = item_S.partition("=")
+        if kind_S not in ("photo", "large", "tiny", "other"):
+            raise ValueError("unknown kind '%s'" % (kind_S))
+        mix_L.append((kind_S, float(weight_S)))
+    return mix_L
+
+
+def choose(rng, mix_L):
+    point = rng.random() * sum([weight for kind_S, weight in mix_L])
+    for kind_S, weight in mix_L:
+        point -= weight
+        if point < 0:
+            return kind_S
+    return mix_L[-1][0]
+
+
+#----------------------------------------------------------------------
+# Rows of the corpus: (obj_id, name, kind, source, content_id, size,
+# mime, local path)
+#----------------------------------------------------------------------
+def generate(options):
+    rng = random.Random(options.seed)
+    mix_L = parse_mix(options.size_mix)
+    sources_L = sorted([os.path.join(options.sources, fname)
+            for fname in os.listdir(options.sources)
+            if os.path.splitext(fname)[1].lower().lstrip(".")
+                                                        in C_MIME_TYPES])
+    if not sources_L:
+        raise ValueError("no images in '%s'" % (options.sources))
+    source_sizes_D = dict([(path, os.path.getsize(path))
+                                                    for path in sources_L])
+    large_size = int(options.large_mb * 1024 * 1024)
+
+    # (kind, source, content_id, size, tag, extension, local path)
+    contents_L = []
+    obj_id = C_FIRST_OBJ_ID
+    for index in range(options.files):
+        if contents_L and rng.random() < options.dup_ratio:
+            content = rng.choice(contents_L)
+        else:
+            kind_S = choose(rng, mix_L)
+            source = rng.choice(sources_L)
+            ext_S = os.path.splitext(source)[1].lower().lstrip(".")
+            if kind_S == "tiny":
+                source = "-"
+                ext_S = "png"
+                size = rng.randint(200, 3000)
+            elif kind_S == "other":
+                source = "-"
+                size = rng.randint(500, 20000)
+            elif kind_S == "large":
+                size = max(large_size, source_sizes_D[source] +\
+                                                            C_TRAILER_LEN)
+            else:
+                size = source_sizes_D[source] + C_TRAILER_LEN
+
+            tag_S = "none"
+            if kind_S in ("photo", "large") and\
+                                        rng.random() < options.face_ratio:
+                if rng.random() < options.wanted_ratio:
+                    tag_S = "wanted"
+                else:
+                    tag_S = "face"
+
+            content_id = len(contents_L)
+            local_path = "-"
+            if options.materialize:
+                local_path = materialize(options.materialize, kind_S,
+                                            source, content_id, size, ext_S)
+            content = (kind_S, source, content_id, size, tag_S, ext_S,
+                                                                local_path)
+            contents_L.append(content)
+
+        kind_S, source, content_id, size, tag_S, ext_S, local_path = content
+        mime_S = C_MIME_TYPES.get(ext_S, "-")
+        if kind_S == "other":
+            mime_S = "text/plain"
+        elif rng.random() < options.renamed_ratio:
+            # Image without its extension: found by its MIME type
+            ext_S = "dat"
+        if kind_S in ("photo", "large"):
+            stem_S = os.path.splitext(os.path.basename(source))[0]
+        else:
+            stem_S = kind_S
+        name_S = "%s_%07d_%s.%s" % (stem_S, index, tag_S, ext_S)
+
+        yield (obj_id, name_S, kind_S, source, content_id, size, mime_S,
+                                                                local_path)
+        # Object ids of a case DB have gaps (directories, other files)
+        obj_id += rng.randint(1, 3)
+
+
+# Content written to disk (local files, as for logical file sets)
+def materialize(out_dir, kind_S, source, content_id, size, ext_S):
+    sub_dir = os.path.join(out_dir, "%02x" % (content_id % 256))
+    if not os.path.exists(sub_dir):
+        os.makedirs(sub_dir)
+    path = os.path.join(sub_dir, "%09d.%s" % (content_id, ext_S))
+    with open(path, "wb") as content_F:
+        content_F.write(mock_autopsy.make_content(kind_S, source,
+                                                        content_id, size))
+    return os.path.abspath(path)
+
+
+def load_corpus(corpus_path):
+    files_L = []
+    with open(corpus_path, "r") as corpus_F:
+        for line_S in corpus_F:
+            if line_S.startswith("#"):
+                continue
+            fields_L = line_S.rstrip("\n").split("\t")
+            obj_id, name_S, kind_S, source, content_id, size, mime_S,\
+                                                    local_path = fields_L
+            files_L.append(mock_autopsy.AbstractFile(int(obj_id), name_S,
+                    kind_S, source, int(content_id), int(size),
+                    None if mime_S == "-" else mime_S,
+                    None if local_path == "-" else local_path))
+    return files_L
+
+
+def main(args_L):
+    parser = argparse.ArgumentParser(description="Synthetic corpus for "
+                                                "the FDRI benchmark")
+    parser.add_argument("--out", required=True, help="TSV file to write")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--sources", default=C_DEFAULT_SOURCES,
+                                        help="directory of source images")
+    parser.add_argument("--dup-ratio", type=float, default=0.2,
+                    help="fraction of files repeating an earlier content")
+    parser.add_argument("--size-mix", default=C_DEFAULT_SIZE_MIX,
+                    help="weights of the kinds of files (photo, large, "
+                    "tiny, other)")
+    parser.add_argument("--large-mb", type=float, default=12.0,
+                                        help="size of the large images")
+    parser.add_argument("--face-ratio", type=float, default=0.3,
+                                    help="fraction of images with faces")
+    parser.add_argument("--wanted-ratio", type=float, default=0.1,
+                help="fraction of the faces that are the wanted person")
+    parser.add_argument("--renamed-ratio", type=float, default=0.02,
+                help="fraction of images without an image extension")
+    parser.add_argument("--materialize", metavar="DIR",
+                help="write the contents to DIR (files with a local path)")
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args(args_L)
+
+    count = 0
+    with open(options.out, "w") as corpus_F:
+        corpus_F.write("# obj_id\tname\tkind\tsource\tcontent_id\tsize\t"
+                                                    "mime\tlocal_path\n")
+        for row in generate(options):
+            corpus_F.write("\t".join([str(field) for field in row]) + "\n")
+            count += 1
+    print("%d files written to '%s'" % (count, options.out))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,1007 @@
+#----------------------------------------------------------------------
+# Stand-ins for the Java, Swing and Autopsy/Sleuthkit classes imported
+# by FDRI.py, so that the module's logic runs under plain (C)Python 2.7
+# on any box. install() registers them in sys.modules; it must be
+# called before FDRI.py is loaded.
+#
+# Files are virtual: each one is a row of the corpus (see make_corpus.py)
+# whose content is generated when read, so that a case of millions of
+# files needs no disk space. The module's queries are answered from the
+# rows, sorted by object id (keyset pagination is O(page), as in the
+# case DB).
+#----------------------------------------------------------------------
+import bisect
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import types
+import zlib
+from array import array
+
+# Marker appended to the images: makes each content unique (and
+# recognizable) without changing how decoders read the image
+C_TRAILER_MAGIC = "FDRIBENCH"
+
+# Raw detections of the Haar cascade on a face (see CascadeClassifier)
+C_HAAR_FACE_DETECTIONS = 6
+
+# What the module did to the case, for the report
+STATE = {}
+
+
+def reset_state():
+    STATE.clear()
+    STATE.update({
+        "artifacts": [],
+        "derived": [],
+        "messages": [],
+        "events": [],
+        "progress": [],
+        "indexed": 0,
+        "transactions": 0,
+        "queries": 0,
+        "bytes_read": 0,
+    })
+    STATE["lock"] = threading.Lock()
+
+reset_state()
+
+
+def add_bytes_read(num_bytes):
+    with STATE["lock"]:
+        STATE["bytes_read"] += num_bytes
+
+
+#----------------------------------------------------------------------
+# Virtual content
+#----------------------------------------------------------------------
+_sources_D = {}
+_sources_lock = threading.Lock()
+
+
+def source_bytes(path):
+    with _sources_lock:
+        data = _sources_D.get(path)
+        if data is None:
+            with open(path, "rb") as source_F:
+                data = source_F.read()
+            _sources_D[path] = data
+        return data
+
+
+def png_chunk(type_S, data):
+    return struct.pack(">I", len(data)) + type_S + data +\
+            struct.pack(">I", zlib.crc32(type_S + data) & 0xffffffff)
+
+
+# Smallest valid PNG of the given size (a grey image)
+def tiny_png(width, height):
+    raw = ("\0" + "\x80" * (width * 3)) * height
+    return "\x89PNG\r\n\x1a\n" +\
+            png_chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2,
+                                                                0, 0, 0)) +\
+            png_chunk("IDAT", zlib.compress(raw)) + png_chunk("IEND", "")
+
+
+# Baseline JPEG header with the given size (no scan data): enough for
+# header parsers, which is all the stand-ins need
+def jpeg_header(width, height):
+    return "\xff\xd8\xff\xc0" + struct.pack(">HBHHB", 11, 8, height,
+                                    width, 1) + "\x01\x11\x00" + "\xff\xd9"
+
+
+# Content of a corpus row: the source (or a generated image/text) plus
+# the trailer with the content id, padded up to the row's size
+def make_content(kind_S, source_path, content_id, size):
+    if kind_S == "tiny":
+        head = tiny_png(16, 16)
+    elif kind_S == "other":
+        head = "Not an image.\n" * 8
+    else:
+        head = source_bytes(source_path)
+    trailer = "%s%012d" % (C_TRAILER_MAGIC, content_id)
+    data = head + trailer
+    if size > len(data):
+        data = data + "\0" * (size - len(data))
+    return data
+
+
+# Width and height in the header of a JPEG or PNG (None: unknown)
+def image_size(data):
+    if data[:8] == "\x89PNG\r\n\x1a\n" and data[12:16] == "IHDR":
+        return struct.unpack(">II", data[16:24])
+    if data[:2] != "\xff\xd8":
+        return None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != "\xff":
+            return None
+        marker = ord(data[pos + 1])
+        if marker == 0xff:
+            pos += 1
+            continue
+        if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+            pos += 2
+            continue
+        if marker == 0xd9 or marker == 0xda:
+            return None
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return (width, height)
+        pos += 2 + length
+    return None
+
+
+#----------------------------------------------------------------------
+# Java
+#----------------------------------------------------------------------
+def module(name_S, **attrs):
+    new_module = types.ModuleType(name_S)
+    new_module.__dict__.update(attrs)
+    sys.modules[name_S] = new_module
+    parent_S, _, child_S = name_S.rpartition(".")
+    if parent_S:
+        if parent_S not in sys.modules:
+            module(parent_S)
+        if not hasattr(sys.modules[parent_S], child_S):
+            setattr(sys.modules[parent_S], child_S, new_module)
+    return new_module
+
+
+# Anything (Swing components, constants...) that is only called
+class Anything(object):
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name_S):
+        return Anything()
+
+    def __call__(self, *args, **kwargs):
+        return Anything()
+
+
+class Level(object):
+    SEVERE = "SEVERE"
+    WARNING = "WARNING"
+    INFO = "INFO"
+    FINE = "FINE"
+
+
+class Logger(object):
+
+    records_L = []
+    loggable_S = set(["SEVERE", "WARNING", "INFO"])
+
+    @staticmethod
+    def getLogger(name_S):
+        return Logger()
+
+    def isLoggable(self, level):
+        return level in Logger.loggable_S
+
+    def logp(self, level, class_S, method_S, msg_S):
+        Logger.records_L.append((level, method_S, msg_S))
+
+
+class File(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def getPath(self):
+        return self.path
+
+    def toPath(self):
+        return self.path
+
+
+#----------------------------------------------------------------------
+# java.nio memory mapping (RandomAccessFile.getChannel().map()): the
+# window is read, as little endian floats
+#----------------------------------------------------------------------
+class RandomAccessFile(object):
+
+    def __init__(self, path, mode_S):
+        self.file_F = open(path, "rb")
+
+    def getChannel(self):
+        return self
+
+    def map(self, mode, offset, length):
+        self.file_F.seek(offset)
+        return MappedBuffer(self.file_F.read(length))
+
+    def close(self):
+        self.file_F.close()
+
+
+class MappedBuffer(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def order(self, byte_order):
+        return self
+
+    def asFloatBuffer(self):
+        return self
+
+    def get(self, dest, offset, length):
+        floats = array("f", self.data[:length * 4])
+        if sys.byteorder == "big":
+            floats.byteswap()
+        dest[offset:offset + length] = floats
+
+
+class FileChannel(object):
+
+    class MapMode(object):
+        READ_ONLY = "r"
+
+
+class ByteOrder(object):
+
+    LITTLE_ENDIAN = "little"
+
+
+class FileOutputStream(object):
+
+    def __init__(self, path):
+        self.out_F = open(path, "wb")
+
+    def write(self, buf, offset, length):
+        self.out_F.write(buf[offset:offset + length].tostring())
+
+    def close(self):
+        self.out_F.close()
+
+
+class Files(object):
+
+    @staticmethod
+    def createLink(link, existing):
+        os.link(existing, link)
+
+
+def jarray_zeros(length, type_S):
+    if type_S == "f":
+        return array("f", [0.0]) * length
+    return array("b", "\0" * length)
+
+
+#----------------------------------------------------------------------
+# ImageIO/AWT: images are decoded from their headers only. Pixels are
+# not made up: an image only carries the name of its file (see
+# make_corpus.py), from which the stand-in OpenCV finds faces.
+#----------------------------------------------------------------------
+class Image(object):
+
+    TYPE_INT_RGB = 1
+    TYPE_BYTE_GRAY = 10
+
+    def __init__(self, width, height, image_type=None, name_S=""):
+        self.width = width
+        self.height = height
+        self.name_S = name_S
+
+    def getWidth(self):
+        return self.width
+
+    def getHeight(self):
+        return self.height
+
+    def createGraphics(self):
+        return Graphics(self)
+
+    # getRaster().getDataBuffer().getData(): the pixels (the name)
+    def getRaster(self):
+        return self
+
+    def getDataBuffer(self):
+        return self
+
+    def getData(self):
+        return Pixels(self.name_S)
+
+
+class Pixels(object):
+
+    def __init__(self, name_S):
+        self.name_S = name_S
+
+
+class Graphics(object):
+
+    def __init__(self, image):
+        self.image = image
+
+    def drawImage(self, image, x, y, *args):
+        self.image.name_S = image.name_S
+
+    def __getattr__(self, name_S):
+        return lambda *args: None
+
+
+class ReadParam(object):
+
+    def __init__(self):
+        self.step = 1
+
+    def setSourceSubsampling(self, step_x, step_y, offset_x, offset_y):
+        self.step = step_x
+
+
+class ImageReader(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def setInput(self, *args):
+        pass
+
+    def getWidth(self, index):
+        return self.size[0]
+
+    def getHeight(self, index):
+        return self.size[1]
+
+    def getDefaultReadParam(self):
+        return ReadParam()
+
+    def read(self, index, param=None):
+        step = param.step if param is not None else 1
+        return Image(max(1, self.size[0] // step),
+                    max(1, self.size[1] // step), None,
+                    os.path.basename(self.path))
+
+    def dispose(self):
+        pass
+
+
+#----------------------------------------------------------------------
+# OpenCV (Java binding, loaded by Autopsy). The Haar cascade finds a
+# face (a group of overlapping raw detections) in the images tagged
+# with faces, and a stray detection in every image.
+#----------------------------------------------------------------------
+class OpenCvLoader(object):
+
+    @staticmethod
+    def openCvIsLoaded():
+        return True
+
+
+class Mat(object):
+
+    def __init__(self, *args):
+        self.name_S = ""
+
+    def put(self, row, col, data):
+        self.name_S = data.name_S
+
+
+class Rect(object):
+
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+
+class MatOfRect(object):
+
+    def __init__(self):
+        self.rects_L = []
+
+    def toArray(self):
+        return self.rects_L
+
+
+class CvType(object):
+
+    CV_8UC1 = 0
+
+
+class Imgproc(object):
+
+    @staticmethod
+    def equalizeHist(src, dest):
+        pass
+
+
+class CascadeClassifier(object):
+
+    def __init__(self, path):
+        self.loaded = os.path.isfile(path)
+
+    def empty(self):
+        return not self.loaded
+
+    def detectMultiScale(self, image, objects, *args):
+        objects.rects_L = [Rect(10, 10, 24, 24)]
+        if "_face" in image.name_S or "_wanted" in image.name_S:
+            objects.rects_L.extend([Rect(100 + i, 100 + i, 60, 60)
+                            for i in range(C_HAAR_FACE_DETECTIONS)])
+
+
+class ImageStream(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def close(self):
+        pass
+
+
+class Readers(object):
+
+    def __init__(self, readers_L):
+        self.readers_L = readers_L
+
+    def hasNext(self):
+        return bool(self.readers_L)
+
+    def next(self):
+        return self.readers_L.pop(0)
+
+
+class ImageIO(object):
+
+    @staticmethod
+    def createImageInputStream(file):
+        return ImageStream(file.getPath())
+
+    @staticmethod
+    def getImageReaders(stream):
+        with open(stream.path, "rb") as image_F:
+            size = image_size(image_F.read(64 * 1024))
+        if size is None:
+            return Readers([])
+        return Readers([ImageReader(stream.path, size)])
+
+    @staticmethod
+    def read(file):
+        readers = ImageIO.getImageReaders(ImageStream(file.getPath()))
+        if not readers.hasNext():
+            return None
+        return readers.next().read(0)
+
+    @staticmethod
+    def write(image, format_S, file):
+        with open(file.getPath(), "wb") as image_F:
+            if format_S == "png":
+                image_F.write(tiny_png(image.getWidth(), image.getHeight()))
+            else:
+                image_F.write(jpeg_header(image.getWidth(),
+                                                        image.getHeight()))
+        return True
+
+
+#----------------------------------------------------------------------
+# Sleuthkit/Autopsy
+#----------------------------------------------------------------------
+class TskCoreException(Exception):
+    pass
+
+
+class ReadContentInputStream(object):
+
+    def __init__(self, file):
+        self.data = file.content()
+        self.pos = 0
+
+    def read(self, buf, offset=0, length=None):
+        if length is None:
+            length = len(buf)
+        chunk = self.data[self.pos:self.pos + length]
+        if not chunk:
+            return -1
+        buf[offset:offset + len(chunk)] = array("b", chunk)
+        self.pos += len(chunk)
+        add_bytes_read(len(chunk))
+        return len(chunk)
+
+    def skip(self, num_bytes):
+        num_bytes = min(num_bytes, len(self.data) - self.pos)
+        self.pos += num_bytes
+        return num_bytes
+
+    def close(self):
+        pass
+
+
+class ContentUtils(object):
+
+    @staticmethod
+    def writeToFile(file, dest):
+        data = file.content()
+        add_bytes_read(len(data))
+        with open(dest.getPath(), "wb") as out_F:
+            out_F.write(data)
+
+
+class Artifact(object):
+
+    def __init__(self, file, artifact_type):
+        self.file = file
+        self.artifact_type = artifact_type
+        self.attributes_L = []
+
+    def addAttribute(self, attribute):
+        self.attributes_L.append(attribute)
+
+    def getAttributes(self):
+        return self.attributes_L
+
+    def getObjectID(self):
+        return self.file.getId()
+
+    def getArtifactID(self):
+        return id(self)
+
+    def getDisplayName(self):
+        return "Interesting file hit"
+
+
+class AbstractFile(object):
+
+    __slots__ = ("obj_id", "name_S", "kind_S", "source_path", "content_id",
+                "size", "mime_S", "local_path", "artifacts_L")
+
+    def __init__(self, obj_id, name_S, kind_S, source_path, content_id,
+                                            size, mime_S, local_path=None):
+        self.obj_id = obj_id
+        self.name_S = name_S
+        self.kind_S = kind_S
+        self.source_path = source_path
+        self.content_id = content_id
+        self.size = size
+        self.mime_S = mime_S
+        self.local_path = local_path
+        self.artifacts_L = None
+
+    def content(self):
+        return make_content(self.kind_S, self.source_path, self.content_id,
+                                                                    self.size)
+
+    def getId(self):
+        return self.obj_id
+
+    def getName(self):
+        return self.name_S
+
+    def getSize(self):
+        return self.size
+
+    def getNameExtension(self):
+        return self.name_S.rpartition(".")[2].lower()
+
+    def getMIMEType(self):
+        return self.mime_S
+
+    def getMd5Hash(self):
+        return None
+
+    def getLocalAbsPath(self):
+        return self.local_path
+
+    def isFile(self):
+        return True
+
+    def isDir(self):
+        return False
+
+    def canRead(self):
+        return True
+
+    def getArtifacts(self, artifact_type):
+        return [art for art in (self.artifacts_L or [])
+                                    if art.artifact_type == artifact_type]
+
+    def newArtifact(self, artifact_type):
+        art = Artifact(self, artifact_type)
+        self.add_artifact(art)
+        return art
+
+    def add_artifact(self, art):
+        if self.artifacts_L is None:
+            self.artifacts_L = []
+        self.artifacts_L.append(art)
+        STATE["artifacts"].append(art)
+
+
+class SleuthkitCase(object):
+
+    def __init__(self, files_L):
+        self.files_L = sorted(files_L, key=lambda file: file.obj_id)
+        self.ids_L = [file.obj_id for file in self.files_L]
+        self.files_D = dict([(file.obj_id, file) for file in self.files_L])
+        self.blackboard = CaseBlackboard(self)
+
+    def getAbstractFileById(self, obj_id):
+        return self.files_D.get(int(obj_id))
+
+    #----------------------------------------------------------------
+    # The WHERE clauses built by FDRI.py: "obj_id IN (...)" and the
+    # enumeration (size, MIME type, extension or name, keyset page)
+    #----------------------------------------------------------------
+    def findAllFilesWhere(self, where_S):
+        STATE["queries"] += 1
+        match = re.match(r"obj_id IN \(([0-9,]+)\)", where_S)
+        if match:
+            return [self.files_D[int(id_S)]
+                        for id_S in match.group(1).split(",")
+                                    if int(id_S) in self.files_D]
+
+        match = re.search(r"size (>=|<) (\d+)", where_S)
+        large = match.group(1) == ">="
+        limit_size = int(match.group(2))
+        mime_types_S = set(re.findall(r"'(image/[a-z]+)'", where_S))
+        if "LIKE" in where_S:
+            extensions_S = set(re.findall(r"LIKE '%\.([a-z]+)'", where_S))
+        else:
+            extensions_S = set(re.findall(r"'([a-z]+)'",
+                                    where_S.split("LOWER(extension)")[1]))
+        match = re.search(r"obj_id > (-?\d+)", where_S)
+        last_id = int(match.group(1)) if match else -1
+        match = re.search(r"LIMIT (\d+)", where_S)
+        limit = int(match.group(1)) if match else len(self.files_L)
+
+        page_L = []
+        for file in itertools_islice(self.files_L,
+                                bisect.bisect_right(self.ids_L, last_id)):
+            if (file.size >= limit_size) != large:
+                continue
+            if file.mime_S in mime_types_S or\
+                                file.getNameExtension() in extensions_S:
+                page_L.append(file)
+                if len(page_L) >= limit:
+                    break
+        return page_L
+
+    def getBlackboardArtifacts(self, artifact_type, value_S=None):
+        if value_S is None:
+            return [art for art in STATE["artifacts"]
+                                    if art.artifact_type == artifact_type]
+        return [art for art in STATE["artifacts"]
+                    if value_S in [att.getValueString()
+                                        for att in art.getAttributes()]]
+
+    def addDerivedFile(self, label_S, temp_path, size, *args):
+        STATE["derived"].append((label_S, temp_path, size))
+
+    def getBlackboard(self):
+        return self.blackboard
+
+    def beginTransaction(self):
+        return CaseDbTransaction()
+
+
+# Artifacts created in a transaction reach the case on commit
+class CaseDbTransaction(object):
+
+    def __init__(self):
+        self.artifacts_L = []
+
+    def commit(self):
+        for art in self.artifacts_L:
+            art.file.add_artifact(art)
+        self.artifacts_L = []
+        STATE["transactions"] += 1
+
+    def rollback(self):
+        self.artifacts_L = []
+
+
+class AnalysisResultAdded(object):
+
+    def __init__(self, art):
+        self.art = art
+
+    def getAnalysisResult(self):
+        return self.art
+
+
+# Blackboard of the case DB (org.sleuthkit.datamodel)
+class CaseBlackboard(object):
+
+    class BlackboardException(Exception):
+        pass
+
+    def __init__(self, case):
+        self.case = case
+
+    def getArtifacts(self, type_id, data_source_id):
+        STATE["queries"] += 1
+        return [art for art in STATE["artifacts"]
+                        if art.artifact_type.getTypeID() == type_id]
+
+    def newAnalysisResult(self, result_type, obj_id, data_source_id, score,
+                conclusion_S, configuration_S, justification_S,
+                attributes_L, transaction):
+        art = Artifact(self.case.getAbstractFileById(obj_id),
+                                                    result_type.artifact_type)
+        for att in attributes_L:
+            art.addAttribute(att)
+        transaction.artifacts_L.append(art)
+        return AnalysisResultAdded(art)
+
+    def postArtifacts(self, artifacts_L, module_S):
+        STATE["indexed"] += len(artifacts_L)
+        IngestServices.getInstance().fireModuleDataEvent(
+                                ModuleDataEvent(module_S, artifacts_L))
+
+
+def itertools_islice(files_L, start):
+    for index in xrange(start, len(files_L)):
+        yield files_L[index]
+
+
+class FileManager(object):
+
+    def __init__(self, case):
+        self.case = case
+
+    def findFiles(self, data_source, pattern_S):
+        suffix_S = pattern_S.lstrip("%").lower()
+        return [file for file in self.case.files_L
+                                if file.name_S.lower().endswith(suffix_S)]
+
+
+class Blackboard(object):
+
+    class BlackboardException(Exception):
+        pass
+
+    def indexArtifact(self, art):
+        STATE["indexed"] += 1
+
+
+class Services(object):
+
+    def __init__(self, case):
+        self.file_manager = FileManager(case)
+        self.blackboard = Blackboard()
+
+    def getFileManager(self):
+        return self.file_manager
+
+    def getBlackboard(self):
+        return self.blackboard
+
+
+class Case(object):
+
+    current = None
+
+    @staticmethod
+    def getCurrentCase():
+        return Case.current
+
+    def __init__(self, case_dir, files_L):
+        self.case_dir = case_dir
+        self.sleuthkit_case = SleuthkitCase(files_L)
+        self.services = Services(self.sleuthkit_case)
+        for dir_S in (self.getModuleDirectory(), self.getTempDirectory()):
+            if not os.path.exists(dir_S):
+                os.makedirs(dir_S)
+
+    def getName(self):
+        return "benchmark"
+
+    def getModuleDirectory(self):
+        return os.path.join(self.case_dir, "ModuleOutput")
+
+    def getTempDirectory(self):
+        return os.path.join(self.case_dir, "Temp")
+
+    def getSleuthkitCase(self):
+        return self.sleuthkit_case
+
+    def getServices(self):
+        return self.services
+
+
+class DataSource(object):
+
+    def getName(self):
+        return "benchmark_ds"
+
+    def getId(self):
+        return 1
+
+
+class IngestJobContext(object):
+
+    def isJobCancelled(self):
+        return False
+
+
+# Updates of the progress bar: (time, method, arguments)
+class ProgressBar(object):
+
+    def __getattr__(self, name_S):
+        def update(*args):
+            STATE["progress"].append((time.time(), name_S, args))
+        return update
+
+
+class IngestServices(object):
+
+    @staticmethod
+    def getInstance():
+        return IngestServices()
+
+    def postMessage(self, message):
+        STATE["messages"].append(message)
+
+    def fireModuleDataEvent(self, event):
+        STATE["events"].append(event)
+
+
+class IngestMessage(object):
+
+    class MessageType(object):
+        DATA = "DATA"
+
+    @staticmethod
+    def createMessage(message_type, module_S, message_S):
+        return message_S
+
+
+class IngestModule(object):
+
+    class ProcessResult(object):
+        OK = "OK"
+        ERROR = "ERROR"
+
+
+class IngestModuleException(Exception):
+    pass
+
+
+class ModuleDataEvent(object):
+
+    def __init__(self, *args):
+        self.args = args
+
+
+class ArtifactType(object):
+
+    def __init__(self, type_id):
+        self.type_id = type_id
+
+    def getTypeID(self):
+        return self.type_id
+
+
+class BlackboardArtifact(object):
+
+    class ARTIFACT_TYPE(object):
+        TSK_INTERESTING_FILE_HIT = ArtifactType(3)
+
+    class Type(object):
+
+        def __init__(self, artifact_type):
+            self.artifact_type = artifact_type
+
+
+class Score(object):
+    SCORE_LIKELY_NOTABLE = "LIKELY_NOTABLE"
+
+
+class BlackboardAttribute(object):
+
+    class ATTRIBUTE_TYPE(object):
+
+        class TSK_SET_NAME(object):
+
+            @staticmethod
+            def getTypeID():
+                return 1
+
+    def __init__(self, type_id, module_S, value_S):
+        self.value_S = value_S
+
+    def getValueString(self):
+        return self.value_S
+
+
+class TskData(object):
+
+    class EncodingType(object):
+        NONE = 0
+
+    class TSK_DB_FILES_TYPE_ENUM(object):
+        pass
+
+    class TSK_FS_META_TYPE_ENUM(object):
+
+        class TSK_FS_META_TYPE_DIR(object):
+
+            @staticmethod
+            def getValue():
+                return 2
+
+
+# Job settings of the ingest panel (flags: jpg, jpeg, png, hashes,
+# dedupe)
+class JobSettings(object):
+
+    def __init__(self, wanted_dir, hashes=True, dedupe=True):
+        self.flags_L = [True, True, True, hashes, dedupe]
+        self.wanted_dir = wanted_dir
+
+    def getFlag(self, pos):
+        if pos < len(self.flags_L):
+            return self.flags_L[pos]
+        return False
+
+    def getAllFlags(self):
+        return self.flags_L
+
+    def getPath(self, code):
+        return self.wanted_dir
+
+
+class Base(object):
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+def install():
+    module("jarray", zeros=jarray_zeros)
+    module("java.awt", BasicStroke=Anything, BorderLayout=Anything,
+            Color=Anything(), Dimension=Anything, FlowLayout=Anything,
+            GridLayout=Anything, RenderingHints=Anything())
+    module("java.awt.event", KeyAdapter=Anything, KeyEvent=Anything,
+                                                    KeyListener=Anything)
+    module("java.awt.image", BufferedImage=Image)
+    module("java.io", File=File, FileOutputStream=FileOutputStream,
+                                        RandomAccessFile=RandomAccessFile)
+    module("java.nio", ByteOrder=ByteOrder)
+    module("java.nio.channels", FileChannel=FileChannel)
+    module("java.lang", System=Anything())
+    module("java.nio.file", Files=Files)
+    module("java.util.logging", Level=Level)
+    module("javax.imageio", ImageIO=ImageIO)
+    module("javax.swing", BorderFactory=Anything, BoxLayout=Anything,
+            JButton=Anything, JCheckBox=Anything, JComponent=Anything,
+            JFileChooser=Anything, JFrame=Anything, JLabel=Anything,
+            JPanel=Anything, JScrollPane=Anything, JTextField=Anything,
+            JToolBar=Anything)
+    module("javax.swing.event", DocumentEvent=Anything,
+                                                DocumentListener=Anything)
+    module("org.sleuthkit.autopsy.casemodule", Case=Case)
+    module("org.sleuthkit.autopsy.casemodule.services",
+            Blackboard=Blackboard, FileManager=FileManager,
+            Services=Services)
+    module("org.sleuthkit.autopsy.coreutils", Logger=Logger,
+                                                OpenCvLoader=OpenCvLoader)
+    module("org.opencv.core", Core=Anything(), CvType=CvType, Mat=Mat,
+                                        MatOfRect=MatOfRect, Size=Base)
+    module("org.opencv.imgproc", Imgproc=Imgproc)
+    module("org.opencv.objdetect", CascadeClassifier=CascadeClassifier)
+    module("org.sleuthkit.autopsy.datamodel", ContentUtils=ContentUtils)
+    module("org.sleuthkit.autopsy.ingest", DataSourceIngestModule=Base,
+            FileIngestModule=Base, IngestMessage=IngestMessage,
+            IngestModule=IngestModule, IngestModuleFactoryAdapter=Base,
+            IngestModuleIngestJobSettings=Base,
+            IngestModuleIngestJobSettingsPanel=Base,
+            IngestModuleGlobalSettingsPanel=Base,
+            IngestServices=IngestServices, ModuleDataEvent=ModuleDataEvent)
+    module("org.sleuthkit.autopsy.ingest.IngestModule",
+            IngestModuleException=IngestModuleException)
+    module("org.sleuthkit.datamodel", AbstractFile=AbstractFile,
+            Blackboard=CaseBlackboard, BlackboardArtifact=BlackboardArtifact,
+            BlackboardAttribute=BlackboardAttribute, Score=Score,
+            ReadContentInputStream=ReadContentInputStream,
+            SleuthkitCase=SleuthkitCase, TskCoreException=TskCoreException,
+            TskData=TskData)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+#----------------------------------------------------------------------
+# Offline benchmark of FDRIModule.process: the module runs (CPython
+# 2.7) over a corpus of make_corpus.py, against the mock Autopsy API
+# (mock_autopsy.py) and the stand-in FDRI.exe (fake_fdri.py), and the
+# time spent in each stage is reported:
+#   enumeration   queries of the case DB (find_page)
+#   header check  image headers read before copying (sniffer)
+#   copy          extraction of the files to img/ (worker threads)
+#   hash          hashes computed apart from the copy
+#   detection     FDRI.exe runs (or batches of the service)
+#   ingestion     results posted to the blackboard
+#   dfxml         DFXML completed with the hashes and merged
+# Stages run concurrently (copy workers, detector and poster threads):
+# "busy secs" add up the time of the calls of each stage, so the rate
+# of a stage is the rate of one of its threads.
+#----------------------------------------------------------------------
+import argparse
+import glob
+import imp
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+C_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+C_REPO_DIR = os.path.dirname(C_BENCH_DIR)
+sys.path.insert(0, C_BENCH_DIR)
+import mock_autopsy
+
+C_DEFAULT_WANTED_DIR = os.path.join(C_REPO_DIR, "testing_data",
+                                                            "face_to_find")
+
+# Stage -> [(class name, method name, items of a call)]
+C_STAGES_L = [
+    ("enumeration", [("FDRIModule", "find_page",
+                                    lambda args, result: len(result))]),
+    ("header check", [("ImageHeaderSniffer", "check", None)]),
+    ("copy", [("ExtractionPool", "extract", None)]),
+    ("hash", [("FileHasher", "compute_hashes", None)]),
+    ("detection", [("FDRIModule", "run_fdri",
+                        lambda args, result: len(args[1].copied_ids_L))]),
+    ("ingestion", [("FDRIModule", "post_shard",
+                        lambda args, result: len(args[1].copied_ids_L)),
+                    ("FDRIModule", "post_late_duplicates",
+                                                lambda args, result: 0)]),
+    ("dfxml", [("FDRIModule", "complete_dfxml",
+                                    lambda args, result: len(args[2])),
+                ("FDRIModule", "merge_shards_results",
+                                                lambda args, result: 0)]),
+]
+
+
+#----------------------------------------------------------------------
+# Time spent in (and items handled by) the wrapped methods of a stage
+#----------------------------------------------------------------------
+class StageTimer(object):
+
+    def __init__(self, name_S):
+        self.name_S = name_S
+        self.calls = 0
+        self.items = 0
+        self.busy_secs = 0.0
+        self.lock = threading.Lock()
+
+    def wrap(self, owner, method_S, count_items):
+        method = getattr(owner, method_S)
+        timer = self
+
+        def timed(*args):
+            start_time = time.time()
+            result = method(*args)
+            elapsed = time.time() - start_time
+            with timer.lock:
+                timer.calls += 1
+                timer.busy_secs += elapsed
+                if count_items is None:
+                    timer.items += 1
+                else:
+                    timer.items += count_items(args, result)
+            return result
+        setattr(owner, method_S, timed)
+
+    def as_dict(self):
+        rate = self.items / self.busy_secs if self.busy_secs else 0.0
+        return {"calls": self.calls, "items": self.items,
+                        "busy_secs": self.busy_secs, "items_per_sec": rate}
+
+
+# Stand-in FDRI.exe, run with this interpreter
+def write_exe(work_dir):
+    exe_path = os.path.join(work_dir, "FDRI.exe")
+    with open(exe_path, "w") as exe_F:
+        exe_F.write("#!/bin/sh\nexec '%s' '%s' \"$@\"\n" % (sys.executable,
+                                os.path.join(C_BENCH_DIR, "fake_fdri.py")))
+    os.chmod(exe_path, os.stat(exe_path).st_mode | stat.S_IXUSR)
+    return exe_path
+
+
+def load_module(module_path, constants_L):
+    mock_autopsy.install()
+    fdri = imp.load_source("FDRI", module_path)
+    for const_S in constants_L:
+        name_S, _, value_S = const_S.partition("=")
+        if not hasattr(fdri, name_S):
+            raise ValueError("no constant '%s' in '%s'" % (name_S,
+                                                            module_path))
+        setattr(fdri, name_S, eval(value_S))
+    return fdri
+
+
+def run(options):
+    import make_corpus
+
+    fdri = load_module(options.module, options.const)
+    timers_L = []
+    for stage_S, methods_L in C_STAGES_L:
+        timer = StageTimer(stage_S)
+        for class_S, method_S, count_items in methods_L:
+            timer.wrap(getattr(fdri, class_S), method_S, count_items)
+        timers_L.append(timer)
+
+    if options.work:
+        work_dir = os.path.abspath(options.work)
+        if os.path.exists(work_dir) and not options.keep:
+            shutil.rmtree(work_dir)
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="fdri_bench_")
+
+    start_time = time.time()
+    files_L = make_corpus.load_corpus(options.corpus)
+    load_secs = time.time() - start_time
+
+    os.environ["FDRI_BENCH_RUN_SECS"] = str(options.run_secs)
+    os.environ["FDRI_BENCH_IMAGE_SECS"] = str(options.image_secs)
+    os.environ["FDRI_BENCH_MAX_PIXELS"] = str(options.max_pixels)
+    if options.stall:
+        os.environ["FDRI_BENCH_STALL"] = options.stall
+    fdri.GLOBAL_CONFIGURATION_PATH = os.path.join(work_dir,
+                                                    "configuration.json")
+    if not os.path.exists(fdri.GLOBAL_CONFIGURATION_PATH):
+        with open(fdri.GLOBAL_CONFIGURATION_PATH, "w") as config_F:
+            json.dump({"save_files": False,
+                        "paths": {"0": "", "1": "", "2": ""},
+                        "gpu_memory_mb": options.gpu_memory_mb}, config_F)
+    # Haar cascade of the pre-pass (read by the stand-in OpenCV)
+    cascade_path = fdri.prepass_cascade_path()
+    if not os.path.exists(cascade_path):
+        with open(cascade_path, "w") as cascade_F:
+            cascade_F.write("<opencv_storage></opencv_storage>\n")
+
+    mock_autopsy.reset_state()
+    mock_autopsy.Case.current = mock_autopsy.Case(
+                                os.path.join(work_dir, "case"), files_L)
+    module = fdri.FDRIModule(mock_autopsy.JobSettings(options.wanted,
+                                        not options.no_hashes,
+                                        not options.no_dedupe))
+    module.startUp(mock_autopsy.IngestJobContext())
+    module.pathToExe = write_exe(work_dir)
+
+    start_time = time.time()
+    result = module.process(mock_autopsy.DataSource(),
+                                                mock_autopsy.ProgressBar())
+    process_secs = time.time() - start_time
+
+    report_D = {
+        "corpus": os.path.abspath(options.corpus),
+        "files": len(files_L),
+        "result": str(result),
+        "corpus_load_secs": load_secs,
+        "process_secs": process_secs,
+        "files_per_sec": len(files_L) / process_secs if process_secs else 0,
+        "bytes_read": mock_autopsy.STATE["bytes_read"],
+        "queries": mock_autopsy.STATE["queries"],
+        "artifacts": len(mock_autopsy.STATE["artifacts"]),
+        "transactions": mock_autopsy.STATE["transactions"],
+        "derived_files": len(mock_autopsy.STATE["derived"]),
+        "messages": mock_autopsy.STATE["messages"],
+        # Updates of the progress bar: (secs since the start, method,
+        # arguments)
+        "progress": [(update_time - start_time, method_S, list(args))
+                            for update_time, method_S, args in
+                                        mock_autopsy.STATE["progress"]],
+        "stages": dict([(timer.name_S, timer.as_dict())
+                                                    for timer in timers_L]),
+        "constants": options.const,
+        "work_dir": work_dir,
+    }
+    # Metrics written by the module itself (C_METRICS), if any
+    for metrics_path in sorted(glob.glob(os.path.join(work_dir, "case",
+                "ModuleOutput", "*", "FDRI", "*", fdri.C_METRICS_FNAME))):
+        with open(metrics_path, "r") as metrics_F:
+            report_D["module_metrics"] = json.load(metrics_F)
+    problems_L = [record for record in mock_autopsy.Logger.records_L
+                                    if record[0] in ("SEVERE", "WARNING")]
+    report_D["warnings"] = len(problems_L)
+
+    print_report(report_D, timers_L)
+    if options.verbose:
+        for level, method_S, msg_S in mock_autopsy.Logger.records_L:
+            print("%-8s %-24s %s" % (level, method_S, msg_S))
+        for secs, method_S, args_L in report_D["progress"]:
+            print("%8.2f %-24s %s" % (secs, method_S,
+                                    ", ".join([str(arg) for arg in args_L])))
+    elif problems_L:
+        for level, method_S, msg_S in problems_L[:20]:
+            print("%-8s %-24s %s" % (level, method_S, msg_S))
+    if options.json:
+        with open(options.json, "w") as json_F:
+            json.dump(report_D, json_F, indent=2, sort_keys=True)
+    if not options.work and not options.keep:
+        shutil.rmtree(work_dir, True)
+    return report_D
+
+
+def print_report(report_D, timers_L):
+    print("Corpus: %d files (loaded in %.2f secs)" % (report_D["files"],
+                                            report_D["corpus_load_secs"]))
+    print("process(): %.2f secs, %.1f files/sec, %.1f MB read, "
+            "%d queries, %d artifacts (%d transactions), %d derived files "
+            "(%s)" % (report_D["process_secs"], report_D["files_per_sec"],
+            report_D["bytes_read"] / 1048576.0, report_D["queries"],
+            report_D["artifacts"], report_D["transactions"],
+            report_D["derived_files"],
+            report_D["result"]))
+    print("%-14s %8s %10s %12s %12s" % ("stage", "calls", "items",
+                                                "busy secs", "items/sec"))
+    for timer in timers_L:
+        stage_D = timer.as_dict()
+        print("%-14s %8d %10d %12.3f %12.1f" % (timer.name_S,
+                    stage_D["calls"], stage_D["items"],
+                    stage_D["busy_secs"], stage_D["items_per_sec"]))
+    for message_S in report_D["messages"]:
+        print(message_S)
+
+
+def main(args_L):
+    parser = argparse.ArgumentParser(description="Offline benchmark of "
+                                                "the FDRI Autopsy module")
+    parser.add_argument("--corpus", required=True,
+                                    help="TSV file of make_corpus.py")
+    parser.add_argument("--module", default=os.path.join(C_REPO_DIR,
+                                "FDRI.py"), help="FDRI.py to benchmark")
+    parser.add_argument("--work", help="case directory (default: a "
+                                        "temporary one, removed after)")
+    parser.add_argument("--keep", action="store_true",
+            help="keep the case directory (a second run is a rerun)")
+    parser.add_argument("--const", action="append", default=[],
+            metavar="NAME=VALUE", help="set a C_ constant of FDRI.py "
+            "(Python expression), e.g. C_SHARD_SIZE=500")
+    parser.add_argument("--wanted", default=C_DEFAULT_WANTED_DIR,
+                help="folder with the wanted faces ('' : no recognition)")
+    parser.add_argument("--no-hashes", action="store_true",
+                                    help="no hashes in the DFXML file")
+    parser.add_argument("--no-dedupe", action="store_true",
+                                    help="copies of an image processed")
+    parser.add_argument("--run-secs", type=float, default=0.5,
+                            help="cost of each FDRI.exe run (models)")
+    parser.add_argument("--image-secs", type=float, default=0.01,
+                            help="cost of each image in FDRI.exe")
+    parser.add_argument("--max-pixels", type=int, default=0,
+                help="FDRI.exe runs out of GPU memory above (pixels)")
+    parser.add_argument("--stall", metavar="TEXT", help="the detector "
+                "hangs on the images whose name contains TEXT (watchdog)")
+    parser.add_argument("--gpu-memory-mb", type=int, default=0,
+                                    help="GPU memory of configuration.json")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--verbose", action="store_true",
+                                                help="print the module's log")
+    options = parser.parse_args(args_L)
+    run(options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#----------------------------------------------------------------------
+# FaceIndex (FDRI.py): the partitions (k-means centroids) must prune
+# the faces read without losing matches. Synthetic descriptors: faces
+# of each person around a centre, people far apart, as with dlib's
+# descriptors. The search is compared with a brute-force scan.
+#   python benchmark/test_face_index.py
+#----------------------------------------------------------------------
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+C_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, C_BENCH_DIR)
+import run_benchmark
+
+C_DIM = 128
+C_PEOPLE = 60
+C_FACES_PER_PERSON = 40
+# Distance of a face to the centre of its person (same person: below
+# the threshold, other people: about 1.4)
+C_FACE_SPREAD = 0.25
+C_THRESHOLD = 0.6
+
+fdri = run_benchmark.load_module(os.path.join(run_benchmark.C_REPO_DIR,
+                                                            "FDRI.py"), [])
+
+
+def unit_vector(rnd):
+    vector = [rnd.gauss(0.0, 1.0) for j in range(C_DIM)]
+    norm = math.sqrt(sum([x * x for x in vector]))
+    return [x / norm for x in vector]
+
+
+def face_of(rnd, centre):
+    noise = unit_vector(rnd)
+    spread = rnd.uniform(0.0, C_FACE_SPREAD)
+    return [c + spread * n for c, n in zip(centre, noise)]
+
+
+def distance(vector_1, vector_2):
+    return math.sqrt(sum([(a - b) * (a - b)
+                                    for a, b in zip(vector_1, vector_2)]))
+
+
+class FaceIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp(prefix="fdri_index_")
+        rnd = random.Random(7)
+        self.centres_L = [unit_vector(rnd) for i in range(C_PEOPLE)]
+        # (descriptor, file id)
+        self.faces_L = []
+        for i in range(C_PEOPLE * C_FACES_PER_PERSON):
+            person = rnd.randrange(C_PEOPLE)
+            self.faces_L.append((face_of(rnd, self.centres_L[person]), i))
+        self.queries_D = dict([("person_%d.jpg" % (person),
+                            [face_of(rnd, self.centres_L[person])])
+                                        for person in range(0, C_PEOPLE, 6)])
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def build(self, num_partitions, batch_size=200):
+        index = fdri.FaceIndex(self.index_dir, C_DIM, num_partitions, 16, 5)
+        for start in range(0, len(self.faces_L), batch_size):
+            for descriptor_L, file_id in self.faces_L[start:start +
+                                                            batch_size]:
+                index.add_image([descriptor_L], "case", "ds", file_id,
+                                                    "face_%d.jpg" % (file_id))
+            index.flush()
+        return index
+
+    # File ids within the threshold of any query, by brute force
+    def brute_force(self):
+        ids_S = set()
+        for descriptors_L in self.queries_D.values():
+            for query_L in descriptors_L:
+                for descriptor_L, file_id in self.faces_L:
+                    if distance(query_L, descriptor_L) <= C_THRESHOLD:
+                        ids_S.add(file_id)
+        return ids_S
+
+    def search_ids(self, index, probes):
+        matches_L = index.search(self.queries_D, C_THRESHOLD, probes)
+        return set([int(meta_L[3]) for distance_f, wanted_fname, meta_L
+                                                                in matches_L])
+
+    def test_exhaustive(self):
+        index = self.build(0)
+        expected_S = self.brute_force()
+        self.assertTrue(expected_S)
+        self.assertEqual(self.search_ids(index, 1), expected_S)
+        self.assertEqual(index.searched_count, len(self.faces_L))
+
+    def test_partitions_keep_recall(self):
+        index = self.build(16)
+        self.assertEqual(index.num_centroids(), 16)
+        self.assertFalse(os.path.exists(
+                                index.vectors_path(fdri.FaceIndex.STAGING)))
+        expected_S = self.brute_force()
+        found_S = self.search_ids(index, 2)
+        recall = float(len(found_S & expected_S)) / len(expected_S)
+        self.assertTrue(found_S <= expected_S)
+        self.assertTrue(recall >= 0.99, "recall %f" % (recall))
+        # The search reads a fraction of the faces per query
+        faces_per_query = float(index.searched_count) / len(self.queries_D)
+        self.assertTrue(faces_per_query < 0.3 * len(self.faces_L),
+                            "%d faces read per query" % (faces_per_query))
+
+    def test_staging_before_training(self):
+        index = fdri.FaceIndex(self.index_dir, C_DIM, 16, 16, 5)
+        for descriptor_L, file_id in self.faces_L[:100]:
+            index.add_image([descriptor_L], "case", "ds", file_id, "f.jpg")
+        index.flush()
+        self.assertEqual(index.num_centroids(), 0)
+        self.faces_L = self.faces_L[:100]
+        self.assertEqual(self.search_ids(index, 2), self.brute_force())
+
+
+if __name__ == "__main__":
+    unittest.main()